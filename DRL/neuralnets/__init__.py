@@ -1,3 +1,4 @@
 from __future__ import absolute_import
 from . import a3cnn
+from . import numpynn
 from . import qnn
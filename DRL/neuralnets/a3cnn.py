@@ -1,6 +1,9 @@
 # coding: utf-8
 import numpy as np
 from ..utils import settings
+from ..utils.sharedparams import ParameterBuffer
+from ..utils.summaries import SummaryPolicy
+from ..utils.schedule import LearningRateSchedule
 import os
 from os.path import join as pjoin
 
@@ -47,7 +50,10 @@ class A3CNeuralNetwork():
 
         self.variables = {}
         self.initialised = False
+        self.loaded_version = None
+        self.gradients = None
         self.learning_rate = learning_rate
+        self.schedule = LearningRateSchedule(learning_rate, "linear")
         self.alpha_reg = alpha_reg
         self.beta_reg = beta_reg
 
@@ -59,28 +65,33 @@ class A3CNeuralNetwork():
         Create the neural network, the loss and the train step
         """
         self.create_variables()
+        self.build_assign()
         self.create_placeholders()
         self.build_model()
-        self.reset_lr(None, True)
+        self.create_learning_rate()
         self.build_loss()
         self.build_train_step()
+        self.build_delta()
         self.initialised = True
 
-    def create_summary(self, sess, name="0"):
+    def create_summary(self, sess, name="0", scalar_every=10, histogram_every=1000):
+        """
+        Create the summaries and their writer. They are computed by train following a SummaryPolicy
+        Parameters:
+            sess: tensorflow session
+            name: name of the directory of the summaries
+            scalar_every: number of updates between two summaries of the learning rate and the loss
+            histogram_every: number of updates between two histograms of the weights and biases
+        """
         import tensorflow as tf
 
         save_path = './callbacks/summaries/' + name + '/'
 
-        tf.summary.scalar("learning rate", self.decay_learning_rate)
-        tf.summary.scalar("loss", self.loss_vf)
-
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
+        scalars = tf.summary.merge([tf.summary.scalar("learning rate", self.decay_learning_rate),
+                                    tf.summary.scalar("loss", self.loss_vf)])
 
-        for key in keys:
-            tf.summary.histogram(key, self.variables[key])
-
-        self.merged = tf.summary.merge_all()
+        histograms = tf.summary.merge([tf.summary.histogram(key, self.variables[key]) 
+                                       for key in self.keys])
 
         if os.path.exists(save_path):
             for f in os.listdir(save_path):
@@ -90,6 +101,27 @@ class A3CNeuralNetwork():
 
         self.writer = tf.summary.FileWriter(save_path, sess.graph)
 
+        self.summaries = SummaryPolicy(self.writer, scalars, histograms, scalar_every, histogram_every)
+
+    def train(self, sess, feed_dict, step, fetches=[], T=None):
+        """
+        Run the train step with the summaries due following the summary policy. Return the values of
+        fetches
+        Parameters:
+            sess: tensorflow session, allow multiprocessing
+            feed_dict: feed_dict of the train step
+            step: step of the summaries
+            fetches: list of tensors evaluated with the train step
+            T: global step. If not None, the learning rate of self.schedule at T is fed, else the
+               initial learning rate is used
+        """
+        if T is not None:
+            feed_dict = dict(feed_dict)
+            feed_dict[self.decay_learning_rate] = self.schedule(T)
+
+        self.loaded_version = None
+        return self.summaries.run(sess, [self.train_step] + list(fetches), feed_dict, step)[1:]
+
     def create_weight_variable(self, shape, name="W", type_layer=None):
         """
         Create a matrix of weights as a tf variable. Create also a placeholder and a assign operation
@@ -147,6 +179,68 @@ class A3CNeuralNetwork():
             type_layer="vf")
         self.create_bias_variable((1, 1), name="bo_vf", type_layer="vf")
 
+    def build_assign(self):
+        """
+        Create a single operation loading every weight/biais from a flat float32 buffer, in the 
+        order of the sorted keys. The order is computed once here and stored in self.keys.
+        """
+        import tensorflow as tf
+
+        self.keys = sorted(self.variables.keys())
+        self.keys = [key for key in self.keys if critere_keys(key)]
+
+        shapes = [self.variables[key].get_shape().as_list() for key in self.keys]
+        self.theta_copy = ParameterBuffer(shapes)
+
+        self.variables["theta_ph"] = tf.placeholder(tf.float32, shape=[self.theta_copy.size], 
+            name="theta_ph")
+        splits = tf.split(self.variables["theta_ph"], self.theta_copy.sizes)
+        self.theta_base = tf.Variable(tf.zeros([self.theta_copy.size]), trainable=False, 
+            name="theta_base")
+        self.variables["theta_assign"] = tf.group(*[tf.assign(self.variables[key], 
+            tf.reshape(split, shape)) for key, split, shape in zip(self.keys, splits, shapes)] + 
+            [tf.assign(self.theta_base, self.variables["theta_ph"])])
+
+    def build_gradients(self, loss):
+        """
+        Create the train step used with the shared optimiser (settings.shared_optimizer): it only
+        computes the gradients of loss, as a flat float32 buffer in the order of self.keys, which
+        push_update applies to theta
+        """
+        import tensorflow as tf
+
+        variables = [self.variables[key] for key in self.keys]
+        gradients = [tf.zeros_like(variable) if gradient is None else gradient
+                     for gradient, variable in zip(tf.gradients(loss, variables), variables)]
+        self.gradients = tf.concat([tf.reshape(gradient, [-1]) for gradient in gradients], 0)
+        self.train_step = tf.no_op()
+
+    def build_delta(self):
+        """
+        Create the operations computing, as a flat float32 buffer in the order of self.keys, the
+        update of the weights since the last assign and the sum of the norms of its tensors. 
+        theta_delta reads the current weights; train_delta reads them after the train step, so that
+        an update and its delta take a single sess.run.
+        """
+        import tensorflow as tf
+
+        def delta():
+            flat = tf.concat([tf.reshape(tf.identity(self.variables[key]), [-1]) 
+                              for key in self.keys], 0)
+            delta = flat - self.theta_base
+            norm = tf.add_n([tf.norm(split) for split in tf.split(delta, self.theta_copy.sizes)])
+            return delta, norm
+
+        self.theta_delta, self.theta_delta_norm = delta()
+        with tf.control_dependencies([self.train_step]):
+            self.train_delta, self.train_delta_norm = delta()
+
+        # Values fetched with the train step and given to push_update
+        if self.gradients is None:
+            self.update_fetches = [self.train_delta, self.train_delta_norm]
+        else:
+            self.update_fetches = [self.gradients]
+
     def create_placeholders(self):
         """
         Create placeholders for the observations, the results and the actions took
@@ -164,9 +258,6 @@ class A3CNeuralNetwork():
             self.variables["y_action"].append(tf.placeholder(tf.float32, shape=(None, self.output_size[i]), 
             name="action_%s"%i))
 
-        self.variables["loss_policy_ph"] = tf.placeholder(tf.float32, shape=[None], 
-            name="loss_policy")
-
     def build_model(self):
         """
         Create the forward pass
@@ -188,8 +279,16 @@ class A3CNeuralNetwork():
         self.variables["values"] = tf.matmul(y, self.variables["Wo_vf"]) + self.variables["bo_vf"]
         
     def build_loss(self):
+        """
+        Create the losses of the policy and of the value function. The advantages are computed in 
+        the graph from the returns fed in y_true and the values of the same forward pass, so an 
+        update needs a single sess.run.
+        """
         import tensorflow as tf
 
+        values = tf.squeeze(self.variables["values"], axis=1)
+        self.advantages = tf.stop_gradient(self.variables["y_true"] - values)
+
         log_pi = [tf.log(tf.clip_by_value(self.variables["actions"][0], 1e-20, 1.))]
         pi_actions = [tf.reduce_sum(tf.multiply(log_pi[0] , self.variables["y_action"][0]), axis=1)]
         for i in range(1, len(self.output_size)):
@@ -198,17 +297,21 @@ class A3CNeuralNetwork():
         
         self.loss_policy = 0.
         for j in pi_actions:
-            self.loss_policy += -tf.reduce_sum(tf.multiply(j, self.variables["loss_policy_ph"]))
+            self.loss_policy += -tf.reduce_sum(tf.multiply(j, self.advantages))
 
         for i in range(len(log_pi)):
             self.loss_policy -= self.beta_reg * tf.reduce_sum(tf.multiply(self.variables["actions"][i], log_pi[i]))
 
-        self.loss_vf = tf.nn.l2_loss(self.variables["values"] - self.variables["y_true"])
+        self.loss_vf = tf.nn.l2_loss(values - self.variables["y_true"])
         
 
     def build_train_step(self):
         import tensorflow as tf
 
+        if settings.shared_optimizer is not None:
+            self.build_gradients(self.loss_policy + self.loss_vf)
+            return
+
         self.optimizer = tf.train.RMSPropOptimizer(self.decay_learning_rate,
             decay=0.99, momentum=0., centered=True)
 
@@ -223,29 +326,17 @@ class A3CNeuralNetwork():
         self.updates += self.optimizer.compute_gradients(self.loss_vf, 
                                 [self.variables[key] for key in keys])
         
-        self.train_step = self.optimizer.apply_gradients(self.updates,
-            global_step=self.global_step)
+        self.train_step = self.optimizer.apply_gradients(self.updates)
 
-    def reset_lr(self, sess, init=False):
+    def create_learning_rate(self):
+        """
+        Create the placeholder of the learning rate, fed by train from self.schedule
+        """
         import tensorflow as tf
-        
-        if init:
-            self.global_step = tf.Variable(0, trainable=False)
-            self.global_step_pl = tf.placeholder(tf.int32)
-            self.global_step_assign = tf.assign(self.global_step, self.global_step_pl)
-
-            self.decay_steps = tf.Variable(1, trainable=False)
-            self.decay_steps_pl = tf.placeholder(tf.int32)
-            self.decay_steps_assign = tf.assign(self.decay_steps, self.decay_steps_pl)
-        else:
-            print("Reset")
-            temp = sess.run(self.decay_steps) * 2
-            sess.run(self.decay_steps_assign, feed_dict={self.decay_steps_pl: temp})
-        
-        #self.decay_learning_rate = tf.train.exponential_decay(self.learning_rate,
-        #    global_step=self.global_step, decay_steps=self.decay_steps, decay_rate=0.999)
 
-        self.decay_learning_rate = self.learning_rate - self.global_step / self.decay_steps * self.learning_rate * 1e-3
+        self.variables["learning_rate_ph"] = tf.placeholder_with_default(np.float32(self.learning_rate),
+                                                                         shape=[], name="learning_rate_ph")
+        self.decay_learning_rate = self.variables["learning_rate_ph"]
 
     def get_reward(self, observation, sess):
         feed_dic = {self.variables["input_observation"]: observation.reshape((1, -1))}
@@ -253,6 +344,49 @@ class A3CNeuralNetwork():
         reward = [np.squeeze(i) for i in reward]
         return reward
 
+    def get_outputs(self, observation, sess):
+        """
+        Return the probabilities of each head of the policy and the estimated value of a state, 
+        in one forward pass
+        Parameters:
+            observation: np.array, state of the environnement
+            sess: tensorflow session, allow multiprocessing
+        """
+        feed_dic = {self.variables["input_observation"]: observation.reshape((1, -1))}
+        actions, value = sess.run([self.variables["actions"], self.variables["values"]], 
+                                  feed_dict=feed_dic)
+        return [np.squeeze(i) for i in actions], value[0, 0]
+
+    def forward(self, observations, sess):
+        """
+        Return the probabilities of each head of the policy, of shape (batch_size, output_size[i]),
+        and the values, of shape (batch_size,), of a batch of observations in one sess.run
+        Parameters:
+            observations: np.array of shape (batch_size, input_size)
+            sess: tensorflow session, allow multiprocessing
+        """
+        feed_dic = {self.variables["input_observation"]: observations.reshape((len(observations), -1))}
+        actions, values = sess.run([self.variables["actions"], self.variables["values"]], 
+                                   feed_dict=feed_dic)
+        return actions, values[:, 0]
+
+    def best_actions(self, observations, sess):
+        """
+        Sample an action of each head of the policy for each observation of a batch, as an array
+        of shape (batch_size, len(output_size))
+        Parameters:
+            observations: np.array of shape (batch_size, input_size)
+            sess: tensorflow session, allow multiprocessing
+        """
+        actions, _ = self.forward(observations, sess)
+        choice = np.zeros((len(observations), len(actions)), dtype=np.int64)
+        for i, proba in enumerate(actions):
+            proba = np.clip(proba, 1e-10, 1-1e-10)
+            cumsum = np.cumsum(proba, axis=1) / np.sum(proba, axis=1, keepdims=True)
+            u = np.random.rand(len(proba), 1)
+            choice[:, i] = np.minimum(np.sum(cumsum < u, axis=1), proba.shape[1] - 1)
+        return choice
+
     def best_choice(self, observation, sess):
         """
         Return the best action and the estimated reward for a given state
@@ -261,16 +395,34 @@ class A3CNeuralNetwork():
             sess: tensorflow session, allow multiprocessing
         """
         assert self.initialised, "This model must be initialised (self.initialisation())"
-        feed_dic = {self.variables["input_observation"]: observation.reshape((1, -1))}
-        reward_temp = sess.run(self.variables["actions"], feed_dict=feed_dic)
-        reward = []
-        for i in reward_temp:
+        reward_temp, value = self.get_outputs(observation, sess)
+        return self.action_from_reward(reward_temp), value
+
+    def action_from_reward(self, reward, weighted=False):
+        """
+        Sample an action of each head from the probabilities of the policy of a state
+        Parameters:
+            reward: list of np.array, output of get_reward
+            weighted: Not used, the policy is always sampled
+        """
+        probas = []
+        for i in reward:
             i = np.clip(i, 1e-10, 1-1e-10)
             i = i / np.sum(i)
-            reward.append(np.squeeze(i))
-        value = sess.run(self.variables["values"], feed_dict = feed_dic)
-        choice = [np.random.choice(range(len(i)), p = i) for i in reward]
-        return choice, value[0, 0]
+            probas.append(np.squeeze(i))
+        return [np.random.choice(range(len(i)), p = i) for i in probas]
+
+    def choose_action(self, observation, sess, weighted=False):
+        """
+        Return the action sampled for a given state, as best_action, and the probabilities of each
+        head (output of get_reward) from which it was sampled, with a single forward pass
+        Parameters:
+            observation: np.array, state of the environnement
+            sess: tensorflow session, allow multiprocessing
+            weighted: Not used, the policy is always sampled
+        """
+        reward = self.get_outputs(observation, sess)[0]
+        return self.action_from_reward(reward, weighted), reward
 
     def weighted_choice(self, observation, sess):
         """
@@ -318,55 +470,106 @@ class A3CNeuralNetwork():
 
     def assign_value_to_theta(self, sess):
         """
-        Assign the value of the NN weights to theta
+        Add the update of the NN weights since the last assign to theta, computed in the graph in a
+        single sess.run. Return the sum of the norms of the update of each tensor
         Parameters: 
             sess: tensorflow session, allow multiprocessing
         """
-        import tensorflow as tf
+        assert self.initialised, "This model must be initialised (self.initialisation())."
 
-        assert(self.initialised, "This model must be initialised (self.initialisation()).")
+        delta, diff = sess.run([self.theta_delta, self.theta_delta_norm])
+        self.push_delta(delta)
+        return diff
 
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
+    def push_delta(self, delta):
+        """
+        Add an update of the weights to theta and publish its new version
+        Parameters: 
+            delta: flat float32 np.array, like theta_delta or train_delta
+        """
+        settings.l_theta.push_all(ParameterBuffer(self.theta_copy.shapes, buffer=delta))
+        settings.l_theta.publish()
 
-        diff = 0
-        for i, key in enumerate(keys):
-            diff_temp = sess.run(self.variables[key]) - self.theta_copy[i]
-            settings.l_theta[i] += diff_temp
-            diff += np.linalg.norm(diff_temp)
-        return diff
-        
-    def assign_value_to_theta_prime(self, theta_prime):
+    def train_and_push(self, sess, feed_dict, step, T=None):
         """
-        Assign the value of theta to theta'
+        Run the train step like train, with the update of the weights computed in the same 
+        sess.run, and add this update to theta (push_update). Return the sum of the norms of the update of each
+        tensor
         Parameters: 
             sess: tensorflow session, allow multiprocessing
+            feed_dict: feed_dict of the train step
+            step: step of the summaries
+            T: global step of the learning rate, see train
         """
-        assert self.initialised, "This model must be initialised (self.initialisation())."
+        return self.push_update(self.train(sess, feed_dict, step, self.update_fetches, T), T)
 
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
+    def push_update(self, values, T=None):
+        """
+        Add to theta the update computed with the train step: the delta of the weights, or with the
+        shared optimiser the gradients, applied at the learning rate of the schedule. Return the sum 
+        of the norms of the update of each tensor
+        Parameters: 
+            values: values of self.update_fetches, run with the train step
+            T: global step of the learning rate of the shared optimiser. If None, the initial 
+               learning rate is used
+        """
+        if self.gradients is None:
+            self.push_delta(values[0])
+            return values[1]
 
-        for i, key in enumerate(keys):
-            theta_prime[i] = settings.l_theta[i]
+        learning_rate = self.schedule.learning_rate if T is None else self.schedule(T)
+        return settings.shared_optimizer.apply_all(ParameterBuffer(self.theta_copy.shapes, 
+                                                                   buffer=values[0]), learning_rate)
+        
+    def assign_value_to_theta_prime(self, theta_prime):
+        """
+        Copy the value of theta into theta', in place
+        Parameters: 
+            theta_prime: sharedparams.ParameterBuffer, local snapshot of the weights. It is not 
+                         copied again while the version of theta is unchanged
+        """
+        assert self.initialised, "This model must be initialised (self.initialisation())."
 
+        theta_prime.pull(settings.l_theta)
         return theta_prime
         
-    def read_value_from_theta(self, sess, theta):
+    def read_value_from_theta(self, sess, theta, version=None):
         """
-        Assign the value of theta to the weights of the NN
+        Assign the value of theta to the weights of the NN, in a single sess.run. Return True if the
+        weights were assigned
         Parameters: 
             sess: tensorflow session, allow multiprocessing
+            theta: sharedparams.ParameterBuffer, or list of arrays in the order of self.keys
+            version: if not None, tag of the version of theta. Nothing is done if the NN already
+                     holds this version, i.e. it was the last one assigned and no train step ran since
         """
-        import tensorflow as tf
+        assert self.initialised, "This model must be initialised (self.initialisation())."
+
+        if (version is not None) and (version == self.loaded_version):
+            return False
 
+        self.theta_copy.copy_from(theta)
+        sess.run(self.variables["theta_assign"], 
+                 feed_dict={self.variables["theta_ph"]: self.theta_copy.flat})
+        self.loaded_version = version
+        return True
+
+    def load_snapshot(self, sess, snapshot, name):
+        """
+        Assign versioned weights to the NN, unless it already holds their current version. Return
+        True if the weights were assigned
+        Parameters: 
+            sess: tensorflow session, allow multiprocessing
+            snapshot: sharedparams.SharedParameters (theta) or sharedparams.SnapshotBuffer (theta minus)
+            name: name of snapshot, which tags its versions
+        """
         assert self.initialised, "This model must be initialised (self.initialisation())."
 
-        self.theta_copy = []
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
+        if self.loaded_version == (name, snapshot.version.value):
+            return False
 
-        for i, key in enumerate(keys):
-            self.theta_copy.append(theta[i])
-            feed_dict = {self.variables[key + "_assign_ph"]: theta[i]}
-            sess.run(self.variables[key + "_assign"], feed_dict=feed_dict)
+        version = snapshot.snapshot(self.theta_copy)
+        sess.run(self.variables["theta_assign"], 
+                 feed_dict={self.variables["theta_ph"]: self.theta_copy.flat})
+        self.loaded_version = (name, version)
+        return True
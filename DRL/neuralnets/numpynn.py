@@ -0,0 +1,171 @@
+# coding: utf-8
+import numpy as np
+
+from .qnn import QNeuralNetwork
+from .a3cnn import A3CNeuralNetwork
+
+
+def relu_layers(weights, observation, n_hidden):
+    """
+    Forward pass through the hidden layers built by build_model (dense + ReLU)
+    Parameters:
+        weights: dictionary key -> np.array, parameters of the network
+        observation: np.array of shape (batch_size, input_size)
+        n_hidden: number of hidden layers
+    """
+    y = np.maximum(observation.dot(weights["W1"]) + weights["b1"], 0.)
+    for i in range(n_hidden-1):
+        y = np.maximum(y.dot(weights["W"+str(i+2)]) + weights["b"+str(i+2)], 0.)
+    return y
+
+def softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+class NumpyQNeuralNetwork():
+    """
+    Evaluate the forward pass of a QNeuralNetwork with NumPy, without any session call. The weights
+    are read from nn.theta_copy, the snapshot loaded in the graph by the last read_value_from_theta,
+    so it always acts like the tensorflow network. It exposes the same acting API, the sess
+    arguments being ignored.
+    """
+
+    def __init__(self, nn):
+        """
+        Parameters:
+            nn: qnn.QNeuralNetwork, initialised
+        """
+        assert nn.initialised, "This model must be initialised (self.initialisation())"
+
+        self.nn = nn
+        self.n_hidden = nn.n_hidden
+        self.initialised = True
+        self.weights = dict(zip(nn.keys, nn.theta_copy))
+
+    def forward(self, observations, sess=None):
+        """
+        Return the estimated rewards of a batch of observations
+        Parameters:
+            observations: np.array of shape (batch_size, input_size)
+        """
+        y = relu_layers(self.weights, observations.astype(np.float32), self.n_hidden)
+        return y.dot(self.weights["Wo"]) + self.weights["bo"]
+
+    def get_reward(self, observation, sess=None):
+        return np.squeeze(self.forward(observation.reshape((1, -1))))
+
+    best_actions = QNeuralNetwork.best_actions
+    best_choice = QNeuralNetwork.best_choice
+    weighted_choice = QNeuralNetwork.weighted_choice
+    best_action = QNeuralNetwork.best_action
+    best_reward = QNeuralNetwork.best_reward
+    action_from_reward = QNeuralNetwork.action_from_reward
+    choose_action = QNeuralNetwork.choose_action
+
+
+class NumpyA3CNeuralNetwork():
+    """
+    Evaluate the forward pass of a A3CNeuralNetwork with NumPy, without any session call. The
+    weights are read from nn.theta_copy, the snapshot loaded in the graph by the last
+    read_value_from_theta. It exposes the same acting API, the sess arguments being ignored.
+    """
+
+    def __init__(self, nn):
+        """
+        Parameters:
+            nn: a3cnn.A3CNeuralNetwork, initialised
+        """
+        assert nn.initialised, "This model must be initialised (self.initialisation())"
+
+        self.nn = nn
+        self.n_hidden = nn.n_hidden
+        self.output_size = nn.output_size
+        self.initialised = True
+        self.weights = dict(zip(nn.keys, nn.theta_copy))
+
+    def forward(self, observations, sess=None):
+        """
+        Return the probabilities of each head of the policy, of shape (batch_size, output_size[i]),
+        and the values of shape (batch_size,) of a batch of observations
+        Parameters:
+            observations: np.array of shape (batch_size, input_size)
+        """
+        y = relu_layers(self.weights, observations.astype(np.float32), self.n_hidden)
+        actions = [softmax(y.dot(self.weights["Wo_policy_%s"%i]) + self.weights["bo_policy_%s"%i])
+                   for i in range(len(self.output_size))]
+        values = (y.dot(self.weights["Wo_vf"]) + self.weights["bo_vf"])[:, 0]
+        return actions, values
+
+    def get_outputs(self, observation, sess=None):
+        actions, values = self.forward(observation.reshape((1, -1)))
+        return [np.squeeze(i) for i in actions], values[0]
+
+    def get_reward(self, observation, sess=None):
+        return self.get_outputs(observation)[0]
+
+    best_actions = A3CNeuralNetwork.best_actions
+    best_choice = A3CNeuralNetwork.best_choice
+    weighted_choice = A3CNeuralNetwork.weighted_choice
+    best_action = A3CNeuralNetwork.best_action
+    best_reward = A3CNeuralNetwork.best_reward
+    action_from_reward = A3CNeuralNetwork.action_from_reward
+    choose_action = A3CNeuralNetwork.choose_action
+
+
+def numpy_network(nn):
+    """
+    Return the NumPy inference engine corresponding to a network
+    Parameters:
+        nn: qnn.QNeuralNetwork or a3cnn.A3CNeuralNetwork, initialised
+    """
+    if isinstance(nn, A3CNeuralNetwork):
+        return NumpyA3CNeuralNetwork(nn)
+    return NumpyQNeuralNetwork(nn)
+
+class NetworkSpec(object):
+    """
+    Picklable description of a network (keys, layers and heads), enough to build its NumPy engine
+    from a list of weights in another process, without tensorflow.
+    """
+
+    def __init__(self, nn):
+        """
+        Parameters:
+            nn: qnn.QNeuralNetwork or a3cnn.A3CNeuralNetwork, initialised
+        """
+        assert nn.initialised, "This model must be initialised (self.initialisation())"
+
+        self.a3c = isinstance(nn, A3CNeuralNetwork)
+        self.keys = list(nn.keys)
+        self.n_hidden = nn.n_hidden
+        self.output_size = nn.output_size
+        self.initialised = True
+        self.theta_copy = None
+
+    def engine(self, theta):
+        """
+        Return the NumPy engine of the network with the weights theta
+        Parameters:
+            theta: list of np.array, in the order of self.keys
+        """
+        self.theta_copy = theta
+        if self.a3c:
+            return NumpyA3CNeuralNetwork(self)
+        return NumpyQNeuralNetwork(self)
+
+def check_equivalence(numpy_nn, nn, sess, observation, atol=1e-4):
+    """
+    Check that the NumPy engine and the tensorflow network give the same outputs for an observation.
+    Raise an AssertionError otherwise.
+    Parameters:
+        numpy_nn: NumpyQNeuralNetwork or NumpyA3CNeuralNetwork built on nn
+        nn: qnn.QNeuralNetwork or a3cnn.A3CNeuralNetwork
+        sess: tensorflow session, with the weights of nn.theta_copy loaded
+        observation: np.array, state of the environnement
+        atol: absolute tolerance
+    """
+    expected = np.concatenate([np.ravel(i) for i in nn.get_reward(observation, sess)])
+    result = np.concatenate([np.ravel(i) for i in numpy_nn.get_reward(observation, sess)])
+    assert np.allclose(expected, result, atol=atol), \
+        "NumPy inference differs from tensorflow: %s != %s"%(result, expected)
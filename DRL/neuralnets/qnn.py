@@ -1,6 +1,9 @@
 # coding: utf-8
 import numpy as np
 from ..utils import settings
+from ..utils.sharedparams import ParameterBuffer
+from ..utils.summaries import SummaryPolicy
+from ..utils.schedule import LearningRateSchedule
 import os
 from os.path import join as pjoin
 
@@ -12,7 +15,7 @@ def critere_keys(key):
         minus: Boolean, If true, critere_keys returns True if the key corresponds 
                to a parameter of theta minus, else, it returns True for a parameter of theta
     """
-    critere = (key not in ["input_observation", "y_true", "y_action", "y"])
+    critere = (key not in ["input_observation", "y_true", "y_action", "y", "sample_weights"])
     critere = critere & (key[-3:] != "_ph") & (key[-7:] != "_assign")
 
     return critere
@@ -47,7 +50,10 @@ class QNeuralNetwork():
 
         self.variables = {}
         self.initialised = False
+        self.loaded_version = None
+        self.gradients = None
         self.learning_rate = learning_rate
+        self.schedule = LearningRateSchedule(learning_rate, "exponential")
         self.alpha_reg = alpha_reg
         self.beta_reg = beta_reg
 
@@ -56,27 +62,32 @@ class QNeuralNetwork():
         Create the neural network, the loss and the train step
         """
         self.create_variables()
+        self.build_assign()
         self.create_placeholders()
         self.build_model()
-        self.reset_lr(None, True)
+        self.create_learning_rate()
         self.build_loss()
+        self.build_delta()
         self.initialised = True
 
-    def create_summary(self, sess, name="0"):
+    def create_summary(self, sess, name="0", scalar_every=10, histogram_every=1000):
+        """
+        Create the summaries and their writer. They are computed by train following a SummaryPolicy
+        Parameters:
+            sess: tensorflow session
+            name: name of the directory of the summaries
+            scalar_every: number of updates between two summaries of the learning rate and the loss
+            histogram_every: number of updates between two histograms of the weights and biases
+        """
         import tensorflow as tf
 
         save_path = './callbacks/summaries/' + name + '/'
 
-        tf.summary.scalar("learning rate", self.decay_learning_rate)
-        tf.summary.scalar("loss", self.loss)
-
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
-
-        for key in keys:
-            tf.summary.histogram(key, self.variables[key])
+        scalars = tf.summary.merge([tf.summary.scalar("learning rate", self.decay_learning_rate),
+                                    tf.summary.scalar("loss", self.loss)])
 
-        self.merged = tf.summary.merge_all()
+        histograms = tf.summary.merge([tf.summary.histogram(key, self.variables[key]) 
+                                       for key in self.keys])
 
         if os.path.exists(save_path):
             for f in os.listdir(save_path):
@@ -86,6 +97,27 @@ class QNeuralNetwork():
 
         self.writer = tf.summary.FileWriter(save_path, sess.graph)
 
+        self.summaries = SummaryPolicy(self.writer, scalars, histograms, scalar_every, histogram_every)
+
+    def train(self, sess, feed_dict, step, fetches=[], T=None):
+        """
+        Run the train step with the summaries due following the summary policy. Return the values of
+        fetches
+        Parameters:
+            sess: tensorflow session, allow multiprocessing
+            feed_dict: feed_dict of the train step
+            step: step of the summaries
+            fetches: list of tensors evaluated with the train step
+            T: global step. If not None, the learning rate of self.schedule at T is fed, else the
+               initial learning rate is used
+        """
+        if T is not None:
+            feed_dict = dict(feed_dict)
+            feed_dict[self.decay_learning_rate] = self.schedule(T)
+
+        self.loaded_version = None
+        return self.summaries.run(sess, [self.train_step] + list(fetches), feed_dict, step)[1:]
+
     def create_weight_variable(self, shape, name="W"):
         """
         Create a matrix of weights as a tf variable. Create also a placeholder and a assign operation
@@ -139,6 +171,68 @@ class QNeuralNetwork():
 
         self.create_bias_variable((1, self.output_size), name="bo")
 
+    def build_assign(self):
+        """
+        Create a single operation loading every weight/biais from a flat float32 buffer, in the 
+        order of the sorted keys. The order is computed once here and stored in self.keys.
+        """
+        import tensorflow as tf
+
+        self.keys = sorted(self.variables.keys())
+        self.keys = [key for key in self.keys if critere_keys(key)]
+
+        shapes = [self.variables[key].get_shape().as_list() for key in self.keys]
+        self.theta_copy = ParameterBuffer(shapes)
+
+        self.variables["theta_ph"] = tf.placeholder(tf.float32, shape=[self.theta_copy.size], 
+            name="theta_ph")
+        splits = tf.split(self.variables["theta_ph"], self.theta_copy.sizes)
+        self.theta_base = tf.Variable(tf.zeros([self.theta_copy.size]), trainable=False, 
+            name="theta_base")
+        self.variables["theta_assign"] = tf.group(*[tf.assign(self.variables[key], 
+            tf.reshape(split, shape)) for key, split, shape in zip(self.keys, splits, shapes)] + 
+            [tf.assign(self.theta_base, self.variables["theta_ph"])])
+
+    def build_gradients(self, loss):
+        """
+        Create the train step used with the shared optimiser (settings.shared_optimizer): it only
+        computes the gradients of loss, as a flat float32 buffer in the order of self.keys, which
+        push_update applies to theta
+        """
+        import tensorflow as tf
+
+        variables = [self.variables[key] for key in self.keys]
+        gradients = [tf.zeros_like(variable) if gradient is None else gradient
+                     for gradient, variable in zip(tf.gradients(loss, variables), variables)]
+        self.gradients = tf.concat([tf.reshape(gradient, [-1]) for gradient in gradients], 0)
+        self.train_step = tf.no_op()
+
+    def build_delta(self):
+        """
+        Create the operations computing, as a flat float32 buffer in the order of self.keys, the
+        update of the weights since the last assign and the sum of the norms of its tensors. 
+        theta_delta reads the current weights; train_delta reads them after the train step, so that
+        an update and its delta take a single sess.run.
+        """
+        import tensorflow as tf
+
+        def delta():
+            flat = tf.concat([tf.reshape(tf.identity(self.variables[key]), [-1]) 
+                              for key in self.keys], 0)
+            delta = flat - self.theta_base
+            norm = tf.add_n([tf.norm(split) for split in tf.split(delta, self.theta_copy.sizes)])
+            return delta, norm
+
+        self.theta_delta, self.theta_delta_norm = delta()
+        with tf.control_dependencies([self.train_step]):
+            self.train_delta, self.train_delta_norm = delta()
+
+        # Values fetched with the train step and given to push_update
+        if self.gradients is None:
+            self.update_fetches = [self.train_delta, self.train_delta_norm]
+        else:
+            self.update_fetches = [self.gradients]
+
     def create_placeholders(self):
         """
         Create placeholders for the observations, the results and the actions took
@@ -153,6 +247,10 @@ class QNeuralNetwork():
         self.variables["y_action"] = tf.placeholder(tf.float32, shape=[None, self.output_size], 
             name="action")
 
+        # Importance sampling weights of the transitions of a prioritized replay, 1 by default
+        self.variables["sample_weights"] = tf.placeholder_with_default(
+            tf.ones_like(self.variables["y_true"]), shape=[None], name="sample_weights")
+
     def build_model(self):
         """
         Create the forward pass
@@ -177,7 +275,8 @@ class QNeuralNetwork():
         import tensorflow as tf
 
         y_1d = tf.reduce_sum(tf.multiply(self.variables["y"], self.variables["y_action"]), axis=1)
-        loss = tf.nn.l2_loss(y_1d - self.variables["y_true"])
+        self.td_errors = y_1d - self.variables["y_true"]
+        loss = tf.reduce_sum(self.variables["sample_weights"] * tf.square(self.td_errors)) / 2
 
         l1_reg = 0
         l2_reg = 0
@@ -190,33 +289,47 @@ class QNeuralNetwork():
 
         self.loss = loss + self.alpha_reg * l1_reg + self.beta_reg * l2_reg
 
-        self.train_step = tf.train.RMSPropOptimizer(self.decay_learning_rate,
-            decay=0.99, momentum=0., centered=True).minimize(self.loss, global_step=self.global_step)
+        if settings.shared_optimizer is None:
+            self.train_step = tf.train.RMSPropOptimizer(self.decay_learning_rate,
+                decay=0.99, momentum=0., centered=True).minimize(self.loss)
+        else:
+            self.build_gradients(self.loss)
 
-    def reset_lr(self, sess, init=False):
+    def create_learning_rate(self):
+        """
+        Create the placeholder of the learning rate, fed by train from self.schedule
+        """
         import tensorflow as tf
-        
-        if init:
-            self.global_step = tf.Variable(0, trainable=False)
-            self.global_step_pl = tf.placeholder(tf.int32)
-            self.global_step_assign = tf.assign(self.global_step, self.global_step_pl)
-
-            self.decay_steps = tf.Variable(1, trainable=False)
-            self.decay_steps_pl = tf.placeholder(tf.int32)
-            self.decay_steps_assign = tf.assign(self.decay_steps, self.decay_steps_pl)
-        else:
-            print("Reset")
-            temp = sess.run(self.decay_steps) * 2
-            sess.run(self.decay_steps_assign, feed_dict={self.decay_steps_pl: temp})
-        
-        self.decay_learning_rate = tf.train.exponential_decay(self.learning_rate,
-            global_step=self.global_step, decay_steps=self.decay_steps, decay_rate=0.999)
+
+        self.variables["learning_rate_ph"] = tf.placeholder_with_default(np.float32(self.learning_rate),
+                                                                         shape=[], name="learning_rate_ph")
+        self.decay_learning_rate = self.variables["learning_rate_ph"]
 
     def get_reward(self, observation, sess):
         feed_dic = {self.variables["input_observation"]: observation.reshape((1, -1))}
         reward = np.squeeze(sess.run(self.variables["y"], feed_dict=feed_dic))
         return reward
 
+    def forward(self, observations, sess):
+        """
+        Return the estimated rewards of a batch of observations, of shape (batch_size, output_size),
+        in one sess.run
+        Parameters:
+            observations: np.array of shape (batch_size, input_size)
+            sess: tensorflow session, allow multiprocessing
+        """
+        feed_dic = {self.variables["input_observation"]: observations.reshape((len(observations), -1))}
+        return sess.run(self.variables["y"], feed_dict=feed_dic)
+
+    def best_actions(self, observations, sess):
+        """
+        Return the best action of each observation of a batch, as an array of shape (batch_size, 1)
+        Parameters:
+            observations: np.array of shape (batch_size, input_size)
+            sess: tensorflow session, allow multiprocessing
+        """
+        return np.argmax(self.forward(observations, sess), axis=1)[:, None]
+
     def best_choice(self, observation, sess):
         """
         Return the best action and the estimated reward for a given state
@@ -239,6 +352,21 @@ class QNeuralNetwork():
         assert self.initialised, "This model must be initialised (self.initialisation())"
         reward = self.get_reward(observation, sess)
 
+        i = self.action_from_reward(reward, weighted=True)
+      
+        return i, reward[i]
+
+    def action_from_reward(self, reward, weighted=False):
+        """
+        Return the action chosen from the estimated rewards of a state
+        Parameters:
+            reward: np.array, output of get_reward
+            weighted: If True, return a random aciton weighted with estimated reward. 
+                      Else, the best one.
+        """
+        if not weighted:
+            return np.argmax(reward)
+
         reward_cumsum = np.cumsum(reward) / np.sum(reward)
 
         temp = np.random.rand()
@@ -246,8 +374,21 @@ class QNeuralNetwork():
         for i, value in enumerate(reward_cumsum):
             if value > temp:
                 break
-      
-        return i, reward[i]
+
+        return i
+
+    def choose_action(self, observation, sess, weighted=False):
+        """
+        Return the action for a given state, as best_action, and the estimated rewards (output of
+        get_reward) from which it was chosen, with a single forward pass
+        Parameters:
+            observation: np.array, state of the environnement
+            sess: tensorflow session, allow multiprocessing
+            weighted: If True, return a random aciton weighted with estimated reward. 
+                      Else, the best one.
+        """
+        reward = self.get_reward(observation, sess)
+        return self.action_from_reward(reward, weighted), reward
 
     def best_action(self, observation, sess, weighted=False):
         """
@@ -279,55 +420,106 @@ class QNeuralNetwork():
 
     def assign_value_to_theta(self, sess):
         """
-        Assign the value of the NN weights to theta
+        Add the update of the NN weights since the last assign to theta, computed in the graph in a
+        single sess.run. Return the sum of the norms of the update of each tensor
         Parameters: 
             sess: tensorflow session, allow multiprocessing
         """
-        import tensorflow as tf
-
         assert self.initialised, "This model must be initialised (self.initialisation())."
 
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
-
-        diff = 0
-        for i, key in enumerate(keys):
-            diff_temp = sess.run(self.variables[key]) - self.theta_copy[i]
-            settings.l_theta[i] += diff_temp
-            diff += np.linalg.norm(diff_temp)
+        delta, diff = sess.run([self.theta_delta, self.theta_delta_norm])
+        self.push_delta(delta)
         return diff
-        
-    def assign_value_to_theta_prime(self, theta_prime):
+
+    def push_delta(self, delta):
         """
-        Assign the value of theta to theta'
+        Add an update of the weights to theta and publish its new version
+        Parameters: 
+            delta: flat float32 np.array, like theta_delta or train_delta
+        """
+        settings.l_theta.push_all(ParameterBuffer(self.theta_copy.shapes, buffer=delta))
+        settings.l_theta.publish()
+
+    def train_and_push(self, sess, feed_dict, step, T=None):
+        """
+        Run the train step like train, with the update of the weights computed in the same 
+        sess.run, and add this update to theta (push_update). Return the sum of the norms of the update of each
+        tensor
         Parameters: 
             sess: tensorflow session, allow multiprocessing
+            feed_dict: feed_dict of the train step
+            step: step of the summaries
+            T: global step of the learning rate, see train
         """
-        assert self.initialised, "This model must be initialised (self.initialisation())."
+        return self.push_update(self.train(sess, feed_dict, step, self.update_fetches, T), T)
 
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
+    def push_update(self, values, T=None):
+        """
+        Add to theta the update computed with the train step: the delta of the weights, or with the
+        shared optimiser the gradients, applied at the learning rate of the schedule. Return the sum 
+        of the norms of the update of each tensor
+        Parameters: 
+            values: values of self.update_fetches, run with the train step
+            T: global step of the learning rate of the shared optimiser. If None, the initial 
+               learning rate is used
+        """
+        if self.gradients is None:
+            self.push_delta(values[0])
+            return values[1]
 
-        for i, key in enumerate(keys):
-            theta_prime[i] = settings.l_theta[i]
+        learning_rate = self.schedule.learning_rate if T is None else self.schedule(T)
+        return settings.shared_optimizer.apply_all(ParameterBuffer(self.theta_copy.shapes, 
+                                                                   buffer=values[0]), learning_rate)
+        
+    def assign_value_to_theta_prime(self, theta_prime):
+        """
+        Copy the value of theta into theta', in place
+        Parameters: 
+            theta_prime: sharedparams.ParameterBuffer, local snapshot of the weights. It is not 
+                         copied again while the version of theta is unchanged
+        """
+        assert self.initialised, "This model must be initialised (self.initialisation())."
 
+        theta_prime.pull(settings.l_theta)
         return theta_prime
         
-    def read_value_from_theta(self, sess, theta):
+    def read_value_from_theta(self, sess, theta, version=None):
         """
-        Assign the value of theta to the weights of the NN
+        Assign the value of theta to the weights of the NN, in a single sess.run. Return True if the
+        weights were assigned
         Parameters: 
             sess: tensorflow session, allow multiprocessing
+            theta: sharedparams.ParameterBuffer, or list of arrays in the order of self.keys
+            version: if not None, tag of the version of theta. Nothing is done if the NN already
+                     holds this version, i.e. it was the last one assigned and no train step ran since
         """
-        import tensorflow as tf
+        assert self.initialised, "This model must be initialised (self.initialisation())."
+
+        if (version is not None) and (version == self.loaded_version):
+            return False
 
+        self.theta_copy.copy_from(theta)
+        sess.run(self.variables["theta_assign"], 
+                 feed_dict={self.variables["theta_ph"]: self.theta_copy.flat})
+        self.loaded_version = version
+        return True
+
+    def load_snapshot(self, sess, snapshot, name):
+        """
+        Assign versioned weights to the NN, unless it already holds their current version. Return
+        True if the weights were assigned
+        Parameters: 
+            sess: tensorflow session, allow multiprocessing
+            snapshot: sharedparams.SharedParameters (theta) or sharedparams.SnapshotBuffer (theta minus)
+            name: name of snapshot, which tags its versions
+        """
         assert self.initialised, "This model must be initialised (self.initialisation())."
 
-        self.theta_copy = []
-        keys = sorted(self.variables.keys())
-        keys = [ key for key in keys if critere_keys(key)]
+        if self.loaded_version == (name, snapshot.version.value):
+            return False
 
-        for i, key in enumerate(keys):
-            self.theta_copy.append(theta[i])
-            feed_dict = {self.variables[key + "_ph"]: theta[i]}
-            sess.run(self.variables[key + "_assign"], feed_dict=feed_dict)
+        version = snapshot.snapshot(self.theta_copy)
+        sess.run(self.variables["theta_assign"], 
+                 feed_dict={self.variables["theta_ph"]: self.theta_copy.flat})
+        self.loaded_version = (name, version)
+        return True
@@ -3,3 +3,7 @@ from . import asynchrone1stepsarsaslave
 from . import asynchrone1stepslave
 from . import asynchronea3cslave
 from . import asynchronenstepslave
+from . import evaluator
+from . import multienvslave
+from . import predictor
+from . import trainer
@@ -3,9 +3,14 @@
 import gym
 import multiprocessing as mp
 import numpy as np
+import sys
 
-from ..utils.utils import epsilon_greedy_policy
+from ..utils.utils import epsilon_greedy_policy, get_shapes
+from ..utils.sharedparams import ParameterBuffer
 from ..utils import settings
+from ..utils.paramserver import ServerLost
+from ..utils.stepcounter import StepCounter
+from ..utils.rollout import RolloutBuffer
 from ..utils import callback as cb
 
 from ..neuralnets import qnn
@@ -19,7 +24,8 @@ class slave_worker_1_step_sarsa(mp.Process):
 	def __init__(self, T_max=100000, t_max=5, gamma=0.9, learning_rate=0.001, Iasyncupdate=10,
 				 env_name="CartPole-v0", model_option={"n_hidden":1, "hidden_size":[10]}, 
 				 verbose=False, policy=None, epsilon_ini=0.9, alpha_reg=0., beta_reg=0.001, 
-				 weighted=False, eps_fall=50000, **kwargs):
+				 weighted=False, eps_fall=50000, callback=None, callback_name="callbacks/actor0", 
+				 callback_batch_size=100, callback_backend="csv", T_chunk=100, **kwargs):
 		"""
 		Parameters:
 			T_max: maximum number of iterations
@@ -35,9 +41,15 @@ class slave_worker_1_step_sarsa(mp.Process):
 			epsilon_ini: Value of epsilon at the beginning
 			alpha_reg: coefficient of l1 regularisation
 			beta_reg: coefficient of l2 regularisation
+			callback: if True, the rewards, actions and updates of this slave are stored in callbacks
+			callback_name: directory of the callbacks
+			callback_batch_size: number of steps stored before being written
+			callback_backend: "csv" or "binary", backend of the callback (see callback.callback)
+			T_chunk: number of steps counted locally before being added to the global counter T
 			kwargs: args of multiprocessing.Process
 		"""
 		super(slave_worker_1_step_sarsa, self).__init__(**kwargs)
+		self.T_chunk = T_chunk
 		self.T_max = T_max
 		self.gamma = gamma
 		self.env = gym.make(env_name)
@@ -49,6 +61,12 @@ class slave_worker_1_step_sarsa(mp.Process):
 		self.Iasyncupdate=Iasyncupdate
 		self.eps_fall=eps_fall
 
+		if callback:
+			self.callback = cb.callback(batch_size=callback_batch_size, saving_directory=callback_name, 
+									observation_size=self.input_size, backend=callback_backend)
+		else:
+			self.callback = None
+
 		if policy is None:
 			self.policy = self.env.action_space.sample
 		else:
@@ -57,71 +75,97 @@ class slave_worker_1_step_sarsa(mp.Process):
 		self.qnn = qnn.QNeuralNetwork(input_size=self.input_size, output_size=self.output_size, 
 				n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"], 
 				learning_rate=learning_rate, alpha_reg=alpha_reg, beta_reg=beta_reg)
+
+		self.theta_prime = ParameterBuffer(get_shapes(n_hidden=model_option["n_hidden"],
+													  hidden_size=model_option["hidden_size"],
+													  input_size=self.input_size,
+													  output_size=self.output_size))
+
+		self.rollout = RolloutBuffer(self.Iasyncupdate, [self.input_size], [self.output_size])
 			
 		
 	def run(self):
+		"""
+		Run work, then close the callback even if it raised, so that its queued steps are written.
+		A slave which lost its parameter server stops with the exit code 1
+		"""
+		try:
+			self.work()
+		except ServerLost as e:
+			print("Slave %s stopping: %s"%(self.name, e))
+			sys.exit(1)
+		finally:
+			if self.callback:
+				self.callback.close()
+
+	def work(self):
 		"""
 		Run the worker and launch the n step algorithm
 		"""
 		import tensorflow as tf
 
+		self.T = StepCounter(settings.T, self.T_chunk)
+
 		self.qnn.initialisation()
 
 		self.sess = tf.Session()
 		self.sess.run(tf.global_variables_initializer())
+		self.sess.graph.finalize()
 
-		self.qnn.read_value_from_theta(self.sess)
-		self.qnn.read_value_from_theta_minus(self.sess)
+		self.theta_prime = self.qnn.assign_value_to_theta_prime(self.theta_prime)
+		self.qnn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
 
 		epsilon = self.epsilon_ini
 		t = 0
-		y_batch = []
 		nb_env = 0
-		firstiter=True
+		rpe = 0
 
 		observation = self.env.reset()
+		self.rollout.reset(observation)
 
-		while settings.T.value<self.T_max:
+		while self.T.value<self.T_max:
 
 			t_init = t
 			
 
 			if self.verbose:
 				self.env.render()
-				if settings.T.value%5000 == 0:
-					print("T = %s"%settings.T.value)
+				if self.T.value%5000 == 0:
+					print("T = %s"%self.T.value)
 
-			self.qnn.read_value_from_theta(self.sess)
+			self.theta_prime = self.qnn.assign_value_to_theta_prime(self.theta_prime)
+			self.qnn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
 
-			action = epsilon_greedy_policy(self.qnn, observation, epsilon, self.env, 
+			random, action = epsilon_greedy_policy(self.qnn, observation, epsilon, self.env, 
 											self.sess, self.policy, self.weighted)
 
 			observationprime, reward, done, info = self.env.step(action) 
 
+			rpe += reward
+
+			if self.callback:
+				self.callback.store(reward, random, action, observation, 0)
+
 			if done:
 				y = reward
 				observationprime = self.env.reset()
 				t_init = t + 1
 				nb_env += 1
+				if self.callback:
+					self.callback.store_rpe(rpe)
+				rpe = 0
 			else:
 				feed_dic = {self.qnn.variables["input_observation"]: observationprime.reshape((1, -1))}
 				values = np.squeeze(self.sess.run(self.qnn.variables["y"], feed_dict=feed_dic))
-				actionprime = epsilon_greedy_policy(self.qnn, observationprime, epsilon, self.env, 
+				_, actionprime = epsilon_greedy_policy(self.qnn, observationprime, epsilon, self.env, 
 											self.sess, self.policy, self.weighted)
 				y = reward + self.gamma * values[actionprime]
 			
-			if firstiter:
-				firstiter=False
-				observation_batch = observation.reshape((1, -1))
-				action_batch = [action]
-			else:
-				observation_batch = np.vstack((observation_batch, observation.reshape((1, -1))))
-				action_batch.append(action)
-			
-			y_batch.append(y)
+			self.rollout.store(action, reward, done, observationprime)
+			self.rollout.targets[-1] = y
+
 			observation = observationprime
-			with settings.T.get_lock():
-				settings.T.value += 1
+			self.T.increment()
 			
 			t += 1
 
@@ -130,23 +174,23 @@ class slave_worker_1_step_sarsa(mp.Process):
 
 			if t %self.Iasyncupdate == 0:
 			   
-				action_batch_multiplier = np.eye(self.output_size)[action_batch].T
-				
-				y_batch_arr = np.array(y_batch).reshape((-1, 1))
+				self.qnn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
 
-				shuffle = range(len(y_batch_arr))
-				np.random.shuffle(shuffle)
+				feed_dict = {self.qnn.variables["input_observation"]: self.rollout.observations,
+							 self.qnn.variables["y_true"]: self.rollout.targets, 
+							 self.qnn.variables["y_action"]: self.rollout.actions_one_hot[0],
+							 self.qnn.decay_learning_rate: self.qnn.schedule(self.T.value)}
+				values = self.sess.run(self.qnn.update_fetches, feed_dict=feed_dict)
+				# The train step changed the weights of the NN, theta must be assigned again
+				self.qnn.loaded_version = None
 
-				self.qnn.read_value_from_theta(self.sess)
+				diff = self.qnn.push_update(values, self.T.value)
 
-				feed_dict = {self.qnn.variables["input_observation"]: observation_batch[shuffle, :],
-							 self.qnn.variables["y_true"]: y_batch_arr[shuffle, :], 
-							 self.qnn.variables["y_action"]: action_batch_multiplier[:, shuffle]}
-				self.sess.run(self.qnn.train_step, feed_dict=feed_dict)
+				if self.callback:
+					self.callback.store_diff(diff)
 
-				self.qnn.assign_value_to_theta(self.sess)
+				self.rollout.reset(observation)
 
-				firstiter = True
-				y_batch = []
+		self.T.flush()
 
 		return
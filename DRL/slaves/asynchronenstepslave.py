@@ -3,12 +3,21 @@
 import gym
 import multiprocessing as mp
 import numpy as np
+import sys
 
-from ..utils.utils import epsilon_greedy_policy, initialise
+from ..utils.utils import epsilon_greedy_policy, get_shapes
+from ..utils.sharedparams import ParameterBuffer
 from ..utils import settings
+from ..utils.paramserver import ServerLost
+from ..utils.stepcounter import StepCounter
+from ..utils.rollout import RolloutBuffer
+from ..utils.returns import discounted_returns
+from ..utils.replay import nstep_transitions, train_on_replay
 from ..utils import callback as cb
+from ..utils.checkpoint import state_writer
+from ..utils.graphguard import GraphGuard
 
-from ..neuralnets import qnn
+from ..neuralnets import qnn, numpynn
 
 class slave_worker_n_step(mp.Process):
     """
@@ -20,7 +29,11 @@ class slave_worker_n_step(mp.Process):
                  env_name="CartPole-v0", model_option={"n_hidden":1, "hidden_size":[10]}, 
                  verbose=False, policy=None, epsilon_ini=0.9, alpha_reg=0., beta_reg=0.01, 
                  weighted=False, eps_fall=50000, callback=None, callback_name="callbacks/actor0", 
-                 callback_batch_size=100, name="", seed=42, action_replay=1,  reset=False, **kwargs):
+                 callback_batch_size=100, name="", seed=42, action_replay=1,  reset=False, 
+                 T_chunk=100, inference="tf", predictor=None, trainer=None,
+                 replay=None, replay_batch_size=32, replay_ratio=1, scalar_every=10,
+                 histogram_every=1000, callback_backend="csv", checkpoints_path=None, resume=False,
+                 guard_every=0, **kwargs):
         """
         Parameters:
             T_max: maximum number of iterations
@@ -36,9 +49,37 @@ class slave_worker_n_step(mp.Process):
             epsilon_ini: Value of epsilon at the beginning
             alpha_reg: coefficient of l1 regularisation
             beta_reg: coefficient of l2 regularisation
+            T_chunk: number of steps counted locally before being added to the global counter T
+            inference: "tf" to choose actions with the tensorflow session, "numpy" to evaluate the
+                       network with NumPy from the loaded weights (numpynn)
+            predictor: if not None, client of the predictor processes (predictor.PredictorChannels)
+                       used to choose the actions instead of the network of the slave
+            trainer: if not None, multiprocessing.Queue of the trainer processes (trainer.trainer_worker).
+                     The rollouts are sent to it instead of being trained by the slave
+            replay: if not None, replay.PrioritizedReplay shared by the slaves. The n step transitions of 
+                    the rollouts are stored in it, and replay_ratio updates on prioritized batches of 
+                    replay_batch_size transitions follow each update on a rollout
+            scalar_every: number of updates between two summaries of the learning rate and the loss
+            histogram_every: number of updates between two histograms of the weights and biases
+            callback_backend: "csv" or "binary", backend of the callback (see callback.callback)
+            checkpoints_path: if not None, run directory of the tester. The training state of the slave
+                              is saved in it with each checkpoint (checkpoint.state_writer)
+            resume: If True, the training state of the slave is restored from checkpoints_path
+            guard_every: if more than 0, number of seconds between two reports of the size of the graph
+                         and of the memory of the process (graphguard.GraphGuard)
             kwargs: args of multiprocessing.Process
         """
         super(slave_worker_n_step, self).__init__(**kwargs)
+        self.guard_every = guard_every
+        self.T_chunk = T_chunk
+        self.inference = inference
+        self.predictor = predictor
+        self.trainer = trainer
+        self.scalar_every = scalar_every
+        self.histogram_every = histogram_every
+        self.replay = replay
+        self.replay_batch_size = replay_batch_size
+        self.replay_ratio = replay_ratio
         self.T_max = T_max
         self.t_max = t_max * action_replay
         self.gamma = gamma
@@ -53,12 +94,17 @@ class slave_worker_n_step(mp.Process):
         self.seed = seed
         self.action_replay = action_replay
         self.reset = reset
-        self.count_T_reset = 0
+        self.resume = resume
+        if checkpoints_path is not None:
+            self.state_writer = state_writer(checkpoints_path, name)
+        else:
+            self.state_writer = None
         self.lr_ini = learning_rate
 
         if callback:
             self.callback = cb.callback(batch_size=callback_batch_size, saving_directory=callback_name, 
-                                    observation_size=self.input_size, action_size=self.output_size)
+                                    observation_size=self.input_size, action_size=self.output_size,
+                                    backend=callback_backend)
         else:
             self.callback = None
 
@@ -71,27 +117,56 @@ class slave_worker_n_step(mp.Process):
                 n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"], 
                 learning_rate=learning_rate, alpha_reg=alpha_reg, beta_reg=beta_reg)
 
-        self.theta_prime = initialise(n_hidden=model_option["n_hidden"],
-                                      hidden_size=model_option["hidden_size"],
-                                      input_size=self.input_size,
-                                      output_size=self.output_size)
+        self.theta_prime = ParameterBuffer(get_shapes(n_hidden=model_option["n_hidden"],
+                                                      hidden_size=model_option["hidden_size"],
+                                                      input_size=self.input_size,
+                                                      output_size=self.output_size))
+
+        self.rollout = RolloutBuffer(self.t_max + 1, [self.input_size], [self.output_size])
             
     def run(self):
+        """
+        Run work, then close the callback even if it raised, so that its queued steps are written.
+        A slave which lost its parameter server stops with the exit code 1
+        """
+        try:
+            self.work()
+        except ServerLost as e:
+            print("Slave %s stopping: %s"%(self.name, e))
+            sys.exit(1)
+        finally:
+            if self.callback:
+                self.callback.close()
+
+    def work(self):
         """
         Run the worker and launch the n step algorithm
         """
         import tensorflow as tf
 
+        self.T = StepCounter(settings.T, self.T_chunk)
+
         np.random.seed(self.seed)
 
         self.qnn.initialisation()
 
         self.sess = tf.Session()
 
-        self.qnn.create_summary(self.sess, self.name)
+        self.qnn.create_summary(self.sess, self.name, self.scalar_every, self.histogram_every)
 
         self.sess.run(tf.global_variables_initializer())
 
+        self.sess.graph.finalize()
+        if self.guard_every > 0:
+            self.guard = GraphGuard(self.name, self.sess.graph, self.guard_every)
+        else:
+            self.guard = None
+
+        if self.inference == "numpy":
+            self.actor = numpynn.numpy_network(self.qnn)
+        else:
+            self.actor = self.qnn
+
         epsilon = 1
         nb_env = 0
         rpe = 0
@@ -100,38 +175,64 @@ class slave_worker_n_step(mp.Process):
 
         observation = self.env.reset()
 
+        if self.inference == "numpy":
+            self.theta_prime = self.qnn.assign_value_to_theta_prime(self.theta_prime)
+            self.qnn.read_value_from_theta(self.sess, self.theta_prime)
+            numpynn.check_equivalence(self.actor, self.qnn, self.sess, observation)
+
+        if self.predictor is None:
+            self.acting = self.actor
+        else:
+            self.acting = self.predictor
+
         rewards_env = []
         estimated_rewards_env = []
         rewards = []
 
         minlr = self.lr_ini / 10
 
-        while settings.T.value<self.T_max:
+        if self.resume and (self.state_writer is not None):
+            values = self.state_writer.restore(self.sess)
+            if values is not None:
+                epsilon = float(values["epsilon"])
+                minlr = float(values["minlr"])
+                t_env = int(values["t_env"])
+                nb_env = int(values["nb_env"])
+                self.qnn.schedule.T_reset = int(values["T_reset"])
+                self.qnn.schedule.decay_steps = int(values["decay_steps"])
+
+        while self.T.value<self.T_max:
+
+            if self.guard is not None:
+                self.guard.check()
 
             t = 0
             done = False
 
-            observation_batch = observation.reshape((1, -1))
+            if (self.state_writer is not None) and self.state_writer.due():
+                self.state_writer.save(self.sess, self.T.value, T_reset=self.qnn.schedule.T_reset, 
+                                       decay_steps=self.qnn.schedule.decay_steps, epsilon=epsilon, 
+                                       minlr=minlr, t_env=t_env, nb_env=nb_env)
 
-            reward_batch = []
-            action_batch = []
+            self.rollout.reset(observation)
 
             self.theta_prime = self.qnn.assign_value_to_theta_prime(self.theta_prime)
+            self.qnn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
 
             while (not done) & (t<=self.t_max):
                 if self.verbose:
                     self.env.render()
-                    if settings.T.value%5000 == 0:
-                        print("T = %s"%settings.T.value)
-
-                self.sess.run(self.qnn.global_step_assign, 
-                    feed_dict={self.qnn.global_step_pl: settings.T.value - self.count_T_reset})
-
-                self.qnn.read_value_from_theta(self.sess, self.theta_prime)
+                    if self.T.value%5000 == 0:
+                        print("T = %s"%self.T.value)
 
                 if action_replay == 1:
-                    random, action = epsilon_greedy_policy(self.qnn, observation, epsilon, self.env, 
-                                                    self.sess, self.policy, self.weighted)
+                    if self.callback:
+                        random, action, outputs = epsilon_greedy_policy(self.acting, observation, epsilon, 
+                                                    self.env, self.sess, self.policy, self.weighted, 
+                                                    return_outputs=True)
+                    else:
+                        random, action = epsilon_greedy_policy(self.acting, observation, epsilon, self.env, 
+                                                        self.sess, self.policy, self.weighted)
                     action_replay = self.action_replay
                 else:
                     action_replay -= 1
@@ -142,56 +243,49 @@ class slave_worker_n_step(mp.Process):
                 
                 if self.callback:
                     rewards_env.append(reward)
-                    rewards.append(self.qnn.get_reward(observation, self.sess))
+                    rewards.append(outputs)
                     rpe += reward
+                    self.callback.store(reward, random, action, self.rollout.observation, rewards)
 
-                reward_batch.append(reward)
-                action_batch.append(action)
-
-                if self.callback:
-                    self.callback.store(reward, random, action, observation_batch[0], rewards)
-
-                observation_batch = np.vstack((observation.reshape((1, -1)), observation_batch))
-                #print("reward_batch", reward_batch)
-                #print("action_batch", action_batch)
-                #print("observation_batch", observation_batch)
-              
+                self.rollout.store(action, reward, done, observation)
 
                 if done:
                     nb_env += 1
                     observation = self.env.reset()
                     if self.callback:
                         self.callback.store_rpe(rpe)
-                        self.callback.store_hp(epsilon, self.sess.run(self.qnn.decay_learning_rate))
+                        self.callback.store_hp(epsilon, self.qnn.schedule(self.T.value))
                     rpe = 0
                 
-                with settings.T.get_lock():
-                    settings.T.value += 1
+                self.T.increment()
                 
                 t += 1
 
                 if epsilon > self.epsilon_ini:
                     epsilon -= (1 - self.epsilon_ini)/self.eps_fall
 
-                if self.reset & (self.sess.run(self.qnn.decay_learning_rate) < minlr) :
+                if self.reset & (self.qnn.schedule(self.T.value) < minlr) :
                     minlr /= 10
                     epsilon = 1
-                    self.count_T_reset = settings.T.value
-                    self.qnn.reset_lr(self.sess)
+                    self.qnn.schedule.reset(self.T.value)
             
-            self.qnn.read_value_from_theta(self.sess, settings.l_theta_minus)
+            self.qnn.load_snapshot(self.sess, settings.l_theta_minus, "theta_minus")
             if done:
                 R = 0
             else:
-                R = self.qnn.best_reward(observation, self.sess, self.weighted)
+                R = self.actor.best_reward(observation, self.sess, self.weighted)
 
-            true_reward = []
-            for i in range(t - 1, -1, -1):
-                R = reward_batch[i] + self.gamma * R
-                true_reward.append(R)
+            true_reward = self.rollout.targets
+            true_reward[:] = discounted_returns(self.rollout.rewards, self.rollout.dones, R, self.gamma)
+
+            if self.replay is not None:
+                replay_rewards, discounts = nstep_transitions(self.rollout.rewards, self.rollout.dones, 
+                                                              self.gamma)
+                self.replay.add(self.rollout.observations, self.rollout.actions[:, 0], replay_rewards, 
+                                np.broadcast_to(observation, self.rollout.observations.shape), discounts)
 
             if self.callback:
-                estimated_rewards_env += true_reward[::-1]
+                estimated_rewards_env += list(true_reward)
                 if done:
                     history = np.zeros((len(estimated_rewards_env), 4 + self.output_size))
                     history[:, 0] = np.arange(len(estimated_rewards_env))
@@ -205,26 +299,31 @@ class slave_worker_n_step(mp.Process):
                     rewards = []
 
 
-            action_batch.reverse()
-            action_batch_multiplier = np.eye(self.output_size)[action_batch]
-            y_batch_arr = np.array(true_reward)
+            if self.trainer is not None:
+                self.trainer.put((self.rollout.observations.copy(),
+                                  [one_hot.copy() for one_hot in self.rollout.actions_one_hot],
+                                  self.rollout.targets.copy()))
+                continue
 
-            shuffle = np.arange(len(y_batch_arr))
-            np.random.shuffle(shuffle)
-            
-            feed_dict = {self.qnn.variables["input_observation"]: observation_batch[1:, :][shuffle, :],
-                         self.qnn.variables["y_true"]: y_batch_arr[shuffle], 
-                         self.qnn.variables["y_action"]: action_batch_multiplier[shuffle, :]}
+            feed_dict = {self.qnn.variables["input_observation"]: self.rollout.observations,
+                         self.qnn.variables["y_true"]: self.rollout.targets, 
+                         self.qnn.variables["y_action"]: self.rollout.actions_one_hot[0]}
 
-            self.qnn.read_value_from_theta(self.sess, self.theta_prime)
+            self.qnn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
             
-            summary, _ = self.sess.run([self.qnn.merged, self.qnn.train_step], feed_dict=feed_dict)
-
-            self.qnn.writer.add_summary(summary, t_env)
-
-            diff = self.qnn.assign_value_to_theta(self.sess)
+            diff = self.qnn.train_and_push(self.sess, feed_dict, t_env, T=self.T.value)
 
             if self.callback:
                 self.callback.store_diff(diff)
 
+            if (self.replay is not None) and (len(self.replay) >= self.replay_batch_size):
+                for i in range(self.replay_ratio):
+                    train_on_replay(self.qnn, self.actor, self.sess, self.replay, self.theta_prime, 
+                                    self.replay_batch_size, self.T.value)
+
+        self.T.flush()
+
+        if self.state_writer is not None:
+            self.state_writer.close()
+
         return
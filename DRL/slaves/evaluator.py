@@ -0,0 +1,167 @@
+# coding: utf-8
+import gym
+import multiprocessing as mp
+import numpy as np
+import os
+
+from ..utils.envs import MultiEnv
+from ..neuralnets.numpynn import NetworkSpec
+
+# Environments of the process, created once by get_envs
+_envs = {}
+
+
+def get_envs(env_name, n_envs):
+    """
+    Return the MultiEnv of n_envs environments env_name of this process, created on the first call
+    """
+    key = (env_name, n_envs)
+    if key not in _envs:
+        env = gym.make(env_name)
+        if type(env.observation_space) == gym.spaces.discrete.Discrete:
+            n_observations = env.observation_space.n
+            decode_obs = lambda r: np.eye(n_observations)[r]
+        else:
+            decode_obs = None
+        _envs[key] = MultiEnv(env_name, n_envs, decode_obs=decode_obs)
+    return _envs[key]
+
+def env_action(space, action, n_bins=50):
+    """
+    Convert the actions chosen for each head into the format of env.step
+    Parameters:
+        space: action space of the environment
+        action: np.array of shape (len(output_size),)
+        n_bins: number of actions a Box space is discretised in
+    """
+    if type(space) == gym.spaces.discrete.Discrete:
+        return action[0]
+    elif type(space) == gym.spaces.box.Box:
+        action_range = space.high[0] - space.low[0]
+        return [space.low[0] + action_range * (i+.5) / n_bins for i in action]
+    return list(action)
+
+def play_episodes(env_name, spec, theta, n_episodes, t_max, seed=None, on_step=None):
+    """
+    Play one episode in each of n_episodes environments in lockstep: the actions of all the running
+    environments are chosen in one forward pass of the NumPy engine (best_actions, greedy for a Q
+    network, sampled from the policy for A3C). Return the total rewards of the episodes.
+    Parameters:
+        env_name: name of gym environnment
+        spec: numpynn.NetworkSpec of the network
+        theta: list of np.array, weights of the network
+        n_episodes: number of episodes, played side by side
+        t_max: maximum number of timesteps per episode
+        seed: if not None, environment i is seeded with seed + i
+        on_step: function called after each step of the environments
+    """
+    envs = get_envs(env_name, n_episodes)
+    engine = spec.engine(theta)
+
+    if seed is not None:
+        for i, env in enumerate(envs.envs):
+            env.seed(seed + i)
+
+    observations = envs.reset()
+    rewards = np.zeros(n_episodes)
+    running = np.ones(n_episodes, dtype=bool)
+
+    t = 0
+    while running.any() and (t < t_max):
+        indices = np.flatnonzero(running)
+        actions = engine.best_actions(observations[indices], None)
+
+        for i, action in zip(indices, actions):
+            env = envs.envs[i]
+            observation, reward, done, info = env.step(env_action(env.action_space, action))
+            observations[i] = envs.decode_obs(observation)
+            rewards[i] += reward
+            running[i] = not done
+
+        t += 1
+        if on_step is not None:
+            on_step()
+
+    return rewards
+
+def reseed():
+    """
+    Initializer of the processes of the pool: they are forked with the random state of the tester,
+    so each one reseeds np.random from its pid to draw its own stream of actions
+    """
+    np.random.seed(os.getpid() % 2**32)
+
+def confidence_interval(rewards, z=1.96):
+    """
+    Return the mean of rewards and the half width of its confidence interval, with the normal
+    approximation
+    Parameters:
+        rewards: list of total rewards of episodes
+        z: quantile of the normal law, 1.96 for 95%
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if len(rewards) < 2:
+        return np.mean(rewards), 0.
+    return np.mean(rewards), z * np.std(rewards, ddof=1) / np.sqrt(len(rewards))
+
+
+class Evaluator(object):
+    """
+    Evaluation of a network on a batch of episodes played in lockstep (play_episodes), split over
+    a pool of processes when n_processes > 1. The pool only uses NumPy; create the evaluator before
+    any tensorflow session of the process, so that the pool is forked without it.
+    """
+
+    def __init__(self, env_name, nn, n_episodes=100, t_max=10000, n_processes=1, seed=0):
+        """
+        Parameters:
+            env_name: name of gym environnment
+            nn: qnn.QNeuralNetwork or a3cnn.A3CNeuralNetwork, initialised
+            n_episodes: number of episodes of an evaluation
+            t_max: maximum number of timesteps per episode
+            n_processes: number of processes of the pool. If 1, the episodes are played in this process
+            seed: seed of the environments of the first evaluation, the next ones use other seeds
+        """
+        self.env_name = env_name
+        self.spec = NetworkSpec(nn)
+        self.n_episodes = n_episodes
+        self.t_max = t_max
+        self.n_processes = n_processes
+        self.seed = seed
+        self.n_evaluations = 0
+
+        if n_processes > 1:
+            self.pool = mp.Pool(n_processes, initializer=reseed)
+        else:
+            self.pool = None
+
+    def evaluate(self, theta, on_wait=None):
+        """
+        Return the total rewards of n_episodes episodes played with the weights theta
+        Parameters:
+            theta: ParameterBuffer or list of np.array, copied before the evaluation
+            on_wait: function called regularly while the episodes are played
+        """
+        theta = [np.array(value) for value in theta]
+        seed = self.seed + self.n_evaluations * self.n_episodes
+        self.n_evaluations += 1
+
+        if self.pool is None:
+            return play_episodes(self.env_name, self.spec, theta, self.n_episodes, self.t_max, seed,
+                                 on_wait)
+
+        chunks = [chunk for chunk in np.array_split(np.arange(self.n_episodes), self.n_processes)
+                  if len(chunk) > 0]
+        result = self.pool.starmap_async(play_episodes, [(self.env_name, self.spec, theta, len(chunk),
+                                                          self.t_max, seed + chunk[0])
+                                                         for chunk in chunks])
+        while not result.ready():
+            if on_wait is not None:
+                on_wait()
+            result.wait(0.01)
+
+        return np.concatenate(result.get())
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
@@ -0,0 +1,386 @@
+# coding: utf-8
+
+import gym
+import multiprocessing as mp
+import numpy as np
+import sys
+
+from ..utils.utils import epsilon_greedy_policy_batch, get_shapes, get_shapes_a3c
+from ..utils.sharedparams import ParameterBuffer
+from ..utils import settings
+from ..utils.paramserver import ServerLost
+from ..utils.stepcounter import StepCounter
+from ..utils.rollout import RolloutBuffer
+from ..utils.returns import discounted_returns
+from ..utils.replay import nstep_transitions, train_on_replay
+from ..utils.envs import MultiEnv
+from ..utils.checkpoint import state_writer
+from ..utils.graphguard import GraphGuard
+from ..utils import callback as cb
+
+from ..neuralnets import qnn, a3cnn, numpynn
+
+class slave_worker_multi_env(mp.Process):
+    """
+    The class coding a process running several environments gym side by side and sharing gradient
+    updates. The actions of all the environments are chosen in a single forward pass, and the
+    rollouts of every environment are trained in one batch.
+    This slave uses asynchrone n step Q learning, 1 step Q learning or A3C algorithm.
+    """
+
+    def __init__(self, algo="nstep", n_envs=4, T_max=100000, t_max=5, gamma=0.9, learning_rate=0.001,
+                 Iasyncupdate=10, env_name="CartPole-v0", model_option={"n_hidden":1, "hidden_size":[10]},
+                 verbose=False, policy=None, epsilon_ini=0.9, alpha_reg=0., beta_reg=None,
+                 weighted=False, eps_fall=50000, callback=None, callback_name="callbacks/actor0",
+                 callback_batch_size=100, name="", seed=42, action_replay=1,  reset=False,
+                 T_chunk=100, inference="tf", predictor=None, trainer=None,
+                 replay=None, replay_batch_size=32, replay_ratio=1, scalar_every=10,
+                 histogram_every=1000, callback_backend="csv", checkpoints_path=None, resume=False,
+                 guard_every=0, **kwargs):
+        """
+        Parameters:
+            algo: which algorithm to use. Possible values: "nstep", "1step", "a3c"
+            n_envs: number of environments run side by side
+            T_max: maximum number of iterations
+            t_max: Value of n in the n step algorithm, number of steps of each rollout for nstep and
+                   a3c
+            gamma: depreciation of the futur
+            learning_rate: learning_rate of the optimiser
+            Iasyncupdate: Number of steps between two updates in 1 step Q learning
+            env_name: name of gym environnment
+            model_option: dictionary, must have two keys. n_hidden defines the number of hidden layers,
+                        hidden_size the size of them in the neural network
+            verbose: If True, the first environment of this slave will be rendered
+            policy: Not used here, random actions are taken uniformly
+            epsilon_ini: Value of epsilon at the end of its decrease
+            alpha_reg: coefficient of l1 regularisation
+            beta_reg: coefficient of l2 regularisation. If None, the default of the slave of algo
+            weighted: not implemented for several environments, must be False
+            eps_fall: number of steps for epsilon to go from 1 to epsilon_ini
+            callback: if True, the steps of all the environments, the rewards of their episodes and
+                      the norms of the updates are stored in a single callback
+            callback_name: directory of the callback
+            callback_batch_size: number of steps stored before being written
+            callback_backend: "csv" or "binary", backend of the callback (see callback.callback)
+            name: name of the slave, used for the summaries
+            seed: seed of numpy and of the environments
+            action_replay: not implemented for several environments, must be 1
+            reset: If True, the learning rate and epsilon are reset when the learning rate gets small
+            T_chunk: number of steps counted locally before being added to the global counter T
+            inference: "tf" to choose actions with the tensorflow session, "numpy" to evaluate the
+                       network with NumPy from the loaded weights (numpynn)
+            predictor: if not None, client of the predictor processes (predictor.PredictorChannels)
+                       used to choose the actions instead of the network of the slave
+            trainer: if not None, multiprocessing.Queue of the trainer processes (trainer.trainer_worker).
+                     The rollouts are sent to it instead of being trained by the slave
+            replay: if not None, replay.PrioritizedReplay shared by the slaves, for nstep and 1step. The 
+                    transitions of the rollouts are stored in it, and replay_ratio updates on 
+                    prioritized batches of replay_batch_size transitions follow each update on a rollout
+            scalar_every: number of updates between two summaries of the learning rate and the loss
+            histogram_every: number of updates between two histograms of the weights and biases
+            checkpoints_path: if not None, run directory of the tester. The training state of the slave
+                              is saved in it with each checkpoint (checkpoint.state_writer)
+            resume: If True, the training state of the slave is restored from checkpoints_path
+            guard_every: if more than 0, number of seconds between two reports of the size of the graph
+                         and of the memory of the process (graphguard.GraphGuard)
+            kwargs: args of multiprocessing.Process
+        """
+        super(slave_worker_multi_env, self).__init__(**kwargs)
+        self.guard_every = guard_every
+
+        assert algo in ["nstep", "1step", "a3c"], "Not understood algorithm"
+        assert (replay is None) or (algo != "a3c"), "Replay is only implemented for Q learning"
+        if weighted:
+            raise ValueError("weighted is not implemented for several environments per slave")
+        if action_replay != 1:
+            raise ValueError("action_replay is not implemented for several environments per slave")
+
+        self.algo = algo
+        self.n_envs = n_envs
+        self.T_chunk = T_chunk
+        self.inference = inference
+        self.predictor = predictor
+        self.trainer = trainer
+        self.scalar_every = scalar_every
+        self.histogram_every = histogram_every
+        self.replay = replay
+        self.replay_batch_size = replay_batch_size
+        self.replay_ratio = replay_ratio
+        self.T_max = T_max
+        self.gamma = gamma
+        self.verbose = verbose
+        self.epsilon_ini = epsilon_ini
+        self.eps_fall = eps_fall
+        self.name = name
+        self.seed = seed
+        self.reset = reset
+        self.resume = resume
+        if checkpoints_path is not None:
+            self.state_writer = state_writer(checkpoints_path, name)
+        else:
+            self.state_writer = None
+        self.lr_ini = learning_rate
+
+        env = gym.make(env_name)
+
+        if type(env.observation_space) == gym.spaces.discrete.Discrete:
+            n_observations = env.observation_space.n
+            self.input_size = [n_observations]
+            decode_obs = lambda r: np.eye(n_observations)[r]
+        else:
+            self.input_size = [env.observation_space.shape[0]]
+            decode_obs = None
+
+        if type(env.action_space) == gym.spaces.box.Box:
+            self.output_size = [50]
+            action_range = env.action_space.high[0] - env.action_space.low[0]
+            self.action_space = [env.action_space.low[0] + action_range * (i+.5) / self.output_size[0]
+                for i in range(self.output_size[0])]
+        elif type(env.action_space) == gym.spaces.discrete.Discrete:
+            self.output_size = [env.action_space.n]
+            self.action_space = [i for i in range(self.output_size[0])]
+        elif type(env.action_space) == gym.spaces.tuple_space.Tuple:
+            self.output_size = []
+            for space in env.action_space.spaces:
+                if type(space) == gym.spaces.discrete.Discrete:
+                    self.output_size.append(space.n)
+                else:
+                    NotImplementedError
+        self.action_space_type = type(env.action_space)
+
+        self.envs = MultiEnv(env_name, n_envs, decode_obs=decode_obs, seed=seed)
+
+        if callback:
+            self.callback = cb.callback(batch_size=callback_batch_size, saving_directory=callback_name, 
+                                    observation_size=self.input_size, action_size=len(self.output_size),
+                                    backend=callback_backend)
+        else:
+            self.callback = None
+
+        if algo == "a3c":
+            self.nn = a3cnn.A3CNeuralNetwork(input_size=self.input_size, output_size=self.output_size,
+                    n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"],
+                    learning_rate=learning_rate, alpha_reg=alpha_reg,
+                    beta_reg=0.001 if beta_reg is None else beta_reg)
+            shapes = get_shapes_a3c(n_hidden=model_option["n_hidden"],
+                                    hidden_size=model_option["hidden_size"],
+                                    input_size=self.input_size, output_size=self.output_size)
+        else:
+            assert len(self.output_size) == 1, "Q learning needs a discrete action space"
+            self.nn = qnn.QNeuralNetwork(input_size=self.input_size[0], output_size=self.output_size[0],
+                    n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"],
+                    learning_rate=learning_rate, alpha_reg=alpha_reg,
+                    beta_reg=(0.01 if algo == "nstep" else 0.001) if beta_reg is None else beta_reg)
+            shapes = get_shapes(n_hidden=model_option["n_hidden"],
+                                hidden_size=model_option["hidden_size"],
+                                input_size=self.input_size[0], output_size=self.output_size[0])
+
+        self.theta_prime = ParameterBuffer(shapes)
+
+        t_rollout = Iasyncupdate if algo == "1step" else t_max
+        self.rollout = RolloutBuffer(t_rollout, self.input_size, self.output_size, n_envs=n_envs)
+
+    def env_action(self, action):
+        """
+        Convert the actions chosen for each head into the format of env.step
+        Parameters:
+            action: np.array of shape (len(output_size),)
+        """
+        if self.action_space_type == gym.spaces.discrete.Discrete:
+            return action[0]
+        elif self.action_space_type == gym.spaces.box.Box:
+            return [self.action_space[action[i]] for i in range(len(action))]
+        else:
+            return list(action)
+
+    def feed_dict(self):
+        """
+        Build the feed_dict of the train step from the rollouts of all the environments
+        """
+        feed_dict = {self.nn.variables["input_observation"]: self.rollout.batch_observations,
+                     self.nn.variables["y_true"]: self.rollout.batch_targets}
+        if self.algo == "a3c":
+            for i in range(len(self.output_size)):
+                feed_dict[self.nn.variables["y_action"][i]] = self.rollout.batch_actions_one_hot[i]
+        else:
+            feed_dict[self.nn.variables["y_action"]] = self.rollout.batch_actions_one_hot[0]
+        return feed_dict
+
+    def store_replay(self, observations):
+        """
+        Store the transitions of the rollouts in the replay buffer: n step transitions to the last
+        states for nstep, 1 step transitions for 1step
+        Parameters:
+            observations: np.array of shape (n_envs, input_size), states reached after the rollouts
+        """
+        if self.algo == "nstep":
+            rewards, discounts = nstep_transitions(self.rollout.rewards, self.rollout.dones, self.gamma)
+            next_observations = np.broadcast_to(observations, self.rollout.observations.shape)
+        else:
+            rewards = self.rollout.rewards
+            discounts = self.gamma * (1. - self.rollout.dones)
+            next_observations = self.rollout.next_observations
+
+        self.replay.add(self.rollout.batch_observations, self.rollout.merge_axes(self.rollout.actions)[:, 0],
+                        self.rollout.merge_axes(rewards), self.rollout.merge_axes(next_observations),
+                        self.rollout.merge_axes(discounts))
+
+    def run(self):
+        """
+        Run work, then close the callback even if it raised, so that its queued steps are written.
+        A slave which lost its parameter server stops with the exit code 1
+        """
+        try:
+            self.work()
+        except ServerLost as e:
+            print("Slave %s stopping: %s"%(self.name, e))
+            sys.exit(1)
+        finally:
+            if self.callback:
+                self.callback.close()
+
+    def work(self):
+        """
+        Run the worker and launch the algorithm on all its environments
+        """
+        import tensorflow as tf
+
+        self.T = StepCounter(settings.T, self.T_chunk)
+
+        np.random.seed(self.seed)
+
+        self.nn.initialisation()
+
+        self.sess = tf.Session()
+
+        self.nn.create_summary(self.sess, self.name, self.scalar_every, self.histogram_every)
+
+        self.sess.run(tf.global_variables_initializer())
+
+        self.sess.graph.finalize()
+        if self.guard_every > 0:
+            self.guard = GraphGuard(self.name, self.sess.graph, self.guard_every)
+        else:
+            self.guard = None
+
+        if self.inference == "numpy":
+            self.actor = numpynn.numpy_network(self.nn)
+        else:
+            self.actor = self.nn
+
+        epsilon = 1
+        t_env = 0
+        minlr = self.lr_ini / 10
+
+        if self.resume and (self.state_writer is not None):
+            values = self.state_writer.restore(self.sess)
+            if values is not None:
+                epsilon = float(values["epsilon"])
+                minlr = float(values["minlr"])
+                t_env = int(values["t_env"])
+                self.nn.schedule.T_reset = int(values["T_reset"])
+                self.nn.schedule.decay_steps = int(values["decay_steps"])
+
+        observations = self.envs.reset()
+
+        if self.inference == "numpy":
+            self.theta_prime = self.nn.assign_value_to_theta_prime(self.theta_prime)
+            self.nn.read_value_from_theta(self.sess, self.theta_prime)
+            numpynn.check_equivalence(self.actor, self.nn, self.sess, observations[0])
+
+        if self.predictor is None:
+            self.acting = self.actor
+        else:
+            self.acting = self.predictor
+
+        while self.T.value<self.T_max:
+
+            if self.guard is not None:
+                self.guard.check()
+
+            if (self.state_writer is not None) and self.state_writer.due():
+                self.state_writer.save(self.sess, self.T.value, T_reset=self.nn.schedule.T_reset, 
+                                       decay_steps=self.nn.schedule.decay_steps, epsilon=epsilon, 
+                                       minlr=minlr, t_env=t_env)
+
+            self.theta_prime = self.nn.assign_value_to_theta_prime(self.theta_prime)
+            self.nn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
+
+            self.rollout.reset(observations)
+
+            for t in range(self.rollout.t_max):
+                if self.verbose:
+                    self.envs.render()
+
+                random, actions = epsilon_greedy_policy_batch(self.acting, observations, epsilon,
+                                                              self.output_size, self.sess)
+
+                previous = observations
+                observations, rewards, dones = self.envs.step([self.env_action(action)
+                                                               for action in actions])
+
+                if self.callback:
+                    for i in range(self.n_envs):
+                        self.callback.store(rewards[i], random[i], actions[i], previous[i], 0)
+
+                self.rollout.store(actions, rewards, dones, observations)
+
+                if self.algo == "1step":
+                    values = np.max(self.actor.forward(observations, self.sess), axis=1)
+                    self.rollout.targets[-1] = rewards + self.gamma * (1. - dones) * values
+
+                self.T.increment(self.n_envs)
+                t_env += self.n_envs
+
+                if epsilon > self.epsilon_ini:
+                    epsilon -= self.n_envs * (1 - self.epsilon_ini)/self.eps_fall
+
+            if self.algo == "nstep":
+                self.nn.load_snapshot(self.sess, settings.l_theta_minus, "theta_minus")
+                R = np.max(self.actor.forward(observations, self.sess), axis=1)
+                self.nn.read_value_from_theta(self.sess, self.theta_prime, ("theta", self.theta_prime.pulled))
+            elif self.algo == "a3c":
+                R = self.actor.forward(observations, self.sess)[1]
+
+            if self.algo != "1step":
+                self.rollout.targets[:] = discounted_returns(self.rollout.rewards, self.rollout.dones,
+                                                             R, self.gamma)
+
+            if self.replay is not None:
+                self.store_replay(observations)
+
+            if self.trainer is not None:
+                self.trainer.put((self.rollout.batch_observations.copy(),
+                                  [one_hot.copy() for one_hot in self.rollout.batch_actions_one_hot],
+                                  self.rollout.batch_targets.copy()))
+            else:
+                diff = self.nn.train_and_push(self.sess, self.feed_dict(), t_env, T=self.T.value)
+                if self.callback:
+                    self.callback.store_diff(diff)
+
+                if (self.replay is not None) and (len(self.replay) >= self.replay_batch_size):
+                    for i in range(self.replay_ratio):
+                        train_on_replay(self.nn, self.actor, self.sess, self.replay, self.theta_prime,
+                                        self.replay_batch_size, self.T.value)
+
+            if self.reset & (self.nn.schedule(self.T.value) < minlr) :
+                minlr /= 10
+                epsilon = 1
+                self.nn.schedule.reset(self.T.value)
+
+            if self.verbose or self.callback:
+                finished = self.envs.pop_finished_rewards()
+                if self.callback:
+                    for rpe in finished:
+                        self.callback.store_rpe(rpe)
+                        self.callback.store_hp(epsilon, self.nn.schedule(self.T.value))
+                if self.verbose and (len(finished) > 0):
+                    print("T = %s, mean reward of the last episodes = %s"%(self.T.value,
+                                                                           np.mean(finished)))
+
+        self.T.flush()
+
+        if self.state_writer is not None:
+            self.state_writer.close()
+
+        return
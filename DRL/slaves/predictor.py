@@ -0,0 +1,215 @@
+# coding: utf-8
+import multiprocessing as mp
+import numpy as np
+
+from ..utils import settings
+from ..utils.utils import gather_queue
+from ..utils.graphguard import GraphGuard
+from ..neuralnets import a3cnn, qnn, numpynn
+
+
+class PredictorChannels(object):
+    """
+    Shared memory used by the slaves to ask the predictors for forward passes. Each slave (client)
+    owns a slot where it writes its observations and where a predictor writes back the outputs of
+    the network. The requests queue only carries the index of the client and the number of
+    observations, and a semaphore per client tells it that its outputs are ready.
+    It must be created before the processes are started.
+    """
+
+    def __init__(self, n_clients, input_size, output_size, algo="nstep", slot_size=1):
+        """
+        Parameters:
+            n_clients: number of slaves using the predictors
+            input_size: list, shape of an observation
+            output_size: list, number of possible actions for each head of the network
+            algo: "a3c" for a policy and value network, else a Q network
+            slot_size: maximum number of observations of one request (n_envs of the slaves)
+        """
+        self.n_clients = n_clients
+        self.input_size = list(input_size)
+        self.output_size = list(output_size)
+        self.algo = algo
+        self.slot_size = slot_size
+
+        if algo == "a3c":
+            # probabilities of every head, then the value
+            self.n_outputs = sum(self.output_size) + 1
+        else:
+            self.n_outputs = self.output_size[0]
+        n_inputs = int(np.prod(self.input_size))
+
+        self.requests = mp.Queue()
+        self.observations = np.frombuffer(mp.RawArray('f', n_clients * slot_size * n_inputs),
+                                          dtype=np.float32).reshape((n_clients, slot_size, n_inputs))
+        self.outputs = np.frombuffer(mp.RawArray('f', n_clients * slot_size * self.n_outputs),
+                                     dtype=np.float32).reshape((n_clients, slot_size, self.n_outputs))
+        self.ready = [mp.Semaphore(0) for i in range(n_clients)]
+
+    def client(self, index):
+        """
+        Return the network-like object used by the slave number index to act through the predictors
+        """
+        if self.algo == "a3c":
+            return PredictorA3CClient(self, index)
+        return PredictorQClient(self, index)
+
+
+class PredictorQClient(numpynn.NumpyQNeuralNetwork):
+    """
+    Acting API of a QNeuralNetwork served by the predictor processes. The forward pass is sent to
+    the predictors and waits for their answer; the sess arguments are ignored. The weights used are
+    the shared weights l_theta at the time of the batch.
+    """
+
+    def __init__(self, channels, index):
+        """
+        Parameters:
+            channels: PredictorChannels
+            index: index of the slot of this client
+        """
+        self.channels = channels
+        self.index = index
+        self.output_size = channels.output_size
+        self.initialised = True
+
+    def request(self, observations):
+        """
+        Send a batch of observations to the predictors and return the rows of outputs
+        Parameters:
+            observations: np.array of shape (batch_size, input_size), batch_size <= slot_size
+        """
+        n = len(observations)
+        assert n <= self.channels.slot_size, "Request larger than the slot of the client"
+
+        self.channels.observations[self.index, :n] = observations.reshape((n, -1))
+        self.channels.requests.put((self.index, n))
+        self.channels.ready[self.index].acquire()
+        return self.channels.outputs[self.index, :n].copy()
+
+    def forward(self, observations, sess=None):
+        return self.request(observations)
+
+
+class PredictorA3CClient(numpynn.NumpyA3CNeuralNetwork):
+    """
+    Acting API of a A3CNeuralNetwork served by the predictor processes, see PredictorQClient
+    """
+
+    __init__ = PredictorQClient.__init__
+    request = PredictorQClient.request
+
+    def forward(self, observations, sess=None):
+        outputs = self.request(observations)
+        bounds = np.cumsum(self.output_size)[:-1]
+        return np.split(outputs[:, :-1], bounds, axis=1), outputs[:, -1]
+
+
+class predictor_worker(mp.Process):
+    """
+    Process gathering the observations sent by the slaves into batches and evaluating them in a
+    single forward pass of the network with the shared weights l_theta (GA3C-style predictor).
+    A batch is sent as soon as it holds batch_size observations or max_wait seconds after its
+    first request.
+    """
+
+    def __init__(self, channels, model_option={"n_hidden":1, "hidden_size":[10]}, batch_size=32,
+                 max_wait=0.001, Ireload=1, inference="tf", verbose=False, guard_every=0,
+                 **kwargs):
+        """
+        Parameters:
+            channels: PredictorChannels shared with the slaves
+            model_option: dictionary, must have two keys. n_hidden defines the number of hidden layers,
+                        hidden_size the size of them in the neural network
+            batch_size: number of observations from which a batch is evaluated without waiting
+            max_wait: maximum time in seconds a request waits for other ones
+            Ireload: number of batches between two reads of the shared weights
+            inference: "tf" to evaluate the batches with a tensorflow session, "numpy" with NumPy
+                       (numpynn)
+            verbose: If True, the mean size of the batches is printed regularly
+            guard_every: if more than 0, number of seconds between two reports of the size of the graph
+                         and of the memory of the process (graphguard.GraphGuard)
+            kwargs: args of multiprocessing.Process
+        """
+        super(predictor_worker, self).__init__(**kwargs)
+        self.guard_every = guard_every
+        self.channels = channels
+        self.model_option = model_option
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.Ireload = Ireload
+        self.inference = inference
+        self.verbose = verbose
+
+    def predict(self, observations):
+        """
+        Return the outputs of the network for a batch, in the layout of channels.outputs
+        """
+        if self.channels.algo == "a3c":
+            actions, values = self.engine.forward(observations, self.sess)
+            return np.concatenate(list(actions) + [values[:, None]], axis=1)
+        return self.engine.forward(observations, self.sess)
+
+    def run(self):
+        """
+        Serve the requests of the slaves until the process is terminated
+        """
+        import tensorflow as tf
+
+        if self.channels.algo == "a3c":
+            self.nn = a3cnn.A3CNeuralNetwork(input_size=self.channels.input_size,
+                    output_size=self.channels.output_size, n_hidden=self.model_option["n_hidden"],
+                    hidden_size=self.model_option["hidden_size"])
+        else:
+            self.nn = qnn.QNeuralNetwork(input_size=self.channels.input_size[0],
+                    output_size=self.channels.output_size[0], n_hidden=self.model_option["n_hidden"],
+                    hidden_size=self.model_option["hidden_size"])
+
+        self.nn.initialisation()
+
+        self.sess = tf.Session()
+
+        self.sess.run(tf.global_variables_initializer())
+
+        self.sess.graph.finalize()
+        if self.guard_every > 0:
+            self.guard = GraphGuard(self.name, self.sess.graph, self.guard_every)
+        else:
+            self.guard = None
+
+        if self.inference == "numpy":
+            self.engine = numpynn.numpy_network(self.nn)
+        else:
+            self.engine = self.nn
+
+        n_batches = 0
+        n_rows = 0
+
+        while True:
+            if self.guard is not None:
+                self.guard.check()
+
+            requests = gather_queue(self.channels.requests, self.batch_size, self.max_wait,
+                                    size=lambda request: request[1])
+
+            if n_batches % self.Ireload == 0:
+                if self.inference == "numpy":
+                    self.nn.theta_copy.pull(settings.l_theta)
+                else:
+                    self.nn.load_snapshot(self.sess, settings.l_theta, "theta")
+
+            observations = np.concatenate([self.channels.observations[index, :n]
+                                           for index, n in requests])
+            outputs = self.predict(observations)
+
+            start = 0
+            for index, n in requests:
+                self.channels.outputs[index, :n] = outputs[start:start + n]
+                self.channels.ready[index].release()
+                start += n
+
+            n_batches += 1
+            n_rows += len(observations)
+
+            if self.verbose & (n_batches % 1000 == 0):
+                print("Predictor %s: mean batch size = %s"%(self.name, n_rows / n_batches))
@@ -3,14 +3,17 @@ import numpy as np
 import multiprocessing as mp
 import time
 import gym
-import os
-from os.path import join as pjoin
 
-from ..neuralnets import a3cnn, qnn 
+from ..neuralnets import a3cnn, qnn, numpynn
+from .evaluator import Evaluator, confidence_interval
 from ..utils.utils import epsilon_greedy_policy
 
 from ..utils import settings
 from ..utils import callback as cb
+from ..utils.checkpoint import (checkpoint_writer, is_checkpoint, load_checkpoint, make_run_directory,
+                                capture_state, restore_state)
+from ..utils.sharedparams import ParameterBuffer
+from ..utils.graphguard import GraphGuard
 
 class tester_worker(mp.Process):
     """
@@ -23,7 +26,8 @@ class tester_worker(mp.Process):
                 callback=None, callback_name="callbacks/tester", callback_batch_size=10, 
                 checkpoint=600, checkpoints_path="./checkpoints", warmstart=False, 
                 weights_path="./checkpoints/cartpole_v1_150/intermediate_weights", nb_render=1, 
-                **kwargs):
+                inference="tf", callback_backend="csv", eval_episodes=0, eval_processes=1, 
+                n_checkpoints=5, run_directory=None, resume=False, guard_every=0, **kwargs):
         """
         Parameters:
             T_max: maximum number of iterations
@@ -36,9 +40,29 @@ class tester_worker(mp.Process):
             len_history: number of episodes to test the algorithm
             Itarget: number of iterations between two updates of theta minus
             render: If True, environment will be rendered
+            inference: "tf" to choose actions with the tensorflow session, "numpy" to evaluate the
+                       network with NumPy from the loaded weights (numpynn)
+            callback_backend: "csv" or "binary", backend of the callback (see callback.callback)
+            eval_episodes: if more than 0, the test episodes are played by batches of eval_episodes
+                           environments in lockstep with batched NumPy inference (evaluator.Evaluator),
+                           instead of one at a time. The callback is not used then
+            eval_processes: number of processes the batches of episodes are split over
+            checkpoint: number of seconds between two checkpoints of theta
+            checkpoints_path: directory where a new directory is created for the checkpoints of the run
+            run_directory: if not None, directory of the checkpoints of the run, used instead of a new
+                           one, see checkpoint.make_run_directory
+            resume: If True, the state of the tester is restored from the latest checkpoint of
+                    run_directory. T and the weights must be restored before the processes are 
+                    started, see checkpoint.resume_shared_state
+            n_checkpoints: number of periodic checkpoints kept, see checkpoint.checkpoint_writer
+            warmstart: If True, theta is loaded from weights_path at the beginning
+            weights_path: checkpoint (.npz file or run directory) or prefix of a tensorflow checkpoint
+            guard_every: if more than 0, number of seconds between two reports of the size of the graph
+                         and of the memory of the process (graphguard.GraphGuard)
             kwargs: args of multiprocessing.Process
         """
         super(tester_worker, self).__init__(**kwargs)
+        self.guard_every = guard_every
         self.T_max = T_max
         self.t_max = t_max
         self.env = gym.make(env_name)
@@ -73,6 +97,7 @@ class tester_worker(mp.Process):
         self.nb_render = nb_render
         self.weighted=weighted
         self.algo = algo
+        self.inference = inference
         
         if algo=="a3c":
             self.nn = a3cnn.A3CNeuralNetwork(input_size=self.input_size, output_size=self.output_size, 
@@ -91,21 +116,27 @@ class tester_worker(mp.Process):
 
         if callback:
             self.callback = cb.callback(batch_size=callback_batch_size, saving_directory=callback_name, 
-                                        observation_size=self.input_size, action_size=len(self.output_size))
+                                        observation_size=self.input_size, action_size=len(self.output_size),
+                                        backend=callback_backend)
         else:
             self.callback = None
 
-        n_temp =  "Try_" + str(len(os.listdir(checkpoints_path)) )
-        self.checkpoints_path = pjoin(checkpoints_path, n_temp)
-        os.mkdir(self.checkpoints_path)
-        self.checkpoints_path = pjoin(self.checkpoints_path, "intermediate_weights")
-        self.final_weights_path = pjoin(self.checkpoints_path, "final_weights")
+        if run_directory is None:
+            run_directory = make_run_directory(checkpoints_path)
+        self.checkpoints_path = run_directory
+        self.resume = resume
+        self.n_checkpoints = n_checkpoints
         self.checkpoint = checkpoint
         self.last_checkpoint = time.time()
 
         self.warmstart = warmstart
         self.weights_path = weights_path
 
+        self.env_name = env_name
+        self.eval_episodes = eval_episodes
+        self.eval_processes = eval_processes
+        self.evaluator = None
+
     def add_history(self, reward):
         """
         Add a value to the history and remove the last one
@@ -115,6 +146,79 @@ class tester_worker(mp.Process):
         self.history = self.history[1:]
         self.history.append(reward)
         
+    def update_theta_minus(self):
+        """
+        Publish theta as a new version of theta minus every Itarget steps
+        """
+        if self.algo != "a3c" and settings.T.value >= self.counter_T:
+            self.counter_T += self.Itarget
+            settings.l_theta_minus.publish(settings.l_theta)
+
+    def restore(self):
+        """
+        Load theta from weights_path, written by a checkpoint_writer or, for older checkpoints, by a
+        tensorflow saver, and publish it
+        """
+        if is_checkpoint(self.weights_path):
+            weights = load_checkpoint(self.weights_path)
+            settings.l_theta.copy_from([weights[key] for key in self.nn.keys])
+            settings.l_theta.publish()
+        else:
+            import tensorflow as tf
+            self.nn.read_value_from_theta(self.sess, settings.l_theta)
+            saver = tf.train.Saver([self.nn.variables[key] for key in self.nn.keys])
+            saver.restore(self.sess, self.weights_path)
+            self.nn.assign_value_to_theta(self.sess)
+        print("Model successfully loaded")
+
+    def training_state(self):
+        """
+        Return the state of the tester, theta minus and the statistics of the shared optimiser, saved
+        with theta in the checkpoints
+        """
+        n_evaluations = 0 if self.evaluator is None else self.evaluator.n_evaluations
+        state = capture_state(None, counter_T=self.counter_T, history=self.history, 
+                              max_mean=self.max_mean, nb_env=self.nb_env, last_T=self.last_T,
+                              n_evaluations=n_evaluations)
+        if self.algo != "a3c":
+            settings.l_theta_minus.snapshot(self.theta_minus)
+            for key, value in zip(self.nn.keys, self.theta_minus):
+                state["theta_minus/" + key] = value.copy()
+        if settings.shared_optimizer is not None:
+            for key, value in zip(self.nn.keys, settings.shared_optimizer.g):
+                state["rmsprop/" + key] = value.copy()
+        return state
+
+    def restore_training_state(self):
+        """
+        Restore the state of the tester from the latest checkpoint of the run
+        """
+        values = restore_state(None, load_checkpoint(self.checkpoints_path))
+        self.counter_T = int(values["counter_T"])
+        self.history = list(values["history"])
+        self.max_mean = float(values["max_mean"])
+        self.nb_env = int(values["nb_env"])
+        self.last_T = int(values["last_T"])
+        if self.evaluator is not None:
+            self.evaluator.n_evaluations = int(values["n_evaluations"])
+        print("Resumed from T = %s"%settings.T.value)
+
+    def evaluate(self):
+        """
+        Play a batch of eval_episodes episodes with the current weights theta, add them to the
+        history and print the rolling mean with its confidence interval
+        """
+        rewards = self.evaluator.evaluate(settings.l_theta, on_wait=self.update_theta_minus)
+
+        for reward in rewards:
+            self.add_history(reward)
+        self.nb_env += len(rewards)
+        self.last_T = settings.T.value
+
+        mean, half_width = confidence_interval(self.history)
+        print("T = %s, mean over the last %s episodes = %.2f +/- %.2f (batch mean = %.2f)"%(
+            settings.T.value, len(self.history), mean, half_width, np.mean(rewards)))
+
     def stoping_criteria(self):
         """
         Check from the history if the game is solved 
@@ -128,6 +232,16 @@ class tester_worker(mp.Process):
             return True
 
     def run(self):
+        """
+        Run work, then close the callback even if it raised, so that its queued steps are written
+        """
+        try:
+            self.work()
+        finally:
+            if self.callback:
+                self.callback.close()
+
+    def work(self):
         """
         Launch the worker
         """
@@ -136,23 +250,43 @@ class tester_worker(mp.Process):
 
         self.nn.initialisation()
 
+        if self.eval_episodes > 0:
+            self.evaluator = Evaluator(self.env_name, self.nn, n_episodes=self.eval_episodes, 
+                                       t_max=self.t_max, n_processes=self.eval_processes)
+
+        self.checkpoints = checkpoint_writer(self.checkpoints_path, self.nn.keys, self.n_checkpoints)
+        if self.algo != "a3c":
+            self.theta_minus = ParameterBuffer(settings.l_theta_minus.shapes)
+        if self.resume:
+            self.restore_training_state()
+
         self.sess = tf.Session()
         self.sess.run(tf.global_variables_initializer())
-        saver = tf.train.Saver()
         if self.warmstart:
-            self.nn.read_value_from_theta(self.sess, settings.l_theta)
-            saver.restore(self.sess, self.weights_path)
-            self.nn.assign_value_to_theta(self.sess)
-            print("Model successfully loaded")
+            self.restore()
+        self.sess.graph.finalize()
+        if self.guard_every > 0:
+            self.guard = GraphGuard(self.name, self.sess.graph, self.guard_every)
+        else:
+            self.guard = None
 
         observation = self.env.reset()
         observation = self.decode_obs(observation)
 
+        if self.inference == "numpy":
+            self.actor = numpynn.numpy_network(self.nn)
+            self.nn.read_value_from_theta(self.sess, settings.l_theta)
+            numpynn.check_equivalence(self.actor, self.nn, self.sess, observation)
+        else:
+            self.actor = self.nn
+
         epsilon=0.
         nb_env = 0
 
         t_init = time.time()
         while (settings.T.value<self.T_max) & (not self.stoping_criteria()):
+            if self.guard is not None:
+                self.guard.check()
             
             if time.time() - t_init > self.n_sec_print:
                 print("T = %s"%settings.T.value)
@@ -162,18 +296,21 @@ class tester_worker(mp.Process):
             
             if time.time() - self.last_checkpoint > self.checkpoint:
                 self.last_checkpoint = time.time()
-                save_path = saver.save(self.sess, self.checkpoints_path)
-                print("######################################")
-                print("# Model saved in %s #"%save_path)
-                print("######################################")
-
+                save_path = self.checkpoints.save(settings.l_theta, settings.T.value, 
+                                                  state=self.training_state())
+                with settings.checkpoint_request.get_lock():
+                    settings.checkpoint_request.value += 1
+                print("Saving model in %s"%save_path)
 
+            if self.evaluator is not None:
+                self.evaluate()
+                continue
 
             t = 0
             self.nb_env += 1
             current_reward = 0
 
-            self.nn.read_value_from_theta(self.sess, settings.l_theta)
+            self.nn.load_snapshot(self.sess, settings.l_theta, "theta")
             while t<self.t_max:
 
                 if self.render & (nb_env % self.nb_render == 0):
@@ -181,12 +318,9 @@ class tester_worker(mp.Process):
 
                 t += 1
 
-                if self.algo != "a3c" and settings.T.value >= self.counter_T:
-                    self.counter_T += self.Itarget
-                    for i, theta_minus in enumerate(settings.l_theta_minus):
-                        settings.l_theta_minus[i] = settings.l_theta[i]
+                self.update_theta_minus()
 
-                _, action = epsilon_greedy_policy(self.nn, observation, epsilon, self.output_size,
+                _, action = epsilon_greedy_policy(self.actor, observation, epsilon, self.output_size,
                                                   self.sess, self.policy, self.weighted)
                 
                 if type(self.env.action_space) == gym.spaces.discrete.Discrete:
@@ -229,11 +363,16 @@ class tester_worker(mp.Process):
             nb_env += 1
 
         print("Training completed")
-        save_path = saver.save(self.sess, self.final_weights_path)
+        if self.evaluator is not None:
+            self.evaluator.close()
+        save_path = self.checkpoints.save(settings.l_theta, settings.T.value, "final_weights", 
+                                          self.training_state())
+        self.checkpoints.close()
         print("Model saved in %s"%save_path)
         print("T final = %s"%self.last_T)
         print("Done in %s environments"%(self.nb_env-100))
         print("Done in %s seconds"%(time.time() - t_taken))
+        print("Pushes into theta: %s"%settings.l_theta.stats())
         settings.T.value += self.T_max
 
         observation = self.env.reset()
@@ -245,7 +384,7 @@ class tester_worker(mp.Process):
                 t += 1
                 self.env.render()
 
-                action = self.nn.best_action(observation, self.sess)
+                action = self.actor.best_action(observation, self.sess)
 
                 observation, reward, done, info = self.env.step(action) 
 
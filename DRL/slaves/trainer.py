@@ -0,0 +1,132 @@
+# coding: utf-8
+import multiprocessing as mp
+import numpy as np
+
+from ..utils import settings
+from ..utils.utils import gather_queue
+from ..utils.graphguard import GraphGuard
+from ..neuralnets import a3cnn, qnn
+
+
+class trainer_worker(mp.Process):
+    """
+    Process training the shared weights on the rollouts collected by the slaves. The rollouts of
+    several slaves are gathered into one minibatch, the network is trained once from the current
+    shared weights l_theta, the update is pushed to l_theta and a new version of the weights is
+    published. Works for the Q networks (nstep, 1step) and the A3C network.
+    """
+
+    def __init__(self, rollouts, algo="nstep", input_size=[4], output_size=[2],
+                 model_option={"n_hidden":1, "hidden_size":[10]}, learning_rate=0.001, alpha_reg=0.,
+                 beta_reg=None, batch_size=256, max_wait=0.01, name="trainer", verbose=False,
+                 scalar_every=10, histogram_every=1000, guard_every=0, **kwargs):
+        """
+        Parameters:
+            rollouts: multiprocessing.Queue where the slaves put their rollouts, as tuples
+                      (observations, list of one hot actions of each head, targets)
+            algo: "a3c" for a policy and value network, else a Q network
+            input_size: list, shape of an observation
+            output_size: list, number of possible actions for each head of the network
+            model_option: dictionary, must have two keys. n_hidden defines the number of hidden layers,
+                        hidden_size the size of them in the neural network
+            learning_rate: learning_rate of the optimiser
+            alpha_reg: coefficient of l1 regularisation
+            beta_reg: coefficient of l2 regularisation. If None, the default of the slave of algo
+            batch_size: number of transitions from which a minibatch is trained without waiting
+            max_wait: maximum time in seconds a rollout waits for other ones
+            name: name of the trainer, used for the summaries
+            verbose: If True, the number of updates is printed regularly
+            scalar_every: number of updates between two summaries of the learning rate and the loss
+            histogram_every: number of updates between two histograms of the weights and biases
+            guard_every: if more than 0, number of seconds between two reports of the size of the graph
+                         and of the memory of the process (graphguard.GraphGuard)
+            kwargs: args of multiprocessing.Process
+        """
+        super(trainer_worker, self).__init__(**kwargs)
+        self.guard_every = guard_every
+        self.rollouts = rollouts
+        self.algo = algo
+        self.input_size = list(input_size)
+        self.output_size = list(output_size)
+        self.model_option = model_option
+        self.learning_rate = learning_rate
+        self.alpha_reg = alpha_reg
+        self.beta_reg = beta_reg
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self.verbose = verbose
+        self.scalar_every = scalar_every
+        self.histogram_every = histogram_every
+
+    def feed_dict(self, batch):
+        """
+        Concatenate the rollouts of a batch into the feed_dict of the train step
+        """
+        observations = np.concatenate([rollout[0] for rollout in batch])
+        targets = np.concatenate([rollout[2] for rollout in batch])
+        actions = [np.concatenate([rollout[1][i] for rollout in batch])
+                   for i in range(len(self.output_size))]
+
+        feed_dict = {self.nn.variables["input_observation"]: observations.reshape((len(observations), -1)),
+                     self.nn.variables["y_true"]: targets}
+        if self.algo == "a3c":
+            for i in range(len(self.output_size)):
+                feed_dict[self.nn.variables["y_action"][i]] = actions[i]
+        else:
+            feed_dict[self.nn.variables["y_action"]] = actions[0]
+        return feed_dict
+
+    def run(self):
+        """
+        Train on the rollouts of the slaves until the process is terminated
+        """
+        import tensorflow as tf
+
+        n_hidden = self.model_option["n_hidden"]
+        hidden_size = self.model_option["hidden_size"]
+        if self.algo == "a3c":
+            self.nn = a3cnn.A3CNeuralNetwork(input_size=self.input_size, output_size=self.output_size,
+                    n_hidden=n_hidden, hidden_size=hidden_size, learning_rate=self.learning_rate,
+                    alpha_reg=self.alpha_reg,
+                    beta_reg=0.001 if self.beta_reg is None else self.beta_reg)
+        else:
+            self.nn = qnn.QNeuralNetwork(input_size=self.input_size[0], output_size=self.output_size[0],
+                    n_hidden=n_hidden, hidden_size=hidden_size, learning_rate=self.learning_rate,
+                    alpha_reg=self.alpha_reg,
+                    beta_reg=(0.01 if self.algo == "nstep" else 0.001) if self.beta_reg is None else self.beta_reg)
+
+        self.nn.initialisation()
+
+        self.sess = tf.Session()
+
+        self.nn.create_summary(self.sess, self.name, self.scalar_every, self.histogram_every)
+
+        self.sess.run(tf.global_variables_initializer())
+
+        self.sess.graph.finalize()
+        if self.guard_every > 0:
+            self.guard = GraphGuard(self.name, self.sess.graph, self.guard_every)
+        else:
+            self.guard = None
+
+        n_updates = 0
+
+        while True:
+            if self.guard is not None:
+                self.guard.check()
+
+            batch = gather_queue(self.rollouts, self.batch_size, self.max_wait,
+                                 size=lambda rollout: len(rollout[0]))
+
+            feed_dict = self.feed_dict(batch)
+
+            self.nn.load_snapshot(self.sess, settings.l_theta, "theta")
+
+            self.nn.train_and_push(self.sess, feed_dict, n_updates, T=settings.T.value)
+
+            n_updates += 1
+
+            if self.verbose & (n_updates % 1000 == 0):
+                print("Trainer %s: %s updates, weights version %s"%(self.name, n_updates,
+                                                                    settings.l_theta.version.value))
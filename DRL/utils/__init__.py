@@ -1,4 +1,15 @@
 from __future__ import absolute_import
 from . import callback
+from . import checkpoint
+from . import envs
+from . import graphguard
+from . import paramserver
+from . import replay
+from . import returns
+from . import rollout
+from . import schedule
 from . import settings
+from . import sharedparams
+from . import stepcounter
+from . import summaries
 from . import utils
\ No newline at end of file
@@ -1,31 +1,54 @@
 # coding: utf-8
 import numpy as np
 import os
+import threading
 from os.path import join as pjoin
 
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+STREAMS = ["rewards", "random", "action", "observation", "diff", "rpe", "epsilon", "lr"]
+
 
 class callback():
 
-	def __init__(self, batch_size=100, saving_directory="./", observation_size=4, action_size=2):
+	def __init__(self, batch_size=100, saving_directory="./", observation_size=4, action_size=2, 
+				 backend="csv"):
+		"""
+		Parameters:
+			batch_size: number of steps stored before being written
+			saving_directory: directory of the files
+			observation_size: list, shape of an observation
+			action_size: number of heads of the actions
+			backend: "csv" to append to the CSV files in the process, "binary" to write .npy chunks 
+					 from a background thread (binary_writer). export_csv converts the chunks to the
+					 CSV files of the csv backend
+		"""
+
+		assert backend in ["csv", "binary"], "Unknown callback backend %s"%backend
 
 		self.batch_size = batch_size
+		self.observation_size = observation_size
+		self.action_size = action_size
+		self.backend = backend
 		self.counter = 0
-		self.rewards = np.zeros(batch_size)
-		self.random = np.zeros(batch_size)
-		self.action = np.zeros((batch_size, action_size))
-		self.observation = np.zeros([batch_size] + observation_size)
+		self.allocate()
 		self.diff = []
 		self.rpe = []
 		self.epsilon = []
 		self.lr = []
 
 		self.saving_directory = saving_directory
-		self.list_directory = ["rewards.csv", "random.csv", "action.csv", "observation.csv", 
-								"diff.csv", "rpe.csv", "epsilon.csv", "lr.csv"]
-		self.data = [self.rewards, self.random, self.action, self.observation,
-					 self.diff, self.rpe, self.epsilon, self.lr]
+		self.list_directory = [name + ".csv" for name in STREAMS]
 		self.init()
 
+		if backend == "binary":
+			self.writer = binary_writer(saving_directory)
+		else:
+			self.writer = None
+
 
 	def init(self):
 		if os.path.exists(self.saving_directory):
@@ -34,6 +57,12 @@ class callback():
 		else:
 			os.makedirs(self.saving_directory)
 
+	def allocate(self):
+		self.rewards = np.zeros(self.batch_size)
+		self.random = np.zeros(self.batch_size)
+		self.action = np.zeros((self.batch_size, self.action_size))
+		self.observation = np.zeros([self.batch_size] + self.observation_size)
+
 
 
 	def store(self, reward, random, action, observation, rewards):
@@ -58,18 +87,138 @@ class callback():
 
 	def write_history(self, history):
 		data = history.copy()
-		with open(pjoin(self.saving_directory, "history.csv"), 'ab') as writer:
-			np.savetxt(writer, data, delimiter=";")
+		if self.writer is not None:
+			self.writer.write([("history", data)])
+		else:
+			with open(pjoin(self.saving_directory, "history.csv"), 'ab') as writer:
+				np.savetxt(writer, data, delimiter=";")
 
 	def write_on_disk(self):
-		self.data = [self.rewards, self.random, self.action, self.observation, self.diff, self.rpe, self.epsilon, self.lr]
-		self.diff = np.array(self.diff)
-		for data, name in zip(self.data, self.list_directory):
-			with open(pjoin(self.saving_directory, name), 'ab') as writer:
-				np.savetxt(writer, data, delimiter=";")
+		buffers = (self.rewards, self.random, self.action, self.observation)
+		self.data = [buffer[:self.counter] for buffer in buffers] + \
+					[np.array(self.diff), np.array(self.rpe), np.array(self.epsilon), np.array(self.lr)]
+
+		if self.writer is not None:
+			# the buffers are handed to the writer thread, store continues in the other set
+			self.writer.write(list(zip(STREAMS, self.data)), buffers)
+			free = self.writer.recycle()
+			if free is None:
+				self.allocate()
+			else:
+				self.rewards, self.random, self.action, self.observation = free
+		else:
+			for data, name in zip(self.data, self.list_directory):
+				with open(pjoin(self.saving_directory, name), 'ab') as writer:
+					np.savetxt(writer, data, delimiter=";")
 		self.counter = 0
 		self.diff = []
 		self.rpe = []
 		self.epsilon = []
 		self.lr = []
 
+	def close(self):
+		"""
+		Write the steps stored since the last batch and wait for the writer thread
+		"""
+		if self.counter > 0 or self.diff or self.rpe or self.epsilon:
+			self.write_on_disk()
+		if self.writer is not None:
+			self.writer.close()
+
+
+class binary_writer():
+	"""
+	Background thread appending arrays to a directory as .npy chunks, one file per array written, 
+	named <stream>_<chunk number>.npy. Each chunk is recorded in index.csv as stream;file;rows, in 
+	the order of writing. The thread is started by the first write of each process, so a writer 
+	created before a fork works in the child. It is a daemon thread, so a process never waits for it
+	at exit: close writes the queued chunks.
+	"""
+
+	def __init__(self, saving_directory):
+		"""
+		Parameters:
+			saving_directory: directory of the chunks and of the index
+		"""
+		self.saving_directory = saving_directory
+		self.queue = queue.Queue()
+		self.free = queue.Queue()
+		self.chunks = {}
+		self.thread = None
+		self.pid = None
+
+	def start(self):
+		if self.pid != os.getpid():
+			self.pid = os.getpid()
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def write(self, arrays, buffers=None):
+		"""
+		Queue arrays to be written and return immediately
+		Parameters:
+			arrays: list of (stream name, np.array)
+			buffers: if not None, object given back by recycle once the arrays are written
+		"""
+		self.start()
+		self.queue.put((arrays, buffers))
+
+	def recycle(self):
+		"""
+		Return buffers given to write whose arrays are written, or None if there is none
+		"""
+		try:
+			return self.free.get_nowait()
+		except queue.Empty:
+			return None
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			arrays, buffers = item
+			for name, array in arrays:
+				self.append(name, array)
+			if buffers is not None:
+				self.free.put(buffers)
+
+	def append(self, name, array):
+		if len(array) == 0:
+			return
+		chunk = self.chunks.get(name, 0)
+		filename = "%s_%06d.npy"%(name, chunk)
+		np.save(pjoin(self.saving_directory, filename), array)
+		with open(pjoin(self.saving_directory, "index.csv"), 'a') as index:
+			index.write("%s;%s;%s\n"%(name, filename, len(array)))
+		self.chunks[name] = chunk + 1
+
+	def close(self):
+		"""
+		Write the queued arrays and stop the thread
+		"""
+		if (self.thread is not None) and (self.pid == os.getpid()):
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+			self.pid = None
+
+
+def export_csv(saving_directory):
+	"""
+	Concatenate the chunks written by the binary backend into the CSV files of the csv backend 
+	(rewards.csv, action.csv, ..., history.csv), read by the Dashboard
+	Parameters:
+		saving_directory: directory of a callback
+	"""
+	files = {}
+	with open(pjoin(saving_directory, "index.csv")) as index:
+		for line in index:
+			name, filename, rows = line.strip().split(";")
+			files.setdefault(name, []).append(filename)
+
+	for name, filenames in files.items():
+		data = np.concatenate([np.load(pjoin(saving_directory, filename)) for filename in filenames])
+		with open(pjoin(saving_directory, name + ".csv"), 'wb') as writer:
+			np.savetxt(writer, data, delimiter=";")
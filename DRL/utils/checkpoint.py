@@ -0,0 +1,306 @@
+# coding: utf-8
+import numpy as np
+import os
+import threading
+import time
+from os.path import join as pjoin
+
+from . import settings
+
+LATEST = "latest"
+
+
+def make_run_directory(checkpoints_path, prefix="Try_"):
+    """
+    Create a new directory for the checkpoints of a run and return its path. Its name is made of the
+    date and a counter, and os.mkdir fails if it exists, so two runs never share a directory.
+    Parameters:
+        checkpoints_path: directory of the runs, created if needed
+        prefix: prefix of the name of the run directory
+    """
+    if not os.path.exists(checkpoints_path):
+        os.makedirs(checkpoints_path)
+
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    i = 0
+    while True:
+        path = pjoin(checkpoints_path, "%s%s_%d"%(prefix, stamp, i))
+        try:
+            os.mkdir(path)
+            return path
+        except OSError:
+            if not os.path.exists(path):
+                raise
+        i += 1
+
+def latest_checkpoint(directory):
+    """
+    Return the path of the last checkpoint written in directory, read from its latest pointer, or
+    None if there is none
+    Parameters:
+        directory: run directory of a checkpoint_writer
+    """
+    try:
+        with open(pjoin(directory, LATEST)) as f:
+            return pjoin(directory, f.read().strip())
+    except IOError:
+        return None
+
+def is_checkpoint(path):
+    """
+    Return True if path is a checkpoint of a checkpoint_writer (a .npz file or a run directory),
+    False for the other paths, like the prefixes of tensorflow savers
+    """
+    return path.endswith(".npz") or os.path.isdir(path)
+
+def load_checkpoint(path):
+    """
+    Return the arrays of a checkpoint as a dictionary
+    Parameters:
+        path: .npz file, or run directory whose latest checkpoint is loaded
+    """
+    if os.path.isdir(path):
+        path = latest_checkpoint(path)
+        assert path is not None, "No checkpoint in this directory"
+    with np.load(path) as checkpoint:
+        return {key: checkpoint[key] for key in checkpoint.files}
+
+def capture_state(sess=None, **values):
+    """
+    Return the arrays of the training state of a process, to be saved with checkpoint_writer.save:
+    the variables of its tensorflow graph (optimiser slots, global step, decay steps...), the state
+    of np.random and values
+    Parameters:
+        sess: tensorflow session, or None if the process has no graph
+        values: numbers or arrays of the process, like epsilon
+    """
+    state = {"value/" + name: np.array(value) for name, value in values.items()}
+
+    rng = np.random.get_state()
+    state["rng/keys"] = rng[1]
+    state["rng/pos"] = np.array(rng[2])
+    state["rng/has_gauss"] = np.array(rng[3])
+    state["rng/cached_gaussian"] = np.array(rng[4])
+
+    if sess is not None:
+        import tensorflow as tf
+        variables = tf.global_variables()
+        for variable, value in zip(variables, sess.run(variables)):
+            state["graph/" + variable.name] = value
+
+    return state
+
+def restore_state(sess, state):
+    """
+    Restore the state captured by capture_state and return its values as a dictionary
+    Parameters:
+        sess: tensorflow session of the same graph, or None
+        state: dictionary of arrays, like the one returned by load_checkpoint
+    """
+    np.random.set_state(("MT19937", state["rng/keys"], int(state["rng/pos"]), 
+                         int(state["rng/has_gauss"]), float(state["rng/cached_gaussian"])))
+
+    if sess is not None:
+        import tensorflow as tf
+        for variable in tf.global_variables():
+            if "graph/" + variable.name in state:
+                variable.load(state["graph/" + variable.name], sess)
+
+    return {key[len("value/"):]: value for key, value in state.items() if key.startswith("value/")}
+
+def resume_shared_state(directory):
+    """
+    Load the latest checkpoint of a run into the shared state: T, theta, theta minus and the
+    statistics of the shared optimiser. It must be called after settings.init and before the
+    processes are started. Return the checkpoint
+    Parameters:
+        directory: run directory of the tester
+    """
+    checkpoint = load_checkpoint(directory)
+    settings.T.value = int(checkpoint["T"])
+
+    settings.l_theta.copy_from([checkpoint[key] for key in checkpoint["keys"]])
+    settings.l_theta.publish()
+
+    if "theta_minus/" + checkpoint["keys"][0] in checkpoint:
+        settings.l_theta_minus.publish([checkpoint["theta_minus/" + key] for key in checkpoint["keys"]])
+
+    optimizer = settings.shared_optimizer
+    if (optimizer is not None) and ("rmsprop/" + checkpoint["keys"][0] in checkpoint):
+        optimizer.g.copy_from([checkpoint["rmsprop/" + key] for key in checkpoint["keys"]])
+
+    return checkpoint
+
+
+class checkpoint_writer():
+    """
+    Background thread writing checkpoints of the shared weights, and of the training state of a
+    process (capture_state), into a directory.
+    save copies the weights in memory and returns immediately; only the last checkpoint not yet
+    written is kept, so a slow disk delays checkpoints instead of piling them up. Each checkpoint is
+    written to a temporary file and renamed, then the latest pointer is replaced the same way, so a
+    crash never leaves a partial checkpoint or a pointer to one. The n_keep last periodic checkpoints
+    are kept, the named ones (like the final weights) are never removed.
+    The thread is started by the first save of each process, like callback.binary_writer.
+    """
+
+    def __init__(self, directory, keys, n_keep=5):
+        """
+        Parameters:
+            directory: run directory, see make_run_directory
+            keys: names of the tensors, in the order of the weights (nn.keys). Empty if only states
+                  are saved
+            n_keep: number of periodic checkpoints kept
+        """
+        self.directory = directory
+        self.keys = list(keys)
+        self.n_keep = n_keep
+        self.condition = threading.Condition()
+        self.pending = None
+        self.writing = False
+        self.closed = False
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.closed = False
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def save(self, theta, step, name=None, state=None):
+        """
+        Copy the weights and queue their checkpoint. Return the path it will be written to
+        Parameters:
+            theta: sharedparams.ParameterBuffer or list of arrays, in the order of keys
+            step: global step T of the weights
+            name: name of the checkpoint. If None, a periodic checkpoint ckpt_<step>
+            state: dictionary of arrays saved with the weights, see capture_state
+        """
+        arrays = {key: np.array(value) for key, value in zip(self.keys, theta)}
+        if len(self.keys) > 0:
+            arrays["keys"] = np.array(self.keys)
+        arrays["T"] = np.array(step)
+        if state is not None:
+            arrays.update(state)
+        if name is None:
+            name = "ckpt_%010d"%step
+
+        self.start()
+        with self.condition:
+            self.pending = (name, arrays)
+            self.condition.notify()
+        return pjoin(self.directory, name + ".npz")
+
+    def run(self):
+        while True:
+            with self.condition:
+                while (self.pending is None) and (not self.closed):
+                    self.condition.wait()
+                if self.pending is None:
+                    break
+                name, arrays = self.pending
+                self.pending = None
+                self.writing = True
+
+            self.write(name, arrays)
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, name, arrays):
+        """
+        Write a checkpoint atomically, update the latest pointer and remove the old checkpoints
+        """
+        filename = name + ".npz"
+        temporary = pjoin(self.directory, "." + filename + ".tmp")
+        with open(temporary, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, pjoin(self.directory, filename))
+
+        temporary = pjoin(self.directory, "." + LATEST + ".tmp")
+        with open(temporary, "w") as f:
+            f.write(filename)
+        os.replace(temporary, pjoin(self.directory, LATEST))
+
+        periodic = sorted(f for f in os.listdir(self.directory)
+                          if f.startswith("ckpt_") and f.endswith(".npz"))
+        for filename in periodic[:max(len(periodic) - self.n_keep, 0)]:
+            os.remove(pjoin(self.directory, filename))
+
+    def flush(self):
+        """
+        Wait until the queued checkpoint is written
+        """
+        with self.condition:
+            while (self.pending is not None) or self.writing:
+                self.condition.wait()
+
+    def close(self):
+        """
+        Write the queued checkpoint and stop the thread
+        """
+        if (self.thread is not None) and (self.pid == os.getpid()):
+            with self.condition:
+                self.closed = True
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+            self.pid = None
+
+
+class state_writer():
+    """
+    Checkpoints of the training state of a slave (capture_state), written in its own directory
+    slave_<name> of the run directory each time the tester makes a checkpoint of the weights 
+    (settings.checkpoint_request), so that a resumed run restores every process.
+    """
+
+    def __init__(self, run_directory, name, n_keep=2):
+        """
+        Parameters:
+            run_directory: run directory of the tester
+            name: name of the slave
+            n_keep: number of checkpoints kept
+        """
+        self.directory = pjoin(run_directory, "slave_" + name)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.writer = checkpoint_writer(self.directory, [], n_keep)
+        self.request = 0
+
+    def due(self):
+        """
+        Return True if the tester made a checkpoint since the last state saved
+        """
+        return settings.checkpoint_request.value != self.request
+
+    def save(self, sess, step, **values):
+        """
+        Queue a checkpoint of the training state
+        Parameters:
+            sess: tensorflow session of the slave
+            step: global step T
+            values: numbers or arrays of the slave, like epsilon
+        """
+        self.request = settings.checkpoint_request.value
+        self.writer.save([], step, state=capture_state(sess, **values))
+
+    def restore(self, sess):
+        """
+        Restore the latest training state saved, and return its values, or None if there is none
+        Parameters:
+            sess: tensorflow session of the slave
+        """
+        if latest_checkpoint(self.directory) is None:
+            return None
+        self.request = settings.checkpoint_request.value
+        return restore_state(sess, load_checkpoint(self.directory))
+
+    def close(self):
+        self.writer.close()
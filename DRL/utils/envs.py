@@ -0,0 +1,73 @@
+# coding: utf-8
+import numpy as np
+
+
+class MultiEnv(object):
+    """
+    Run several gym environments side by side in the same process. Observations, rewards and dones
+    are returned as arrays with one row per environment, and an environment whose episode ended is
+    reset automatically.
+    """
+
+    def __init__(self, env_name, n_envs, decode_obs=None, seed=None):
+        """
+        Parameters:
+            env_name: name of gym environnment
+            n_envs: number of environments
+            decode_obs: function applied to each raw observation. If None, identity
+            seed: if not None, environment i is seeded with seed * n_envs + i
+        """
+        import gym
+
+        self.n_envs = n_envs
+        self.envs = [gym.make(env_name) for i in range(n_envs)]
+        self.decode_obs = decode_obs if decode_obs is not None else (lambda r: r)
+
+        if seed is not None:
+            for i, env in enumerate(self.envs):
+                env.seed(seed * n_envs + i)
+
+        self.episode_rewards = np.zeros(n_envs)
+        self.finished_rewards = []
+
+    def reset(self):
+        """
+        Reset all the environments and return their observations
+        """
+        self.episode_rewards[:] = 0
+        return np.stack([np.asarray(self.decode_obs(env.reset()), dtype=np.float32)
+                         for env in self.envs])
+
+    def step(self, actions):
+        """
+        Step every environment with its action. The returned observation of an environment whose
+        episode ended is the first observation of its next episode.
+        Parameters:
+            actions: list of actions, one per environment, in the format of env.step
+        """
+        observations = []
+        rewards = np.zeros(self.n_envs, dtype=np.float32)
+        dones = np.zeros(self.n_envs, dtype=np.float32)
+
+        for i, env in enumerate(self.envs):
+            observation, reward, done, info = env.step(actions[i])
+            self.episode_rewards[i] += reward
+            if done:
+                self.finished_rewards.append(self.episode_rewards[i])
+                self.episode_rewards[i] = 0
+                observation = env.reset()
+            observations.append(np.asarray(self.decode_obs(observation), dtype=np.float32))
+            rewards[i] = reward
+            dones[i] = done
+
+        return np.stack(observations), rewards, dones
+
+    def pop_finished_rewards(self):
+        """
+        Return the total rewards of the episodes finished since the last call
+        """
+        finished, self.finished_rewards = self.finished_rewards, []
+        return finished
+
+    def render(self):
+        self.envs[0].render()
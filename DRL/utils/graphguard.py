@@ -0,0 +1,56 @@
+# coding: utf-8
+import os
+import resource
+import sys
+import time
+
+
+def rss():
+    """
+    Return the resident set size of the process in bytes, read from /proc/self/statm, or the peak
+    resident set size where it does not exist
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class GraphGuard(object):
+    """
+    Opt-in report of the number of operations of the tensorflow graph of a process and of its
+    resident memory, printed every `every` seconds with their growth since the first check. The
+    graphs are finalized after their construction, so an op created in a training loop raises; the
+    report also catches the leaks outside of the graph.
+    """
+
+    def __init__(self, name, graph, every=60.):
+        """
+        Parameters:
+            name: name of the process in the reports
+            graph: tensorflow graph of the process
+            every: number of seconds between two reports
+        """
+        self.name = name
+        self.graph = graph
+        self.every = every
+        self.n_ops = len(graph.get_operations())
+        self.rss = rss()
+        self.last = time.time()
+
+    def check(self):
+        """
+        Print a report if the last one is older than every seconds
+        """
+        if time.time() - self.last < self.every:
+            return
+        self.last = time.time()
+
+        n_ops = len(self.graph.get_operations())
+        memory = rss()
+        print("Graph guard %s: %s ops (%+d), RSS %.1f MB (%+.1f MB)"%(self.name, n_ops,
+              n_ops - self.n_ops, memory / 2.**20, (memory - self.rss) / 2.**20))
+        if n_ops > self.n_ops:
+            print("WARNING: the graph of %s grew by %s ops"%(self.name, n_ops - self.n_ops))
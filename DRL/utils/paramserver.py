@@ -0,0 +1,464 @@
+# coding: utf-8
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from . import settings
+from .sharedparams import ParameterBuffer
+
+# Messages are a header (opcode or status, length of the payload) followed by the payload. The
+# weights, deltas and gradients are sent as raw float32 buffers in the order of the keys, the
+# integers and floats as network order structs
+HEADER = struct.Struct("!BI")
+INT = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+
+INFO, GET, SET, LOCK, UNLOCK, VERSION, PULL, PUSH, PUBLISH, APPLY = range(10)
+OK, ERROR = range(2)
+
+# Names of the shared objects in the requests
+VALUES = ["T", "checkpoint_request"]
+SNAPSHOTS = ["l_theta", "l_theta_minus"]
+
+
+class ServerLost(Exception):
+    """
+    Raised by a request when the connection to the parameter server is lost
+    """
+
+
+def recv_exactly(sock, n):
+    """
+    Read n bytes from sock, raise EOFError if it is closed before
+    """
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if count == 0:
+            raise EOFError("Connection closed")
+        received += count
+    return data
+
+def send_message(sock, code, payload=b""):
+    """
+    Send a header and its payload, a bytes-like object or a list of them
+    """
+    if not isinstance(payload, list):
+        payload = [payload]
+    length = sum(memoryview(part).nbytes for part in payload)
+    sock.sendall(HEADER.pack(code, length))
+    for part in payload:
+        sock.sendall(part)
+
+def recv_message(sock):
+    """
+    Return the code and the payload of the next message of sock
+    """
+    code, length = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return code, recv_exactly(sock, length)
+
+
+class ParameterHandler(socketserver.BaseRequestHandler):
+    """
+    Connection of a client to the parameter server: it serves the requests of the client until it
+    disconnects. The locks taken by the client are released when it disconnects. A request whose
+    payload does not have the size of its operation is rejected, and one larger than the largest 
+    operation closes the connection before anything is allocated.
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.held = []
+        self.buffers = {}
+        with self.server.clients.get_lock():
+            self.server.clients.value += 1
+
+    def handle(self):
+        while True:
+            try:
+                op, length = HEADER.unpack(recv_exactly(self.request, HEADER.size))
+                if length > self.server.max_payload:
+                    send_message(self.request, ERROR, b"Payload too large")
+                    break
+                payload = recv_exactly(self.request, length)
+            except (EOFError, ConnectionError):
+                break
+            try:
+                reply = self.dispatch(op, payload)
+            except Exception as e:
+                send_message(self.request, ERROR, str(e).encode())
+            else:
+                send_message(self.request, OK, reply)
+
+    def finish(self):
+        for lock in self.held:
+            lock.release()
+        with self.server.clients.get_lock():
+            self.server.clients.value -= 1
+
+    def buffer(self, name):
+        """
+        Return the ParameterBuffer in which the weights of name are copied before being sent
+        """
+        if name not in self.buffers:
+            self.buffers[name] = ParameterBuffer(getattr(settings, name).shapes)
+        return self.buffers[name]
+
+    def dispatch(self, op, payload):
+        """
+        Run a request on the shared state of settings and return the payload of the reply
+        """
+        if op not in self.server.sizes:
+            raise ValueError("Unknown operation %s"%op)
+        if len(payload) != self.server.sizes[op]:
+            raise ValueError("Payload of %s bytes instead of %s"%(len(payload), self.server.sizes[op]))
+
+        if op == INFO:
+            return json.dumps(self.server.info).encode()
+
+        if op in [GET, SET, LOCK, UNLOCK]:
+            value = getattr(settings, VALUES[payload[0]])
+            if op == GET:
+                return INT.pack(value.value)
+            if op == SET:
+                value.value = INT.unpack_from(payload, 1)[0]
+            elif op == LOCK:
+                value.get_lock().acquire()
+                self.held.append(value.get_lock())
+            else:
+                self.held.remove(value.get_lock())
+                value.get_lock().release()
+            return b""
+
+        if op in [VERSION, PULL]:
+            name = SNAPSHOTS[payload[0]]
+            snapshot = getattr(settings, name)
+            if op == VERSION:
+                return INT.pack(snapshot.version.value)
+            if snapshot.version.value == INT.unpack_from(payload, 1)[0]:
+                return INT.pack(snapshot.version.value)
+            buffer = self.buffer(name)
+            return [INT.pack(snapshot.snapshot(buffer)), buffer.flat]
+
+        if op == PUSH:
+            delta = ParameterBuffer(settings.l_theta.shapes, buffer=payload)
+            settings.l_theta.push_all(delta)
+            return INT.pack(settings.l_theta.publish())
+
+        if op == PUBLISH:
+            theta = ParameterBuffer(settings.l_theta_minus.shapes, buffer=payload)
+            return INT.pack(settings.l_theta_minus.publish(theta))
+
+        if op == APPLY:
+            learning_rate = FLOAT.unpack_from(payload)[0]
+            gradients = ParameterBuffer(settings.l_theta.shapes, buffer=payload[FLOAT.size:])
+            diff = settings.shared_optimizer.apply_all(gradients, learning_rate)
+            return [INT.pack(settings.l_theta.version.value), FLOAT.pack(diff)]
+
+        raise ValueError("Unknown operation %s"%op)
+
+
+class ParameterServer(socketserver.ThreadingTCPServer):
+    """
+    TCP server of the shared state of settings (T, checkpoint_request, l_theta, l_theta_minus and
+    the shared optimiser), one thread per client. Its threads update the shared memory like the
+    local processes, with the same push mode.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, algo, clients=None):
+        """
+        Parameters:
+            address: (host, port) the server listens on. Port 0 picks a free port
+            algo: algorithm of the run, checked by the clients
+            clients: multiprocessing.Value counting the connected clients. If None, a private one
+        """
+        socketserver.ThreadingTCPServer.__init__(self, address, ParameterHandler)
+        self.clients = clients if clients is not None else mp.Value('i', 0)
+
+        # Size of the payload of each operation
+        n_bytes = 4 * settings.l_theta.size
+        self.sizes = {INFO: 0, GET: 1, SET: 1 + INT.size, LOCK: 1, UNLOCK: 1, VERSION: 1, 
+                      PULL: 1 + INT.size, PUSH: n_bytes, PUBLISH: n_bytes, APPLY: FLOAT.size + n_bytes}
+        self.max_payload = max(self.sizes.values())
+        self.info = {"algo": algo, "shapes": [list(shape) for shape in settings.l_theta.shapes],
+                     "minus": algo != "a3c",
+                     "shared_optimizer": settings.shared_optimizer is not None}
+
+
+class parameter_server(mp.Process):
+    """
+    Process serving the shared state of settings over TCP (ParameterServer), so that slaves on other
+    hosts train the same weights (see remote.py). It must be started after settings.init, and
+    after the state of a resumed run is loaded.
+    The server has no authentication: any client can change T and the weights, so it listens on
+    the loopback interface unless a host is given explicitly, which should be on a trusted network.
+    """
+
+    def __init__(self, algo, port, host="127.0.0.1", **kwargs):
+        """
+        Parameters:
+            algo: algorithm of the run
+            port: port the server listens on
+            host: interface the server listens on, "" for all of them
+            kwargs: args of multiprocessing.Process
+        """
+        super(parameter_server, self).__init__(**kwargs)
+        self.algo = algo
+        self.address = (host, port)
+        self.clients = mp.Value('i', 0)
+        self.daemon = True
+
+    def run(self):
+        server = ParameterServer(self.address, self.algo, self.clients)
+        print("Parameter server listening on %s:%s"%server.server_address)
+        server.serve_forever()
+
+    def drain(self, timeout):
+        """
+        Wait until every client disconnected, for at most timeout seconds. Once the tester pushed T
+        past T_max, the remote slaves stop at their next flush of T
+        """
+        end = time.time() + timeout
+        while (self.clients.value > 0) and (time.time() < end):
+            time.sleep(0.1)
+
+
+class Connection(object):
+    """
+    Connection of a process to the parameter server. The socket is opened by the first request of
+    each process, so a Connection created before the processes are started gives every child its
+    own socket, like callback.binary_writer gives them their own thread.
+    If the server is lost, the request raises ServerLost, which the slaves turn into a stop with a
+    non zero exit code.
+    """
+
+    def __init__(self, address):
+        """
+        Parameters:
+            address: (host, port) of the parameter server
+        """
+        self.address = tuple(address)
+        self.sock = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def request(self, op, payload=b""):
+        """
+        Send a request and return the payload of its reply. Raise RuntimeError if the server failed,
+        ServerLost if it cannot be reached
+        """
+        with self.lock:
+            try:
+                if self.pid != os.getpid():
+                    self.sock = socket.create_connection(self.address)
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.pid = os.getpid()
+                send_message(self.sock, op, payload)
+                status, reply = recv_message(self.sock)
+            except (EOFError, OSError) as e:
+                self.pid = None
+                raise ServerLost("Parameter server %s:%s lost (%s)"%(self.address[0], self.address[1], e))
+        if status != OK:
+            raise RuntimeError("Parameter server: %s"%reply.decode())
+        return reply
+
+
+class RemoteLock(object):
+    """
+    Lock of a RemoteValue, held by the server until it is released or the client disconnects
+    """
+
+    def __init__(self, connection, index):
+        self.connection = connection
+        self.index = index
+
+    def acquire(self):
+        self.connection.request(LOCK, bytes([self.index]))
+        return True
+
+    def release(self):
+        self.connection.request(UNLOCK, bytes([self.index]))
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RemoteValue(object):
+    """
+    Integer of the parameter server with the interface of a multiprocessing.Value: value is read
+    and written on the server, and get_lock() locks it there
+    """
+
+    def __init__(self, connection, name):
+        """
+        Parameters:
+            connection: Connection to the parameter server
+            name: one of VALUES
+        """
+        self.connection = connection
+        self.index = VALUES.index(name)
+        self.lock = RemoteLock(connection, self.index)
+
+    @property
+    def value(self):
+        return INT.unpack(self.connection.request(GET, bytes([self.index])))[0]
+
+    @value.setter
+    def value(self, value):
+        self.connection.request(SET, bytes([self.index]) + INT.pack(value))
+
+    def get_lock(self):
+        return self.lock
+
+
+class RemoteVersion(object):
+    """
+    Version of weights of the parameter server, read like the version of SharedParameters
+    """
+
+    def __init__(self, connection, index):
+        self.connection = connection
+        self.index = index
+
+    @property
+    def value(self):
+        return INT.unpack(self.connection.request(VERSION, bytes([self.index])))[0]
+
+
+class RemoteParameters(ParameterBuffer):
+    """
+    Weights of the parameter server with the interface of SharedParameters. The buffer is a local
+    cache of the last version pulled: snapshot only transfers the weights if their version changed.
+    The pushes are added to a local delta, sent in one message by publish.
+    """
+
+    def __init__(self, connection, shapes, name="l_theta"):
+        """
+        Parameters:
+            connection: Connection to the parameter server
+            shapes: list of the shapes of the tensors, in the order of the sorted variables keys
+            name: one of SNAPSHOTS
+        """
+        super(RemoteParameters, self).__init__(shapes)
+        self.connection = connection
+        self.index = SNAPSHOTS.index(name)
+        self.version = RemoteVersion(connection, self.index)
+        self.cached = -1
+        self.delta = ParameterBuffer(shapes)
+        self.push_mode = "remote"
+
+    def push(self, i, delta):
+        """
+        Add delta to the i-th tensor of the delta sent by the next publish
+        """
+        np.add(self.delta[i], delta, out=self.delta[i], casting="unsafe")
+
+    def push_all(self, deltas):
+        for i, delta in enumerate(deltas):
+            self.push(i, delta)
+
+    def publish(self):
+        """
+        Send the pushed delta to the server, which adds it to the weights and increments their
+        version. Return the new version
+        """
+        reply = self.connection.request(PUSH, self.delta.flat)
+        self.delta.flat[:] = 0
+        return INT.unpack(reply)[0]
+
+    def snapshot(self, out):
+        """
+        Copy the weights into out and return their version, pulled from the server if it changed
+        Parameters:
+            out: ParameterBuffer with the same shapes
+        """
+        reply = self.connection.request(PULL, bytes([self.index]) + INT.pack(self.cached))
+        version = INT.unpack_from(reply)[0]
+        if len(reply) > INT.size:
+            self.flat[:] = np.frombuffer(reply, dtype=np.float32, offset=INT.size)
+            self.cached = version
+        if out is not self:
+            out.copy_from(self)
+        return version
+
+    def stats(self):
+        return {"mode": self.push_mode, "pushes": 0, "contention": 0, "lost_updates": 0}
+
+
+class RemoteSnapshotBuffer(RemoteParameters):
+    """
+    Theta minus of the parameter server with the interface of SnapshotBuffer
+    """
+
+    def __init__(self, connection, shapes):
+        super(RemoteSnapshotBuffer, self).__init__(connection, shapes, "l_theta_minus")
+
+    def publish(self, theta):
+        """
+        Send theta to the server as the new theta minus. Return the new version
+        Parameters:
+            theta: ParameterBuffer with the same shapes, or list of arrays
+        """
+        self.delta.copy_from(theta)
+        return INT.unpack(self.connection.request(PUBLISH, self.delta.flat))[0]
+
+
+class RemoteRMSProp(object):
+    """
+    Shared optimiser of the parameter server with the interface of SharedRMSProp: the gradients are
+    sent in one message and applied by the server
+    """
+
+    def __init__(self, connection, shapes):
+        self.connection = connection
+        self.gradients = ParameterBuffer(shapes)
+
+    def apply_all(self, gradients, learning_rate):
+        """
+        Apply a gradient to every tensor and return the sum of the norms of the updates
+        Parameters:
+            gradients: ParameterBuffer, or list of arrays in the order of the tensors
+            learning_rate: learning rate of the update
+        """
+        if not isinstance(gradients, ParameterBuffer):
+            gradients = self.gradients.copy_from(gradients)
+        reply = self.connection.request(APPLY, [FLOAT.pack(learning_rate), gradients.flat])
+        return FLOAT.unpack_from(reply, INT.size)[0]
+
+
+def connect(address):
+    """
+    Replace the shared state of settings by the one of the parameter server at address, instead of
+    settings.init. It must be called before the processes are started. Return the description of
+    the run sent by the server: algo, shapes, minus and shared_optimizer
+    Parameters:
+        address: (host, port) of the parameter server
+    """
+    connection = Connection(address)
+    info = json.loads(connection.request(INFO).decode())
+
+    settings.T = RemoteValue(connection, "T")
+    settings.checkpoint_request = RemoteValue(connection, "checkpoint_request")
+    settings.l_theta = RemoteParameters(connection, info["shapes"])
+    if info["minus"]:
+        settings.l_theta_minus = RemoteSnapshotBuffer(connection, info["shapes"])
+    if info["shared_optimizer"]:
+        settings.shared_optimizer = RemoteRMSProp(connection, info["shapes"])
+    else:
+        settings.shared_optimizer = None
+
+    return info
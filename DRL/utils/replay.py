@@ -0,0 +1,222 @@
+# coding: utf-8
+import multiprocessing as mp
+import numpy as np
+import os
+import shutil
+import tempfile
+from os.path import join as pjoin
+
+from . import settings
+from .returns import discounted_returns
+
+
+class PrioritizedReplay(object):
+    """
+    Fixed capacity replay buffer of n step transitions (observation, action, reward, next_observation,
+    discount), where the target of a transition is reward + discount * max_a Q(next_observation, a).
+    Each field is a memory-mapped file (structure of arrays), so a large buffer lives in the page
+    cache instead of the memory of the processes. Transitions are sampled with a probability
+    proportional to priority^alpha, using a sum tree also memory-mapped: sampling and updating a
+    batch cost O(batch_size * log(capacity)).
+    It must be created before the processes are started: the children share the mappings, the
+    write position and the lock.
+    """
+
+    def __init__(self, capacity, observation_size, directory=None, alpha=0.6, beta=0.4, epsilon=1e-6):
+        """
+        Parameters:
+            capacity: maximum number of transitions, the oldest ones are overwritten
+            observation_size: list, shape of an observation
+            directory: directory of the memory-mapped files. If None, a temporary one, removed by
+                       cleanup()
+            alpha: exponent of the priorities, 0 gives uniform sampling
+            beta: exponent of the importance sampling weights
+            epsilon: added to the absolute TD errors so that every transition can be sampled
+        """
+        self.capacity = capacity
+        self.observation_size = list(observation_size)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+
+        self.temporary = directory is None
+        if self.temporary:
+            self.directory = tempfile.mkdtemp(prefix="replay_")
+        else:
+            self.directory = directory
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        shape = [capacity] + self.observation_size
+        self.observations = self.memmap("observations", np.float32, shape)
+        self.actions = self.memmap("actions", np.int64, [capacity])
+        self.rewards = self.memmap("rewards", np.float32, [capacity])
+        self.next_observations = self.memmap("next_observations", np.float32, shape)
+        self.discounts = self.memmap("discounts", np.float32, [capacity])
+
+        # Leaves of the sum tree are the nodes tree_size..2*tree_size-1, node i sums 2i and 2i+1
+        self.tree_size = 1 << max(capacity - 1, 0).bit_length()
+        self.tree = self.memmap("priorities", np.float64, [2 * self.tree_size])
+
+        self.lock = mp.Lock()
+        self.position = mp.RawValue('l', 0)
+        self.size = mp.RawValue('l', 0)
+        self.max_priority = mp.RawValue('d', 1.)
+
+    def memmap(self, name, dtype, shape):
+        return np.memmap(pjoin(self.directory, name + ".dat"), dtype=dtype, mode="w+",
+                         shape=tuple(shape))
+
+    def __len__(self):
+        return self.size.value
+
+    def add(self, observations, actions, rewards, next_observations, discounts):
+        """
+        Store a batch of transitions with the maximum priority seen so far. Return their indices.
+        Parameters:
+            observations: np.array of shape (batch_size,) + observation_size
+            actions: np.array of int of shape (batch_size,)
+            rewards: np.array of shape (batch_size,), discounted sum of the rewards of the n steps
+            next_observations: np.array of shape (batch_size,) + observation_size, state reached
+                               after the n steps
+            discounts: np.array of shape (batch_size,), gamma^n, 0 if the episode ended
+        """
+        n = len(rewards)
+        assert n <= self.capacity, "Batch larger than the replay buffer"
+
+        with self.lock:
+            indices = (self.position.value + np.arange(n)) % self.capacity
+            self.position.value = (self.position.value + n) % self.capacity
+            self.size.value = min(self.size.value + n, self.capacity)
+
+            self.observations[indices] = np.reshape(observations, [n] + self.observation_size)
+            self.actions[indices] = np.reshape(actions, n)
+            self.rewards[indices] = rewards
+            self.next_observations[indices] = np.reshape(next_observations, [n] + self.observation_size)
+            self.discounts[indices] = discounts
+
+            self.set_priorities(indices, np.full(n, self.max_priority.value))
+
+        return indices
+
+    def sample(self, batch_size):
+        """
+        Sample a batch of transitions with probabilities proportional to their priorities, one in
+        each of batch_size equal slices of the total priority. Return their indices, their importance
+        sampling weights normalised by their maximum, and the tuple (observations, actions, rewards,
+        next_observations, discounts).
+        Parameters:
+            batch_size: number of transitions
+        """
+        assert len(self) > 0, "Empty replay buffer"
+
+        with self.lock:
+            total = self.tree[1]
+            values = (np.arange(batch_size) + np.random.rand(batch_size)) * total / batch_size
+
+            nodes = np.ones(batch_size, dtype=np.int64)
+            while nodes[0] < self.tree_size:
+                left = 2 * nodes
+                go_right = values >= self.tree[left]
+                values = values - np.where(go_right, self.tree[left], 0.)
+                nodes = left + go_right
+
+            # rounding errors may reach an empty leaf after the last transition
+            indices = np.minimum(nodes - self.tree_size, self.size.value - 1)
+            priorities = self.tree[indices + self.tree_size]
+
+            batch = (self.observations[indices], self.actions[indices], self.rewards[indices],
+                     self.next_observations[indices], self.discounts[indices])
+            size = self.size.value
+
+        weights = (size * priorities / total) ** (-self.beta)
+        weights = (weights / np.max(weights)).astype(np.float32)
+
+        return indices, weights, batch
+
+    def update_priorities(self, indices, td_errors):
+        """
+        Set the priorities of sampled transitions from their new TD errors
+        Parameters:
+            indices: np.array of int, indices returned by sample
+            td_errors: np.array with the shape of indices
+        """
+        priorities = (np.abs(td_errors) + self.epsilon) ** self.alpha
+        with self.lock:
+            self.set_priorities(indices, priorities)
+            self.max_priority.value = max(self.max_priority.value, float(np.max(priorities)))
+
+    def set_priorities(self, indices, priorities):
+        """
+        Write the leaves of the sum tree and update their ancestors one level at a time.
+        Must be called with the lock.
+        """
+        nodes = np.asarray(indices, dtype=np.int64) + self.tree_size
+        self.tree[nodes] = priorities
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def cleanup(self):
+        """
+        Remove the files of a temporary buffer
+        """
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def nstep_transitions(rewards, dones, gamma):
+    """
+    Return the rewards and the discounts of the n step transitions going from each step of a rollout
+    to its last state: R_t = sum_k gamma^k r_{t+k} and discount_t = gamma^(T-t), or 0 when an
+    episode ended in between.
+    Parameters:
+        rewards: np.array of shape (T,) or (T, n_envs), rewards in time order
+        dones: np.array with the shape of rewards, 1 where the episode ended at this step
+        gamma: depreciation of the futur
+    """
+    dones = np.asarray(dones, dtype=np.float32)
+    T = len(rewards)
+    returns = discounted_returns(rewards, dones, 0., gamma)
+
+    steps = np.arange(T, 0, -1).reshape((T,) + (1,) * (dones.ndim - 1))
+    ended = np.cumsum(dones[::-1], axis=0)[::-1] > 0
+    discounts = np.where(ended, 0., gamma ** steps).astype(np.float32)
+    return returns, discounts
+
+def train_on_replay(nn, actor, sess, replay, theta, batch_size, T=None):
+    """
+    Make one update of a Q network on a prioritized batch of the replay buffer, push it to the shared
+    weights and update the priorities of the batch. The targets use theta minus. Return the sum of
+    the norms of the update.
+    Parameters:
+        nn: qnn.QNeuralNetwork, initialised
+        actor: nn or its numpynn engine, used to compute the targets
+        sess: tensorflow session
+        replay: PrioritizedReplay
+        theta: ParameterBuffer, filled with the current shared weights before the update
+        batch_size: number of transitions of the batch
+        T: global step. If not None, the learning rate of nn.schedule at T is used
+    """
+    indices, weights, batch = replay.sample(batch_size)
+    observations, actions, rewards, next_observations, discounts = batch
+
+    nn.load_snapshot(sess, settings.l_theta_minus, "theta_minus")
+    targets = rewards + discounts * np.max(actor.forward(next_observations, sess), axis=1)
+
+    theta = nn.assign_value_to_theta_prime(theta)
+    nn.read_value_from_theta(sess, theta)
+
+    feed_dict = {nn.variables["input_observation"]: observations.reshape((batch_size, -1)),
+                 nn.variables["y_true"]: targets,
+                 nn.variables["y_action"]: np.eye(nn.output_size, dtype=np.float32)[actions],
+                 nn.variables["sample_weights"]: weights}
+    if T is not None:
+        feed_dict[nn.decay_learning_rate] = nn.schedule(T)
+    results = sess.run([nn.td_errors] + nn.update_fetches, feed_dict=feed_dict)
+
+    diff = nn.push_update(results[1:], T)
+    td_errors = results[0]
+    replay.update_priorities(indices, td_errors)
+
+    return diff
@@ -0,0 +1,145 @@
+# coding: utf-8
+import numpy as np
+
+# Above this rollout length, the T x T discount matrix costs more than a loop over time
+MAX_MATRIX_LENGTH = 256
+# Up to this number of rewards (T * n_envs), a loop on Python floats beats the NumPy kernels
+MAX_PYTHON_SIZE = 128
+# Number of discount matrices kept by _discount_matrix, the oldest one is evicted first
+MAX_CACHED_MATRICES = 32
+
+_discount_matrices = {}
+
+
+def discounted_returns(rewards, dones, bootstrap, gamma):
+    """
+    Compute the n step discounted returns R_t = r_t + gamma * R_{t+1} of one or several rollouts.
+    The sum is cut after a step where the episode ended, and the last return is completed by the
+    bootstrap value unless the rollout ended with a done.
+    A single rollout, or a small batch (up to MAX_PYTHON_SIZE rewards, e.g. t_max=5 with 16
+    environments), is computed by a loop on Python floats, the fastest for the short rollouts of
+    the slaves; a larger batch by a product with the discount matrix, or a loop over time
+    vectorized over the environments when the rollouts are long.
+    Parameters:
+        rewards: np.array of shape (T,) or (T, n_envs), rewards in time order
+        dones: np.array with the shape of rewards, 1 where the episode ended at this step
+        bootstrap: float or np.array of shape (n_envs,), estimated value of the state reached
+                   after the last step
+        gamma: depreciation of the futur
+    """
+    if np.ndim(rewards) == 1:
+        return _discounted_returns_scalar(rewards, dones, bootstrap, gamma)
+    if np.size(rewards) <= MAX_PYTHON_SIZE:
+        return _discounted_returns_columns(rewards, dones, bootstrap, gamma)
+
+    rewards = np.asarray(rewards, dtype=np.float64)
+    dones = np.asarray(dones, dtype=np.float64).reshape(rewards.shape)
+    bootstrap = np.broadcast_to(np.asarray(bootstrap, dtype=np.float64), rewards.shape[1:])
+
+    if len(rewards) > MAX_MATRIX_LENGTH:
+        returns = _discounted_returns_loop(rewards, dones, bootstrap, gamma)
+    else:
+        returns = _discounted_returns_matrix(rewards, dones, bootstrap, gamma)
+
+    return returns.astype(np.float32)
+
+def lambda_returns(rewards, values, dones, bootstrap, gamma, lam=1.):
+    """
+    Compute the lambda-returns G_t = r_t + gamma * ((1 - lam) * V(s_{t+1}) + lam * G_{t+1}) of one
+    or several rollouts, as the discounted sum (with gamma * lam) of the TD errors plus the values.
+    lam=1 gives the n step returns of discounted_returns, lam=0 the 1 step TD targets.
+    Parameters:
+        rewards: np.array of shape (T,) or (T, n_envs), rewards in time order
+        values: np.array with the shape of rewards, estimated values V(s_t) of the visited states
+        dones: np.array with the shape of rewards, 1 where the episode ended at this step
+        bootstrap: float or np.array of shape (n_envs,), estimated value of the state reached
+                   after the last step
+        gamma: depreciation of the futur
+        lam: lambda of the returns, between 0 and 1
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(rewards.shape)
+    dones = np.asarray(dones, dtype=np.float64).reshape(rewards.shape)
+    bootstrap = np.broadcast_to(np.asarray(bootstrap, dtype=np.float64), rewards.shape[1:])
+
+    next_values = np.concatenate([values[1:], bootstrap[None]], axis=0)
+    deltas = rewards + gamma * next_values * (1. - dones) - values
+
+    return discounted_returns(deltas, dones, 0., gamma * lam) + values.astype(np.float32)
+
+def _discount_matrix(T, gamma):
+    """
+    Return the (T, T+1) matrix D[i, j] = gamma^(j-i) if j >= i else 0, cached by (T, gamma)
+    """
+    key = (T, gamma)
+    if key not in _discount_matrices:
+        if len(_discount_matrices) >= MAX_CACHED_MATRICES:
+            del _discount_matrices[next(iter(_discount_matrices))]
+        exponent = np.arange(T + 1)[None, :] - np.arange(T)[:, None]
+        _discount_matrices[key] = np.where(exponent >= 0, gamma ** np.maximum(exponent, 0), 0.)
+    return _discount_matrices[key]
+
+def _discounted_returns_matrix(rewards, dones, bootstrap, gamma):
+    """
+    Vectorized version. The returns H ignoring the episode boundaries are a single product with the 
+    discount matrix; then, for a step i whose episode ends at step e, the part of the sum coming 
+    after e is removed: R_i = H_i - gamma^(e+1-i) * H_{e+1}.
+    """
+    T = len(rewards)
+    values = np.concatenate([rewards, bootstrap[None]], axis=0)
+    H = _discount_matrix(T, gamma).dot(values.reshape((T + 1, -1))).reshape(rewards.shape)
+
+    if not dones.any():
+        return H
+
+    # end[i] = first step >= i where the episode ended, T if there is none
+    steps = np.arange(T).reshape((T,) + (1,) * (rewards.ndim - 1))
+    end = np.where(dones > 0, steps, T)
+    end = np.minimum.accumulate(end[::-1], axis=0)[::-1]
+
+    H_next = np.concatenate([H, bootstrap[None]], axis=0)
+    after_end = np.take_along_axis(H_next, np.minimum(end + 1, T), axis=0)
+    correction = np.where(end < T, gamma ** (end + 1 - steps) * after_end, 0.)
+    return H - correction
+
+def _discounted_returns_loop(rewards, dones, bootstrap, gamma):
+    """
+    Loop over time, vectorized over the environments. Used for long rollouts.
+    """
+    returns = np.zeros(rewards.shape)
+    R = np.array(bootstrap, dtype=np.float64)
+    for i in range(len(rewards) - 1, -1, -1):
+        R = rewards[i] + gamma * R * (1. - dones[i])
+        returns[i] = R
+    return returns
+
+def _discounted_returns_scalar(rewards, dones, bootstrap, gamma):
+    """
+    Loop over time on Python floats, for a single rollout. The short rollouts of the single
+    environment slaves are faster this way than with the NumPy kernels.
+    """
+    return np.array(_returns_list(np.asarray(rewards).tolist(), np.asarray(dones).tolist(),
+                                  np.asarray(bootstrap).item(), gamma), dtype=np.float32)
+
+def _discounted_returns_columns(rewards, dones, bootstrap, gamma):
+    """
+    Loop over time on Python floats, for each environment of a small batch of rollouts
+    """
+    rewards = np.asarray(rewards)
+    dones = np.asarray(dones).reshape(rewards.shape)
+    bootstrap = np.broadcast_to(np.asarray(bootstrap, dtype=np.float64), rewards.shape[1:])
+    returns = [_returns_list(r, d, R, gamma) for r, d, R in zip(rewards.T.tolist(), dones.T.tolist(),
+                                                                bootstrap.tolist())]
+    return np.array(returns, dtype=np.float32).T
+
+def _returns_list(rewards, dones, R, gamma):
+    """
+    Discounted returns of a rollout given as lists, R being the bootstrap value
+    """
+    returns = [0.] * len(rewards)
+    for i in range(len(rewards) - 1, -1, -1):
+        if dones[i]:
+            R = 0.
+        R = rewards[i] + gamma * R
+        returns[i] = R
+    return returns
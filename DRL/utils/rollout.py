@@ -0,0 +1,126 @@
+# coding: utf-8
+import numpy as np
+
+
+class RolloutBuffer(object):
+    """
+    Preallocated storage for the transitions collected by a slave between two updates. Arrays are
+    allocated once for the maximum length of a rollout and filled in place; the properties return
+    views on the filled part, which can be given to a feed_dict without any copy.
+    Row i of observations is the state in which action i was taken, row i+1 the next state.
+    With n_envs, every array has a second axis for the environments stepped side by side, and the
+    batch_* properties merge the time and environment axes for the feed_dict.
+    """
+
+    def __init__(self, t_max, observation_size, action_size, n_envs=None):
+        """
+        Parameters:
+            t_max: maximum number of transitions in a rollout
+            observation_size: list, shape of an observation
+            action_size: list, number of possible actions for each head of the network
+            n_envs: number of environments stored side by side. If None, a single one without
+                    environment axis
+        """
+        self.t_max = t_max
+        self.action_size = list(action_size)
+        self.observation_size = list(observation_size)
+        self.env_shape = [] if n_envs is None else [n_envs]
+
+        self.all_observations = np.zeros([t_max + 1] + self.env_shape + self.observation_size, 
+                                         dtype=np.float32)
+        self.all_actions = np.zeros([t_max] + self.env_shape + [len(self.action_size)], dtype=np.int64)
+        self.all_actions_one_hot = [np.zeros([t_max] + self.env_shape + [n], dtype=np.float32) 
+                                    for n in self.action_size]
+        self.all_rewards = np.zeros([t_max] + self.env_shape, dtype=np.float32)
+        self.all_dones = np.zeros([t_max] + self.env_shape, dtype=np.float32)
+        self.all_targets = np.zeros([t_max] + self.env_shape, dtype=np.float32)
+
+        self.t = 0
+
+    def reset(self, observation):
+        """
+        Empty the buffer and store the first state of the next rollout
+        Parameters:
+            observation: np.array, current state of the environment(s)
+        """
+        for one_hot in self.all_actions_one_hot:
+            one_hot[:self.t] = 0.
+        self.t = 0
+        self.all_observations[0] = np.reshape(observation, self.all_observations.shape[1:])
+
+    def store(self, action, reward, done, observation):
+        """
+        Store a transition
+        Parameters:
+            action: int, or list of int with one action per head. With n_envs, array of shape 
+                    (n_envs, n_heads)
+            reward: reward received, array of shape (n_envs,) with n_envs
+            done: True if the episode ended with this transition, array of shape (n_envs,) with n_envs
+            observation: np.array, state(s) reached after the action
+        """
+        assert self.t < self.t_max, "Rollout buffer is full"
+
+        t = self.t
+        self.all_actions[t] = action
+        for i, one_hot in enumerate(self.all_actions_one_hot):
+            np.put_along_axis(one_hot[t], self.all_actions[t, ..., i:i+1], 1., axis=-1)
+        self.all_rewards[t] = reward
+        self.all_dones[t] = done
+        self.all_observations[t + 1] = np.reshape(observation, self.all_observations.shape[1:])
+        self.t += 1
+
+    @property
+    def observation(self):
+        """
+        Last state stored, in which the next action will be taken
+        """
+        return self.all_observations[self.t]
+
+    @property
+    def observations(self):
+        return self.all_observations[:self.t]
+
+    @property
+    def next_observations(self):
+        return self.all_observations[1:self.t + 1]
+
+    @property
+    def actions(self):
+        return self.all_actions[:self.t]
+
+    @property
+    def actions_one_hot(self):
+        return [one_hot[:self.t] for one_hot in self.all_actions_one_hot]
+
+    @property
+    def rewards(self):
+        return self.all_rewards[:self.t]
+
+    @property
+    def dones(self):
+        return self.all_dones[:self.t]
+
+    @property
+    def targets(self):
+        """
+        Training targets (returns) of the transitions, written in place by the slaves
+        """
+        return self.all_targets[:self.t]
+
+    def merge_axes(self, array):
+        """
+        Merge the time and environment axes of an array of the buffer, without copy
+        """
+        return array.reshape((-1,) + array.shape[1 + len(self.env_shape):])
+
+    @property
+    def batch_observations(self):
+        return self.merge_axes(self.observations)
+
+    @property
+    def batch_actions_one_hot(self):
+        return [self.merge_axes(one_hot) for one_hot in self.actions_one_hot]
+
+    @property
+    def batch_targets(self):
+        return self.merge_axes(self.targets)
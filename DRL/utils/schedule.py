@@ -0,0 +1,46 @@
+# coding: utf-8
+
+
+class LearningRateSchedule(object):
+    """
+    Learning rate of a network computed on the host from the global step T, and fed to its train
+    step, so that following T costs no session call. The step of the decay is T - T_reset, where T_reset
+    is the T of the last reset:
+        exponential: learning_rate * decay_rate^(step / decay_steps)
+        linear: learning_rate * (1 - (1 - decay_rate) * step / decay_steps)
+    Each reset doubles decay_steps, the decay restarting from learning_rate.
+    """
+
+    DECAYS = ["exponential", "linear"]
+
+    def __init__(self, learning_rate, decay="exponential", decay_rate=0.999):
+        """
+        Parameters:
+            learning_rate: learning rate at the beginning and after a reset
+            decay: one of DECAYS
+            decay_rate: decay of the learning rate for decay_steps steps
+        """
+        assert decay in self.DECAYS, "Unknown decay %s"%decay
+
+        self.learning_rate = learning_rate
+        self.decay = decay
+        self.decay_rate = decay_rate
+        self.decay_steps = 1
+        self.T_reset = 0
+
+    def __call__(self, T):
+        """
+        Return the learning rate at the global step T
+        """
+        step = float(T - self.T_reset) / self.decay_steps
+        if self.decay == "exponential":
+            return self.learning_rate * self.decay_rate ** step
+        return self.learning_rate * (1 - (1 - self.decay_rate) * step)
+
+    def reset(self, T):
+        """
+        Restart the decay from the global step T, twice slower
+        """
+        print("Reset")
+        self.T_reset = T
+        self.decay_steps *= 2
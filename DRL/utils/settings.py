@@ -2,20 +2,32 @@
 import multiprocessing as mp
 
 from .utils import initialise, initialise_a3c
+from .sharedparams import SharedRMSProp, SnapshotBuffer
 
-def init(algo="nstep", n_hidden=1, hidden_size=[16],input_size=4, output_size=2):
+def init(algo="nstep", n_hidden=1, hidden_size=[16],input_size=4, output_size=2, push_mode="hogwild",
+		 optimizer="rmsprop"):
 	if algo == "a3c":
-		global T, l_theta
+		global T, l_theta, checkpoint_request, shared_optimizer
 	else:
-		global T, l_theta, l_theta_minus
+		global T, l_theta, l_theta_minus, checkpoint_request, shared_optimizer
 
 	T = mp.Value('i', 0)
+	# Incremented by the tester at each checkpoint, the slaves then save their training state
+	checkpoint_request = mp.Value('l', 0)
 
 	if algo == "a3c":
 		l_theta = initialise_a3c(n_hidden=n_hidden, hidden_size=hidden_size, input_size=input_size, 
-							 	 output_size=output_size)
+							 	 output_size=output_size, push_mode=push_mode)
 	else:
 		l_theta = initialise(n_hidden=n_hidden, hidden_size=hidden_size, input_size=input_size, 
-							 output_size=output_size)
-		l_theta_minus = initialise(n_hidden=n_hidden, hidden_size=hidden_size, input_size=input_size, 
-								   output_size=output_size)
+							 output_size=output_size, push_mode=push_mode)
+		l_theta_minus = SnapshotBuffer(l_theta.shapes)
+		l_theta_minus.publish(l_theta)
+
+	# "rmsprop": each network has its own optimiser. "shared_rmsprop": the statistics of the 
+	# optimiser are shared next to l_theta and the networks only compute gradients
+	assert optimizer in ["rmsprop", "shared_rmsprop"], "Unknown optimizer %s"%optimizer
+	if optimizer == "shared_rmsprop":
+		shared_optimizer = SharedRMSProp(l_theta)
+	else:
+		shared_optimizer = None
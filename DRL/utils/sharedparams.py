@@ -0,0 +1,309 @@
+# coding: utf-8
+import numpy as np
+import multiprocessing as mp
+
+
+class ParameterBuffer(object):
+    """
+    List-like container for the weights and biases of a network. All the parameters are stored in
+    one flat float32 buffer, and element i is a NumPy view with the shape of the i-th tensor, so
+    reading or writing a layer never copies the other ones.
+    """
+
+    def __init__(self, shapes, buffer=None):
+        """
+        Parameters:
+            shapes: list of the shapes of the tensors, in the order of the sorted variables keys
+            buffer: object exposing the buffer protocol holding at least sum(sizes) float32.
+                    If None, a private NumPy array is allocated
+        """
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.cumsum([0] + self.sizes)
+        self.size = int(self.offsets[-1])
+
+        if buffer is None:
+            self.flat = np.zeros(self.size, dtype=np.float32)
+        else:
+            self.flat = np.frombuffer(buffer, dtype=np.float32, count=self.size)
+
+        self.views = [self.flat[self.offsets[i]:self.offsets[i+1]].reshape(shape)
+                      for i, shape in enumerate(self.shapes)]
+
+        # Version of the snapshot last copied by pull, None if the values come from elsewhere
+        self.pulled = None
+
+    def __len__(self):
+        return len(self.views)
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __getitem__(self, i):
+        return self.views[i]
+
+    def __setitem__(self, i, value):
+        self.views[i][...] = value
+
+    def copy_from(self, theta):
+        """
+        Copy the values of theta into this buffer, in place
+        Parameters:
+            theta: ParameterBuffer with the same shapes, or list of arrays
+        """
+        if isinstance(theta, ParameterBuffer):
+            np.copyto(self.flat, theta.flat)
+        else:
+            for i, value in enumerate(theta):
+                self.views[i][...] = value
+        self.pulled = None
+        return self
+
+    def pull(self, snapshot):
+        """
+        Copy the weights of a versioned snapshot into this buffer, unless it already holds their 
+        current version. Return True if they were copied
+        Parameters:
+            snapshot: SharedParameters or SnapshotBuffer, always the same one for a given buffer
+        """
+        if (self.pulled is not None) and (self.pulled == snapshot.version.value):
+            return False
+        self.pulled = snapshot.snapshot(self)
+        return True
+
+
+class SharedParameters(ParameterBuffer):
+    """
+    ParameterBuffer whose flat buffer lives in shared memory. It must be created before the
+    processes are started: children inherit the same memory, so the views are zero-copy in every
+    process and a pull or a push is a plain memcpy.
+
+    Pushes (push/push_all) add a delta into the shared tensors with one of the PUSH_MODES:
+        hogwild: lock-free in-place add. Concurrent pushes on the same tensor may lose elements.
+        striped: one lock per tensor, so two slaves only wait on each other when they write the 
+                 same tensor at the same time.
+    Per-tensor counters of pushes, contended lock acquisitions and overlapping (possibly lost) 
+    hogwild updates are kept in shared memory and summed by stats().
+    version is a shared counter incremented by publish() when a set of pushes is complete, so the 
+    readers can tell that the weights changed.
+    """
+
+    PUSH_MODES = ["hogwild", "striped"]
+
+    def __init__(self, shapes, push_mode="hogwild"):
+        """
+        Parameters:
+            shapes: list of the shapes of the tensors, in the order of the sorted variables keys
+            push_mode: one of PUSH_MODES
+        """
+        assert push_mode in self.PUSH_MODES, "Unknown push mode %s"%push_mode
+
+        size = int(np.sum([np.prod(shape) for shape in shapes]))
+        self.raw = mp.RawArray('f', max(size, 1))
+        super(SharedParameters, self).__init__(shapes, buffer=self.raw)
+
+        self.push_mode = push_mode
+        self.locks = [mp.Lock() for i in range(len(self.shapes))]
+
+        # One row per tensor: sequence number, pushes, contentions, lost updates
+        self.raw_counters = mp.RawArray('q', 4 * max(len(self.shapes), 1))
+        self.counters = np.frombuffer(self.raw_counters, dtype=np.int64).reshape((-1, 4))
+
+        self.version = mp.Value('l', 0)
+
+    def push(self, i, delta):
+        """
+        Add delta to the i-th tensor, following self.push_mode
+        Parameters:
+            i: index of the tensor
+            delta: array with the shape of the tensor
+        """
+        view = self.views[i]
+        counters = self.counters[i]
+
+        if self.push_mode == "striped":
+            if not self.locks[i].acquire(False):
+                self.locks[i].acquire()
+                counters[2] += 1
+            try:
+                np.add(view, delta, out=view, casting="unsafe")
+                counters[0] += 1
+                counters[1] += 1
+            finally:
+                self.locks[i].release()
+        else:
+            seq = counters[0]
+            np.add(view, delta, out=view, casting="unsafe")
+            if counters[0] != seq:
+                counters[3] += 1
+            counters[0] += 1
+            counters[1] += 1
+
+    def push_all(self, deltas):
+        """
+        Add a delta to every tensor
+        Parameters:
+            deltas: list of arrays, in the order of the tensors
+        """
+        for i, delta in enumerate(deltas):
+            self.push(i, delta)
+
+    def publish(self):
+        """
+        Increment the version of the weights and return it
+        """
+        with self.version.get_lock():
+            self.version.value += 1
+            return self.version.value
+
+    def snapshot(self, out):
+        """
+        Copy the weights into out and return their version. The version is read first, so a push 
+        published during the copy is seen as a new version by the next reader.
+        Parameters:
+            out: ParameterBuffer with the same shapes
+        """
+        version = self.version.value
+        out.copy_from(self)
+        return version
+
+    def stats(self):
+        """
+        Return the number of pushes, of contended lock acquisitions (striped mode) and of pushes 
+        which overlapped another one on the same tensor, hence may have lost updates (hogwild mode). 
+        Counters of hogwild mode are themselves updated without lock, so they are estimates.
+        """
+        totals = self.counters.sum(axis=0)
+        return {"mode": self.push_mode, "pushes": int(totals[1]), "contention": int(totals[2]), 
+                "lost_updates": int(totals[3])}
+
+
+class SnapshotBuffer(object):
+    """
+    Versioned weights published as a whole by one writer, like theta minus. They live in two shared
+    buffers: publish fills the back buffer, then increments version, which flips the front buffer 
+    (version % 2) in one write. Readers compare version with the one they hold and skip the copy 
+    when it is unchanged.
+    The front buffer a reader is copying is overwritten as soon as the version after the next one is
+    being published, which happens while the version is already the next one; snapshot copies again
+    whenever the version changed during its copy.
+    It must be created before the processes are started, like SharedParameters.
+    """
+
+    def __init__(self, shapes):
+        """
+        Parameters:
+            shapes: list of the shapes of the tensors, in the order of the sorted variables keys
+        """
+        size = int(np.sum([np.prod(shape) for shape in shapes]))
+        self.raws = [mp.RawArray('f', max(size, 1)) for i in range(2)]
+        self.buffers = [ParameterBuffer(shapes, buffer=raw) for raw in self.raws]
+        self.shapes = self.buffers[0].shapes
+
+        self.version = mp.Value('l', 0)
+
+    def front(self):
+        """
+        Return the ParameterBuffer of the current version
+        """
+        return self.buffers[self.version.value % 2]
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __iter__(self):
+        return iter(self.front())
+
+    def __getitem__(self, i):
+        return self.front()[i]
+
+    def publish(self, theta):
+        """
+        Copy theta into the back buffer and make it the front one. Return the new version
+        Parameters:
+            theta: ParameterBuffer with the same shapes, or list of arrays
+        """
+        with self.version.get_lock():
+            self.buffers[(self.version.value + 1) % 2].copy_from(theta)
+            self.version.value += 1
+            return self.version.value
+
+    def snapshot(self, out):
+        """
+        Copy the front buffer into out and return its version
+        Parameters:
+            out: ParameterBuffer with the same shapes
+        """
+        while True:
+            version = self.version.value
+            out.copy_from(self.buffers[version % 2])
+            if self.version.value == version:
+                return version
+
+
+class SharedRMSProp(object):
+    """
+    RMSProp whose moving averages of the squared gradients live in shared memory next to theta, as
+    in the shared RMSProp of the A3C paper: the slaves send gradients, and the statistics and the
+    weights are updated in place, so they are shared by every slave and survive their restarts.
+    For each tensor i:
+        g_i = decay * g_i + (1 - decay) * gradient_i^2
+        theta_i -= learning_rate * gradient_i / sqrt(g_i + epsilon)
+    The statistics start at 1, like the ones of tf.train.RMSPropOptimizer. In striped mode, each 
+    tensor of statistics has its own lock; in hogwild mode they are updated without lock, like theta.
+    It must be created before the processes are started, like SharedParameters.
+    """
+
+    def __init__(self, theta, decay=0.99, epsilon=1e-10):
+        """
+        Parameters:
+            theta: SharedParameters updated by the optimiser
+            decay: decay of the moving averages
+            epsilon: small value avoiding the division by 0
+        """
+        self.theta = theta
+        self.decay = decay
+        self.epsilon = epsilon
+
+        self.raw = mp.RawArray('f', max(theta.size, 1))
+        self.g = ParameterBuffer(theta.shapes, buffer=self.raw)
+        self.g.flat[:] = 1.
+        self.locks = [mp.Lock() for i in range(len(theta.shapes))]
+
+    def apply(self, i, gradient, learning_rate):
+        """
+        Update the statistics of the i-th tensor with gradient, and push the resulting update into 
+        theta. Return the norm of the update
+        Parameters:
+            i: index of the tensor
+            gradient: array with the shape of the tensor
+            learning_rate: learning rate of the update
+        """
+        g = self.g[i]
+        striped = self.theta.push_mode == "striped"
+        if striped:
+            self.locks[i].acquire()
+        try:
+            g *= self.decay
+            g += (1 - self.decay) * np.square(gradient)
+            delta = -learning_rate * gradient / np.sqrt(g + self.epsilon)
+        finally:
+            if striped:
+                self.locks[i].release()
+
+        self.theta.push(i, delta)
+        return np.linalg.norm(delta)
+
+    def apply_all(self, gradients, learning_rate):
+        """
+        Apply a gradient to every tensor, publish the new version of theta and return the sum of 
+        the norms of the updates
+        Parameters:
+            gradients: list of arrays, in the order of the tensors
+            learning_rate: learning rate of the update
+        """
+        diff = 0
+        for i, gradient in enumerate(gradients):
+            diff += self.apply(i, gradient, learning_rate)
+        self.theta.publish()
+        return diff
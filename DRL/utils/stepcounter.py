@@ -0,0 +1,48 @@
+# coding: utf-8
+
+
+class StepCounter(object):
+    """
+    Local view of the global step counter settings.T for one slave. Steps are counted locally and
+    added to the shared counter by chunks, so the lock of settings.T is taken once every chunk
+    steps instead of on every environment step.
+    """
+
+    def __init__(self, T, chunk=100):
+        """
+        Parameters:
+            T: multiprocessing.Value, global step counter shared by all the workers
+            chunk: number of local steps between two flushes into T
+        """
+        self.T = T
+        self.chunk = chunk
+        self.pending = 0
+        self.last_global = T.value
+
+    def increment(self, n=1):
+        """
+        Count n steps, and flush them into the global counter once a chunk is complete
+        Parameters:
+            n: number of steps
+        """
+        self.pending += n
+        if self.pending >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the pending local steps to the global counter and refresh the cached global value
+        """
+        with self.T.get_lock():
+            self.T.value += self.pending
+            self.last_global = self.T.value
+        self.pending = 0
+
+    @property
+    def value(self):
+        """
+        Approximate global step: last value read from T plus the steps not flushed yet. Steps
+        of the other workers are seen at the next flush, so it lags behind by less than one chunk
+        per worker.
+        """
+        return self.last_global + self.pending
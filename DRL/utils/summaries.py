@@ -0,0 +1,56 @@
+# coding: utf-8
+
+
+class SummaryPolicy(object):
+    """
+    Decide which summaries are computed with a train step: the scalars every scalar_every updates,
+    the histograms every histogram_every updates, and nothing on the other ones, so that most train
+    steps run without any summary op nor event written.
+    """
+
+    def __init__(self, writer, scalars=None, histograms=None, scalar_every=10, histogram_every=1000):
+        """
+        Parameters:
+            writer: tf.summary.FileWriter
+            scalars: merged scalar summaries, or None
+            histograms: merged histogram summaries, or None
+            scalar_every: number of updates between two scalar summaries. If 0, never
+            histogram_every: number of updates between two histogram summaries. If 0, never
+        """
+        self.writer = writer
+        self.scalars = scalars
+        self.histograms = histograms
+        self.scalar_every = scalar_every
+        self.histogram_every = histogram_every
+        self.n_updates = 0
+
+    def due(self):
+        """
+        Return the list of the summary ops to compute with the next update
+        """
+        summaries = []
+        if (self.scalars is not None) and self.scalar_every and (self.n_updates % self.scalar_every == 0):
+            summaries.append(self.scalars)
+        if (self.histograms is not None) and self.histogram_every and \
+                (self.n_updates % self.histogram_every == 0):
+            summaries.append(self.histograms)
+        return summaries
+
+    def run(self, sess, fetches, feed_dict, step):
+        """
+        Run fetches with the summaries due at this update, write the summaries at step and return
+        the values of fetches
+        Parameters:
+            sess: tensorflow session
+            fetches: list of tensors or ops, the update
+            feed_dict: feed_dict of the update
+            step: step of the summaries in TensorBoard
+        """
+        summaries = self.due()
+        results = sess.run(list(fetches) + summaries, feed_dict=feed_dict)
+
+        for summary in results[len(fetches):]:
+            self.writer.add_summary(summary, step)
+        self.n_updates += 1
+
+        return results[:len(fetches)]
@@ -1,8 +1,17 @@
 # coding: utf-8
 import numpy as np
 import multiprocessing as mp
+import time
 
-def epsilon_greedy_policy(qnn, observation, epsilon, output_size, sess, policy=None, weighted=False):
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .sharedparams import SharedParameters
+
+def epsilon_greedy_policy(qnn, observation, epsilon, output_size, sess, policy=None, weighted=False,
+                          return_outputs=False):
     """
     Take a random action with the probability epsilon, else the best action estimated by the qnn.
     Parameters:
@@ -12,8 +21,19 @@ def epsilon_greedy_policy(qnn, observation, epsilon, output_size, sess, policy=N
         env: environnment gym
         sess: tensorflow Session
         policy: policy to take a random action. If None, take a uniform law
+        return_outputs: If True, the outputs of the network for observation (output of get_reward)
+                        are returned as a third value. They are computed even for a random action, 
+                        by the same forward pass as the best action
     """
     u = np.random.binomial(1, epsilon)
+    if return_outputs:
+        action, outputs = qnn.choose_action(observation, sess, weighted)
+        if u:
+            if policy is None:
+                action = [np.random.randint(i) for i in output_size]
+            else:
+                action = [policy(i) for i in output_size]
+        return u, action, outputs
     if u:
         if policy is None:
             return 1, [np.random.randint(i) for i in output_size]
@@ -23,6 +43,27 @@ def epsilon_greedy_policy(qnn, observation, epsilon, output_size, sess, policy=N
     else:
         return 0, qnn.best_action(observation, sess, weighted)
 
+def epsilon_greedy_policy_batch(nn, observations, epsilon, output_size, sess):
+    """
+    Batched epsilon_greedy_policy for several environments: the actions of all the observations are
+    estimated in a single forward pass, then each environment takes a uniform random action with 
+    the probability epsilon. Return the array of random flags, of shape (batch_size,), and the 
+    actions, of shape (batch_size, len(output_size)).
+    Parameters:
+        nn: qnn.QNeuralNetwork, a3cnn.A3CNeuralNetwork or a numpynn engine
+        observations: np.array of shape (batch_size, input_size)
+        epsilon: probability of taking a random action
+        output_size: list, number of possible actions of each head
+        sess: tensorflow Session
+    """
+    random = np.random.binomial(1, epsilon, size=len(observations))
+    actions = nn.best_actions(observations, sess)
+    if random.any():
+        random_actions = np.stack([np.random.randint(n, size=len(observations)) for n in output_size], 
+                                  axis=1)
+        actions = np.where(random[:, None] == 1, random_actions, actions)
+    return random, actions
+
 def create_list_epsilon(n):
     """
     Compute value of epsilon_ini for each worker. For now, it takes the value 1 with probability 0.5 
@@ -43,17 +84,15 @@ def create_list_lr(n):
     lr_max = 4
     return [10**(-x) for x in np.random.uniform(lr_min, lr_max, size=n)]
 
-def initialise(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64]):
+def get_shapes(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64]):
     """
-    Initialise global variables l_theta and l_theta_minus
+    Return the shapes of the parameters of a QNeuralNetwork, in the order of its sorted keys
     Parameters:
         input_size: size of observations
         output_size: number of possible action
         n_hidden: number of hidden layers
         hidden_size: size of hidden layers
     """
-    l_theta = mp.Manager().list()
-    
     shapes = [(input_size, hidden_size[0])]
     for i in range(n_hidden - 1):
         shapes.append((hidden_size[i], hidden_size[i+1]))
@@ -63,23 +102,18 @@ def initialise(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64]):
     for i in range(n_hidden - 1):
         shapes.append((1, hidden_size[i+1]))
     shapes.append((1, output_size))
-    
-    for i, shape in enumerate(shapes):
-        l_theta.append(np.random.uniform(low=-0.01, high=0.01, size=shape))
-        
-    return l_theta
 
-def initialise_a3c(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64]):
+    return shapes
+
+def get_shapes_a3c(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64]):
     """
-    Initialise global variables l_theta and l_theta_minus
+    Return the shapes of the parameters of a A3CNeuralNetwork, in the order of its sorted keys
     Parameters:
         input_size: size of observations
         output_size: number of possible action
         n_hidden: number of hidden layers
         hidden_size: size of hidden layers
     """
-    l_theta = mp.Manager().list()
-    
     shapes = [input_size + [hidden_size[0]]]
     for i in range(n_hidden - 1):
         shapes.append((hidden_size[i], hidden_size[i+1]))
@@ -93,8 +127,71 @@ def initialise_a3c(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64
     for i in output_size:
         shapes.append((1, i))
     shapes.append((1, 1))
+
+    return shapes
+
+def initialise(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64], push_mode="hogwild"):
+    """
+    Initialise global variables l_theta and l_theta_minus
+    Parameters:
+        input_size: size of observations
+        output_size: number of possible action
+        n_hidden: number of hidden layers
+        hidden_size: size of hidden layers
+        push_mode: semantics of the pushes into the weights, see SharedParameters.PUSH_MODES
+    """
+    l_theta = SharedParameters(get_shapes(input_size=input_size, output_size=output_size, 
+                                          n_hidden=n_hidden, hidden_size=hidden_size), 
+                               push_mode=push_mode)
+    
+    for i, shape in enumerate(l_theta.shapes):
+        l_theta[i] = np.random.uniform(low=-0.01, high=0.01, size=shape)
+        
+    return l_theta
+
+def initialise_a3c(input_size=4, output_size=2, n_hidden=2, hidden_size=[128, 64], 
+                   push_mode="hogwild"):
+    """
+    Initialise global variables l_theta and l_theta_minus
+    Parameters:
+        input_size: size of observations
+        output_size: number of possible action
+        n_hidden: number of hidden layers
+        hidden_size: size of hidden layers
+        push_mode: semantics of the pushes into the weights, see SharedParameters.PUSH_MODES
+    """
+    l_theta = SharedParameters(get_shapes_a3c(input_size=input_size, output_size=output_size, 
+                                              n_hidden=n_hidden, hidden_size=hidden_size), 
+                               push_mode=push_mode)
     
-    for i, shape in enumerate(shapes):
-        l_theta.append(np.random.uniform(low=-0.01, high=0.01, size=shape))
+    for i, shape in enumerate(l_theta.shapes):
+        l_theta[i] = np.random.uniform(low=-0.01, high=0.01, size=shape)
         
-    return l_theta
\ No newline at end of file
+    return l_theta
+
+def gather_queue(q, batch_size, max_wait, size=len):
+    """
+    Wait for an item of a multiprocessing queue, then get the next ones until their total size
+    reaches batch_size or max_wait seconds elapsed since the first one. Return the list of items.
+    Parameters:
+        q: multiprocessing.Queue
+        batch_size: total size from which the items are returned without waiting
+        max_wait: maximum time in seconds waited after the first item
+        size: function giving the size of an item
+    """
+    items = [q.get()]
+    n_rows = size(items[0])
+    deadline = time.time() + max_wait
+
+    while n_rows < batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            item = q.get(timeout=timeout)
+        except queue.Empty:
+            break
+        items.append(item)
+        n_rows += size(item)
+
+    return items
@@ -0,0 +1,109 @@
+# coding: utf-8
+"""
+Check of the TCP parameter server (DRL.utils.paramserver) with several processes on localhost:
+clients forked after connect push deltas, count steps into T and read theta minus concurrently,
+and the server rejects malformed requests. Prints the timings of the pulls and pushes.
+Usage: python benchmarks/paramserver_check.py [n_clients] [n_pushes]
+"""
+import os
+import socket
+import sys
+import time
+import multiprocessing as mp
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from DRL.utils import settings
+from DRL.utils.paramserver import (HEADER, PUSH, Connection, connect, parameter_server,
+                                   recv_message)
+from DRL.utils.sharedparams import ParameterBuffer
+from DRL.utils.stepcounter import StepCounter
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def client(address, n_pushes, results):
+    """
+    Push n_pushes deltas of ones into theta and count one step of T per push
+    """
+    info = connect(address)
+    T = StepCounter(settings.T, 10)
+    theta = ParameterBuffer(info["shapes"])
+    ones = [np.ones(shape, dtype=np.float32) for shape in theta.shapes]
+
+    t_pull = t_push = 0.
+    for i in range(n_pushes):
+        start = time.time()
+        theta.pull(settings.l_theta)
+        t_pull += time.time() - start
+
+        start = time.time()
+        settings.l_theta.push_all(ones)
+        settings.l_theta.publish()
+        t_push += time.time() - start
+
+        T.increment()
+    T.flush()
+
+    minus = ParameterBuffer(info["shapes"])
+    settings.l_theta_minus.snapshot(minus)
+    results.put((t_pull / n_pushes, t_push / n_pushes, minus.flat.copy()))
+
+def main(n_clients=4, n_pushes=100):
+    settings.init(algo="nstep", n_hidden=2, hidden_size=[64, 64], input_size=4, output_size=2,
+                  push_mode="striped")
+    initial = settings.l_theta.flat.copy()
+    address = ("127.0.0.1", free_port())
+
+    server = parameter_server("nstep", address[1], address[0])
+    server.start()
+    time.sleep(0.5)
+
+    results = mp.Queue()
+    clients = [mp.Process(target=client, args=(address, n_pushes, results)) for i in range(n_clients)]
+    for process in clients:
+        process.start()
+    timings = [results.get() for process in clients]
+    for process in clients:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in clients), "A client failed"
+    assert settings.T.value == n_clients * n_pushes, "T = %s"%settings.T.value
+    assert settings.l_theta.version.value == n_clients * n_pushes
+    assert np.allclose(settings.l_theta.flat - initial, n_clients * n_pushes), "Lost pushes"
+    assert all(np.array_equal(minus, initial) for t_pull, t_push, minus in timings)
+
+    # Malformed requests: a push of the wrong size is rejected, an oversized header closes the
+    # connection
+    connection = Connection(address)
+    try:
+        connection.request(PUSH, b"\0" * 8)
+        raise AssertionError("A push of the wrong size was accepted")
+    except RuntimeError as e:
+        print("Rejected: %s"%e)
+    sock = socket.create_connection(address)
+    sock.sendall(HEADER.pack(PUSH, 2**31))
+    print("Oversized request: %s"%recv_message(sock)[1].decode())
+    sock.close()
+    connection.sock.close()
+
+    server.drain(5)
+    assert server.clients.value == 0, "%s clients still connected"%server.clients.value
+    server.terminate()
+
+    print("%s clients x %s pushes of %s floats: T = %s, version %s"%(n_clients, n_pushes,
+          settings.l_theta.size, settings.T.value, settings.l_theta.version.value))
+    print("pull %.1f us, push %.1f us"%(1e6 * np.mean([t[0] for t in timings]),
+                                        1e6 * np.mean([t[1] for t in timings])))
+    print("OK")
+
+
+if __name__=="__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,59 @@
+# coding: utf-8
+"""
+Micro-benchmark of DRL.utils.returns.discounted_returns against the Python loop previously used
+in the n step and A3C slaves.
+Usage: python benchmarks/returns_benchmark.py
+"""
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from DRL.utils.returns import discounted_returns
+
+
+def loop_returns(reward_batch, done_batch, R, gamma):
+    """
+    Former computation of the slaves, for one environment, with the episode boundaries, up to the
+    array of targets fed to the train step
+    """
+    true_reward = []
+    for i in range(len(reward_batch) - 1, -1, -1):
+        if done_batch[i]:
+            R = 0
+        R = reward_batch[i] + gamma * R
+        true_reward.append(R)
+    return np.array(true_reward[::-1])
+
+def main(gamma=0.9, number=2000, p_done=0.05):
+    """
+    Parameters:
+        gamma: depreciation of the futur
+        number: number of repetitions of each measure
+        p_done: probability that an episode ends at each step
+    """
+    print("%8s %8s %14s %14s %8s"%("t_max", "n_envs", "loop (us)", "numpy (us)", "speedup"))
+    for t_max in [5, 20, 100]:
+        for n_envs in [1, 16, 64]:
+            rewards = np.random.rand(t_max, n_envs).astype(np.float32)
+            dones = (np.random.rand(t_max, n_envs) < p_done).astype(np.float32)
+            bootstrap = np.random.rand(n_envs).astype(np.float32)
+            reward_lists = [list(rewards[:, k]) for k in range(n_envs)]
+            done_lists = [list(dones[:, k]) for k in range(n_envs)]
+
+            t_loop = timeit.timeit(lambda: [loop_returns(reward_lists[k], done_lists[k], bootstrap[k], 
+                                            gamma) for k in range(n_envs)], number=number) / number
+            if n_envs == 1:
+                # Single environment slaves pass 1-D rollouts
+                rewards, dones, bootstrap = rewards[:, 0], dones[:, 0], bootstrap[0]
+            t_numpy = timeit.timeit(lambda: discounted_returns(rewards, dones, bootstrap, gamma), 
+                                    number=number) / number
+
+            print("%8s %8s %14.1f %14.1f %8.1f"%(t_max, n_envs, 1e6 * t_loop, 1e6 * t_numpy, 
+                                                  t_loop / t_numpy))
+
+
+if __name__=="__main__":
+    main()
@@ -11,9 +11,16 @@ from DRL.slaves.asynchronenstepslave import slave_worker_n_step
 from DRL.slaves.asynchrone1stepslave import slave_worker_1_step
 from DRL.slaves.asynchrone1stepsarsaslave import slave_worker_1_step_sarsa
 from DRL.slaves.asynchronea3cslave import slave_worker_a3c
+from DRL.slaves.multienvslave import slave_worker_multi_env
 from DRL.slaves.tester import tester_worker
+from DRL.slaves.predictor import PredictorChannels, predictor_worker
+from DRL.slaves.trainer import trainer_worker
+from DRL.utils.replay import PrioritizedReplay
+from DRL.utils.checkpoint import make_run_directory, resume_shared_state
+from DRL.utils.paramserver import connect, parameter_server
 
 from DRL.utils.settings import init
+from DRL.utils import settings
 
 
 
@@ -22,7 +29,13 @@ def main(nb_process, T_max=5000, t_max=5, env_name="CartPole-v0", algo="nstep",
          Itarget=100, gamma=0.9, learning_rate=0.001, several_eps=True, epsilon_ini=0.9, 
          n_sec_print=10, master=False, goal=495, len_history=100, render=False, weighted=False, 
          eps_fall=50000, callback=False, action_replay=1, reset=False, warmstart=False, 
-         weights_path="./Acrobot_v1/intermediate_weights", nb_render=5, **kwargs):
+         weights_path="./Acrobot_v1/intermediate_weights", nb_render=5, push_mode="hogwild", T_chunk=100, 
+         inference="tf", n_envs=1, n_predictors=0, predictor_batch_size=32, predictor_max_wait=0.001,
+         n_trainers=0, trainer_batch_size=256, trainer_max_wait=0.01, replay_capacity=0, 
+         replay_batch_size=32, replay_ratio=1, replay_path=None, scalar_every=10, 
+         histogram_every=1000, callback_backend="csv", eval_episodes=0, eval_processes=1, 
+         checkpoint=600, checkpoints_path="./checkpoints", resume=None, guard_every=0, optimizer="rmsprop", 
+         serve=None, server=None, seed=0, stop_timeout=30, **kwargs):
     """
     Parameters:
         nb_process: number of slaves used in the training
@@ -44,6 +57,64 @@ def main(nb_process, T_max=5000, t_max=5, env_name="CartPole-v0", algo="nstep",
         goal: Value of reward to considered the game as solved
         len_history: number of episodes to test the algorithm
         render: If True, environments of the tester will be rendered
+        push_mode: how slaves add their updates to the shared weights, "hogwild" (lock-free) or 
+                   "striped" (one lock per tensor)
+        T_chunk: number of steps a slave counts locally before adding them to the global counter T
+        inference: "tf" to choose actions with the tensorflow sessions, "numpy" to evaluate the
+                   networks of the slaves and of the tester with NumPy
+        n_envs: number of environments stepped side by side by each slave. If more than 1, the slaves
+                choose the actions of all their environments in one batch (multienvslave), for the
+                algorithms "nstep", "1step" and "a3c"
+        n_predictors: number of predictor processes. If more than 0, the slaves send their observations
+                      to the predictors, which choose the actions of all the slaves in batches 
+                      (predictor.predictor_worker). Implemented for "nstep", "a3c" and n_envs > 1
+        predictor_batch_size: number of observations from which a predictor evaluates a batch without
+                              waiting for other requests
+        predictor_max_wait: maximum time in seconds a request waits in a predictor for other ones
+        n_trainers: number of trainer processes. If more than 0, the slaves only collect rollouts and
+                    send them to the trainers, which train the shared weights on minibatches made of
+                    the rollouts of several slaves (trainer.trainer_worker). Implemented for "nstep",
+                    "a3c" and n_envs > 1
+        trainer_batch_size: number of transitions from which a trainer trains without waiting for
+                            other rollouts
+        trainer_max_wait: maximum time in seconds a rollout waits in a trainer for other ones
+        replay_capacity: number of transitions of the prioritized replay buffer shared by the slaves
+                         (replay.PrioritizedReplay). If 0, no replay. Implemented for "nstep", and for
+                         "1step" with n_envs > 1
+        replay_batch_size: number of transitions of a batch sampled from the replay buffer
+        replay_ratio: number of updates on replayed batches after each update on a rollout
+        replay_path: directory of the memory-mapped files of the replay buffer. If None, a temporary
+                     directory removed at the end
+        scalar_every: number of updates of a slave or a trainer between two summaries of the learning
+                      rate and the loss. If 0, never
+        histogram_every: number of updates between two histograms of the weights. If 0, never
+        callback_backend: "csv" to write the callbacks as CSV files in the processes, "binary" to write
+                          .npy chunks from a background thread, converted by callback.export_csv
+        eval_episodes: if more than 0, the tester plays its episodes by batches of eval_episodes 
+                       environments in lockstep, with batched NumPy inference (evaluator.Evaluator)
+        eval_processes: number of processes the batches of test episodes are split over
+        checkpoint: number of seconds between two checkpoints of the training state
+        checkpoints_path: directory where the run directory of the checkpoints is created
+        resume: if not None, run directory of a previous run. Its latest checkpoint is restored: T, theta,
+                theta minus, and the states of the tester and of the slaves (epsilons, optimiser slots,
+                learning rate schedules, random states), and the new checkpoints are written in it
+        guard_every: if more than 0, every process reports the number of operations of its graph and
+                     its resident memory every guard_every seconds (graphguard.GraphGuard)
+        optimizer: "rmsprop" for an optimiser per network, "shared_rmsprop" to keep the statistics of
+                   RMSProp in shared memory next to theta: the slaves and the trainers send gradients,
+                   applied to theta in place (sharedparams.SharedRMSProp)
+        serve: if not None, port on which a parameter server serves T, theta, theta minus and the
+               shared optimiser over TCP (paramserver.parameter_server), for the slaves of other hosts.
+               A port alone listens on the loopback interface; (host, port) exposes the server on
+               host, which has no authentication and must be on a trusted network
+        server: if not None, (host, port) of the parameter server of a run started on another host 
+                (see remote.py): only the slaves are started, and they train its shared state. The
+                options of the model and the algorithm must be the ones of the run. An Exception is
+                raised if a slave stopped with an error, e.g. because it lost the parameter server
+        seed: seed of the first slave, the next ones use the following seeds. The hosts of a run need
+              different seeds
+        stop_timeout: number of seconds the slaves have to stop by themselves once the tester is done,
+                      before they are terminated
         kwargs: args of multiprocessing.Process
     """
 
@@ -70,8 +141,29 @@ def main(nb_process, T_max=5000, t_max=5, env_name="CartPole-v0", algo="nstep",
 
     
 
-    init(algo=algo, n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"], 
-         input_size=input_size, output_size=output_size)
+    if server is not None:
+        info = connect(server)
+        assert info["algo"] == algo, "The parameter server runs %s"%info["algo"]
+        print("Connected to the parameter server %s:%s at T = %s"%(server[0], server[1], 
+                                                                   settings.T.value))
+        run_directory = None
+        resume = None
+    else:
+        init(algo=algo, n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"], 
+             input_size=input_size, output_size=output_size, push_mode=push_mode, optimizer=optimizer)
+
+        if resume is not None:
+            run_directory = resume
+            resume_shared_state(run_directory)
+            print("Resuming %s from T = %s"%(run_directory, settings.T.value))
+        else:
+            run_directory = make_run_directory(checkpoints_path)
+
+    servers = []
+    if serve is not None:
+        host, port = serve if isinstance(serve, tuple) else ("127.0.0.1", serve)
+        servers.append(parameter_server(algo, port, host))
+        servers[0].start()
     """
     init(algo=algo, n_hidden=model_option["n_hidden"], hidden_size=model_option["hidden_size"], 
          input_size= env_temp.observation_space.shape[0], output_size=env_temp.action_space.n)
@@ -100,31 +192,107 @@ def main(nb_process, T_max=5000, t_max=5, env_name="CartPole-v0", algo="nstep",
     else:
         raise Exception("Not understood algorithm")
 
+    slave_options = {}
+    if n_envs > 1:
+        if algo == "1stepsarsa":
+            raise Exception("Several environments per slave are not implemented for 1stepsarsa")
+        slave_worker = slave_worker_multi_env
+        slave_options = {"algo": algo, "n_envs": n_envs}
+
+    if (n_predictors > 0) | (n_trainers > 0):
+        if (n_envs == 1) & (algo not in ["nstep", "a3c"]):
+            raise Exception("Predictors and trainers are not implemented for the %s slaves"%algo)
+
+    if replay_capacity > 0:
+        if (algo not in ["nstep", "1step"]) | ((algo == "1step") & (n_envs == 1)):
+            raise Exception("Replay is not implemented for the %s slaves"%algo)
+        slave_options["replay"] = PrioritizedReplay(replay_capacity, input_size, directory=replay_path)
+        slave_options["replay_batch_size"] = replay_batch_size
+        slave_options["replay_ratio"] = replay_ratio
 
-    exemple = tester_worker(algo=algo, T_max=T_max, t_max=10000, model_option=model_option, env_name=env_name, 
-                            n_sec_print=n_sec_print, goal=goal, len_history=len_history, Itarget=Itarget,
-                            render=render, weighted=weighted, callback=callback, 
-                            callback_name="callbacks/tester", warmstart=warmstart, 
-                            weights_path=weights_path, nb_render=nb_render)
-    exemple.start()
+    predictors = []
+    if n_predictors > 0:
+        channels = PredictorChannels(nb_process, input_size, output_size, algo=algo, 
+                                     slot_size=n_envs)
+        for i in range(n_predictors):
+            predictor = predictor_worker(channels, model_option=model_option, 
+                                         batch_size=predictor_batch_size, max_wait=predictor_max_wait,
+                                         inference=inference, verbose=master, guard_every=guard_every)
+            predictor.start()
+            predictors.append(predictor)
+
+    trainers = []
+    if n_trainers > 0:
+        # Bounded, so that the slaves wait for the trainers instead of sending stale rollouts
+        rollouts = mp.Queue(maxsize=4 * nb_process)
+        slave_options["trainer"] = rollouts
+        for i in range(n_trainers):
+            trainer = trainer_worker(rollouts, algo=algo, input_size=input_size, output_size=output_size,
+                                     model_option=model_option, learning_rate=learning_rate,
+                                     batch_size=trainer_batch_size, max_wait=trainer_max_wait, 
+                                     name="trainer" + str(i), verbose=master, 
+                                     scalar_every=scalar_every, histogram_every=histogram_every,
+                                     guard_every=guard_every)
+            trainer.start()
+            trainers.append(trainer)
+
+
+    exemple = None
+    if server is None:
+        exemple = tester_worker(algo=algo, T_max=T_max, t_max=10000, model_option=model_option, 
+                                env_name=env_name, n_sec_print=n_sec_print, goal=goal, 
+                                len_history=len_history, Itarget=Itarget,
+                                render=render, weighted=weighted, callback=callback, 
+                                callback_name="callbacks/tester", warmstart=warmstart, 
+                                weights_path=weights_path, nb_render=nb_render, inference=inference,
+                                callback_backend=callback_backend, eval_episodes=eval_episodes, 
+                                eval_processes=eval_processes, checkpoint=checkpoint, 
+                                run_directory=run_directory, resume=resume is not None, 
+                                guard_every=guard_every)
+        exemple.start()
 
     for i in range(nb_process):
         print("Process %s starting"%i)
+        if n_predictors > 0:
+            slave_options["predictor"] = channels.client(i)
         job = slave_worker(T_max=T_max, model_option=model_option, env_name=env_name, 
             policy=policies[i], epsilon_ini=epsilons[i], t_max=t_max, gamma=gamma, 
             learning_rate=learning_rates[i], verbose=verboses[i], weighted=weighted, 
             Iasyncupdate=Iasyncupdate, eps_fall=eps_fall, callback=callback,
-            callback_name="callbacks/actor" + str(i), name=str(i), seed=i, action_replay=action_replay,
-            reset=reset)
+            callback_name="callbacks/actor" + str(i), name=str(i), seed=seed + i, action_replay=action_replay,
+            reset=reset, T_chunk=T_chunk, inference=inference, scalar_every=scalar_every, 
+            histogram_every=histogram_every, callback_backend=callback_backend, 
+            checkpoints_path=run_directory, resume=resume is not None, guard_every=guard_every, 
+            **slave_options)
         job.start()
         jobs.append(job)
 
 
-    exemple.join()
+    if exemple is not None:
+        exemple.join()
+        # The tester pushed T past T_max: the slaves stop at their next flush of T, after writing
+        # their callbacks
+        for job in jobs:
+            job.join(stop_timeout)
+        for process in servers:
+            process.drain(stop_timeout)
+    else:
+        # The slaves of a remote host stop by themselves when T reaches T_max
+        for job in jobs:
+            job.join()
 
-    for job in jobs:
+    for job in jobs + predictors + trainers + servers:
         job.terminate()
 
+    if replay_capacity > 0:
+        slave_options["replay"].cleanup()
+
+    if server is not None:
+        failed = [job.name for job in jobs if job.exitcode != 0]
+        if len(failed) > 0:
+            raise Exception("The slaves %s stopped with an error, e.g. the parameter server was "
+                            "lost"%failed)
+
 
 if __name__=="__main__":
     args = sys.argv
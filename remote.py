@@ -0,0 +1,19 @@
+# coding: utf-8
+import sys
+
+from main import main
+
+
+if __name__=="__main__":
+    # Slaves of a run whose parameter server was started on another host, e.g. with
+    # main(..., serve=5000). Usage: python remote.py host:port nb_process seed
+    # The options must be the ones of the run
+    args = sys.argv
+    host, port = args[1].rsplit(":", 1)
+    nb_process = int(args[2]) if len(args) > 2 else 8
+    seed = int(args[3]) if len(args) > 3 else 1000
+
+    main(nb_process, T_max=10000000, model_option={"n_hidden":2, "hidden_size":[128, 256]},
+        render=False, master=False, env_name="CartPole-v1", goal=9900, learning_rate=0.001,
+        weighted=False, algo="a3c", eps_fall=100000, callback=True, Itarget=100, action_replay=1,
+        reset=True, t_max=5, server=(host, int(port)), seed=seed)